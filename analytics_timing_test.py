@@ -1,44 +1,380 @@
 import argparse
+import csv
+import datetime
+import json
 import logging
+import math
+import random
+import statistics
+import subprocess
+import threading
+import time
+from collections import defaultdict
+
 import psycopg2
 
+from query_plans import capture_plan, compare_plans, EXPLAIN_MODES, DEFAULT_MISESTIMATE_FACTOR
+from result_cache import ResultCache, run_cached_query, DEFAULT_RESULT_CACHE_MAX_SIZE_GB
 from sql_queries import analytical_queries, discardable_query
+from tracing import add_tracing_arguments, start_tracing
 from utilities import load_settings, Timer, logging_datefmt, logging_format, logging_argparse_kwargs, \
-    logging_argparse_args
+    logging_argparse_args, get_connection_kwargs
 
 logging.basicConfig(format=logging_format,
                     datefmt=logging_datefmt)
 logger = logging.getLogger(__file__)
 
 DEFAULT_N = 5
+DEFAULT_WARMUP = 1
+DEFAULT_FETCH = "all"
+DEFAULT_FETCH_SIZE = 10000
+FETCH_MODES = ["none", "all", "count"]
+DEFAULT_CONCURRENCY = 8
+DEFAULT_DURATION = 300
+
+# Wraps a query so the server computes the full result but only a single row is returned
+count_wrapper = """
+SELECT COUNT(*) FROM (
+{query}
+) counted
+"""
+
+
+def get_git_revision():
+    """
+    Returns the git revision of the working directory, or "unknown" if it cannot be determined
+    """
+    try:
+        revision = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL)
+        return revision.decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return "unknown"
+
+
+def run_query(engine, q, fetch=DEFAULT_FETCH, fetch_size=DEFAULT_FETCH_SIZE, result_cache=None):
+    """
+    Runs a query once, returning the time taken and number of rows delivered
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        q (str): Query to run
+        fetch (str): How results are consumed:
+                        none: execute only.  On postgres this measures time until results are ready, not delivered
+                        all: fetch every row through a server-side cursor in batches of fetch_size
+                        count: wrap the query in SELECT COUNT(*) so the full result is computed but not transferred
+        fetch_size (int): Rows fetched per round trip when fetch is 'all'
+        result_cache (ResultCache): (optional) If provided, the full result is read through this cache (see
+                                    result_cache.run_cached_query) and fetch is ignored
+
+    Returns:
+        (tuple): (seconds, number of rows or None if rows were not fetched)
+    """
+    n_rows = None
+    t_start = time.perf_counter()
+    if result_cache is not None:
+        n_rows = run_cached_query(engine, q, cache=result_cache, batch_size=fetch_size).num_rows
+        return time.perf_counter() - t_start, n_rows
+    elif fetch == "none":
+        cur = engine.cursor()
+        cur.execute(q)
+    elif fetch == "all":
+        # Named cursors stream results from the server rather than holding the full result in memory
+        cur = engine.cursor(name="benchmark")
+        cur.itersize = fetch_size
+        cur.execute(q)
+        n_rows = 0
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            if not rows:
+                break
+            n_rows += len(rows)
+    elif fetch == "count":
+        cur = engine.cursor()
+        cur.execute(count_wrapper.format(query=q))
+        n_rows = cur.fetchone()[0]
+    else:
+        raise ValueError(f"Unknown fetch mode {fetch}")
+    elapsed = time.perf_counter() - t_start
+    cur.close()
+    engine.commit()
+    return elapsed, n_rows
 
 
-def run_analytical_queries(engine, n):
+def percentile(values, p):
+    """
+    Returns the p'th percentile of values, linearly interpolating between the closest ranks
+
+    Args:
+        values (list): Numeric values
+        p (float): Percentile in [0, 100]
+
+    Returns:
+        (float)
+    """
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100
+    lower = math.floor(rank)
+    upper = math.ceil(rank)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def summarize(times):
+    """
+    Returns summary statistics for a list of run times
+
+    Args:
+        times (list): Run times in seconds
+
+    Returns:
+        (dict): n, min, median, mean, p95, max and stddev of times.  If times is empty, n is 0 and every other
+                statistic is None
+    """
+    if not times:
+        return dict(n=0, min=None, median=None, mean=None, p95=None, max=None, stddev=None)
+    return dict(
+        n=len(times),
+        min=min(times),
+        median=statistics.median(times),
+        mean=statistics.mean(times),
+        p95=percentile(times, 95),
+        max=max(times),
+        stddev=statistics.stdev(times) if len(times) > 1 else 0.0,
+    )
+
+
+def run_analytical_queries(engine, n, warmup=DEFAULT_WARMUP, fetch=DEFAULT_FETCH, fetch_size=DEFAULT_FETCH_SIZE,
+                           queries=None, explain="none", db_type="postgres", baseline=None,
+                           misestimate_factor=DEFAULT_MISESTIMATE_FACTOR, result_cache=None):
     """
     Runs a suite of analytics queries n times each using the provided engine
 
     Args:
         engine: psycopg2 engine connected to postgres database
-        n (int): Number of iterations per query
+        n (int): Number of timed iterations per query
+        warmup (int): Number of untimed iterations per query run before the timed iterations
+        fetch (str): How results are consumed (see run_query)
+        fetch_size (int): Rows fetched per round trip when fetch is 'all'
+        queries (dict): Map of {query_name: query}.  Default is sql_queries.analytical_queries
+        explain (str): 'none', 'plan' to capture each query's plan, or 'analyze' to also capture actual execution
+                       statistics (see query_plans.capture_plan).  Plans are captured after the timed runs
+        db_type (str): postgres or redshift
+        baseline (dict): (optional) Results from a previous run with plans.  If provided, each plan is compared to its
+                         baseline and any likely regressions are logged and returned
+        misestimate_factor (float): Ratio between actual and estimated rows above which a plan node is flagged
+        result_cache (ResultCache): (optional) If provided, results are read through this cache (see run_query)
+
+    Returns:
+        (dict): Map of {query_name: {"times": [...], "rows": rows from the last run, **summary statistics}}.  If
+                plans are captured, results also include "plan", "plan_regressions" and "n_plan_regressions"
     """
+    queries = queries or analytical_queries
     cur = engine.cursor()
+    results = {}
 
-    for q_name, q in analytical_queries.items():
+    for q_name, q in queries.items():
         # Discard a query in case there's an initial connect time
         with Timer(enter_message=f"Running a junk query in case there's an initial connect time",
                    exit_message="\t--> junk query done",
                    print_function=logger.info,
+                   name="junk query",
                    ):
             cur.execute(discardable_query)
+            engine.commit()
+        logger.debug(f"query definition:\n{q}")
+
+        with Timer(enter_message=f"Running query {q_name} {warmup} times to warm up",
+                   exit_message="\t--> warmup done", print_function=logger.info, name=f"warmup {q_name}"):
+            for _ in range(warmup):
+                run_query(engine, q, fetch=fetch, fetch_size=fetch_size, result_cache=result_cache)
+
+        times = []
+        n_rows = None
         with Timer(enter_message=f"Running query {q_name} {n} times", exit_message="\t--> batch run done",
-                   print_function=logger.info,
-                   ):
-            logger.debug(f"query definition:\n{q}")
+                   print_function=logger.info, name=f"run {q_name}", attributes=dict(runs=n),
+                   ) as span:
             for i in range(n):
-                with Timer(exit_message=f"\t--> {i}",
-                           print_function=logger.info,
-                           ):
-                    cur.execute(q)
+                elapsed, n_rows = run_query(engine, q, fetch=fetch, fetch_size=fetch_size, result_cache=result_cache)
+                logger.info(f"\t--> {i}: {elapsed:.2f}s ({n_rows} rows)")
+                times.append(elapsed)
+            if n_rows is not None:
+                span.set_attributes(rows=n_rows * n)
+
+        results[q_name] = dict(times=times, rows=n_rows, **summarize(times))
+        logger.info(f"\t--> min={results[q_name]['min']:.2f}s, median={results[q_name]['median']:.2f}s, "
+                    f"p95={results[q_name]['p95']:.2f}s, stddev={results[q_name]['stddev']:.2f}s")
+
+        if explain != "none":
+            with Timer(enter_message=f"Capturing plan for {q_name}", exit_message="\t--> plan captured",
+                       print_function=logger.info, name=f"plan {q_name}"):
+                plan = capture_plan(engine, q, db_type=db_type, analyze=explain == "analyze")
+            regressions = []
+            if baseline and baseline.get(q_name, {}).get("plan"):
+                regressions = compare_plans(baseline[q_name]["plan"], plan, misestimate_factor=misestimate_factor)
+                for regression in regressions:
+                    logger.warning(f"\t--> plan regression in {q_name}: {regression}")
+            results[q_name].update(plan=plan, plan_regressions=regressions, n_plan_regressions=len(regressions))
+    return results
+
+
+def parse_weights(weight_args, queries):
+    """
+    Parses query weights from strings of "query name=weight"
+
+    Args:
+        weight_args (list): List of "query name=weight" strings, or None.  Queries not listed have weight 0 if any
+                            weights are given, otherwise every query has weight 1
+        queries (dict): Map of {query_name: query}
+
+    Returns:
+        (dict): Map of {query_name: weight}
+    """
+    if not weight_args:
+        return {q_name: 1.0 for q_name in queries}
+
+    weights = {q_name: 0.0 for q_name in queries}
+    for weight_arg in weight_args:
+        q_name, weight = weight_arg.rsplit("=", 1)
+        if q_name not in queries:
+            raise ValueError(f"Unknown query {q_name}.  Options are {list(queries)}")
+        weights[q_name] = float(weight)
+    return weights
+
+
+def run_load_test(connect, concurrency=DEFAULT_CONCURRENCY, duration=DEFAULT_DURATION, weights=None,
+                  fetch=DEFAULT_FETCH, fetch_size=DEFAULT_FETCH_SIZE, queries=None, seed=None, result_cache=None):
+    """
+    Runs a weighted mix of analytics queries from concurrent connections for a fixed duration
+
+    Each worker thread uses its own connection and repeatedly picks a query at random by weight and runs it until the
+    duration has elapsed.  Queries in flight when the duration elapses are allowed to finish
+
+    Args:
+        connect: Function that returns a new psycopg2 connection
+        concurrency (int): Number of concurrent connections
+        duration (float): Seconds to generate load for
+        weights (dict): Map of {query_name: relative weight}.  Default is equal weights
+        fetch (str): How results are consumed (see run_query)
+        fetch_size (int): Rows fetched per round trip when fetch is 'all'
+        queries (dict): Map of {query_name: query}.  Default is sql_queries.analytical_queries
+        seed (int): Random seed for the query mix.  Each worker uses seed + worker index
+        result_cache (ResultCache): (optional) If provided, results are read through this cache (see run_query)
+
+    Returns:
+        (dict): Map of {query_name: {"times": [...], "throughput": queries/sec, "errors": n, **summary statistics}}
+                for each query run or failed at least once, plus an "all queries" entry for the whole workload.
+                Queries that only failed have n=0 and no latency statistics (see summarize)
+    """
+    queries = queries or analytical_queries
+    weights = weights or {q_name: 1.0 for q_name in queries}
+    q_names = [q_name for q_name in queries if weights.get(q_name, 0) > 0]
+    q_weights = [weights[q_name] for q_name in q_names]
+    if not q_names:
+        raise ValueError(f"At least one query must have a positive weight.  Weights are {weights}")
+
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    worker_failures = {}
+    lock = threading.Lock()
+    t_end = time.perf_counter() + duration
+
+    def worker(i_worker):
+        rng = random.Random(None if seed is None else seed + i_worker)
+        try:
+            engine = connect()
+        except Exception as e:
+            logger.error(f"\tworker {i_worker}: failed to connect: {e}")
+            with lock:
+                worker_failures[i_worker] = e
+            return
+        try:
+            while time.perf_counter() < t_end:
+                q_name = rng.choices(q_names, weights=q_weights)[0]
+                try:
+                    elapsed, _ = run_query(engine, queries[q_name], fetch=fetch, fetch_size=fetch_size,
+                                           result_cache=result_cache)
+                    with lock:
+                        latencies[q_name].append(elapsed)
+                except psycopg2.Error as e:
+                    logger.warning(f"\tworker {i_worker}: query {q_name} failed: {e}")
+                    engine.rollback()
+                    with lock:
+                        errors[q_name] += 1
+        except Exception as e:
+            logger.error(f"\tworker {i_worker}: failed: {e}")
+            with lock:
+                worker_failures[i_worker] = e
+        finally:
+            engine.close()
+
+    logger.info(f"Running load test with {concurrency} connections for {duration}s")
+    t_start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t_start
+
+    if worker_failures:
+        messages = {i: str(e) for i, e in sorted(worker_failures.items())}
+        raise ValueError(f"{len(worker_failures)} of {concurrency} load test workers failed: {messages}") from \
+            next(iter(worker_failures.values()))
+
+    results = {}
+    all_times = []
+    for q_name in q_names:
+        times = latencies[q_name]
+        all_times.extend(times)
+        if times or errors[q_name]:
+            results[q_name] = dict(times=times, throughput=len(times) / elapsed, errors=errors[q_name],
+                                   **summarize(times))
+    if all_times or errors:
+        results["all queries"] = dict(times=all_times, throughput=len(all_times) / elapsed,
+                                      errors=sum(errors.values()), **summarize(all_times))
+
+    for q_name, result in results.items():
+        if result["n"] == 0:
+            logger.info(f"\t{q_name}: no successful runs, errors={result['errors']}")
+            continue
+        logger.info(f"\t{q_name}: {result['throughput']:.3f} queries/s, median={result['median']:.2f}s, "
+                    f"p95={result['p95']:.2f}s, max={result['max']:.2f}s, errors={result['errors']}")
+    return results
+
+
+def write_results(results, output, metadata):
+    """
+    Writes benchmark results to {output}.json and {output}.csv
+
+    The json file contains metadata, every run time and any captured plans.  The csv file contains one row of summary
+    statistics per query, with the metadata repeated on each row so files from different runs can be concatenated
+
+    Args:
+        results (dict): Results from run_analytical_queries
+        output (str): Output filename, without extension
+        metadata (dict): Run metadata (db, git revision, settings, ...)
+    """
+    with open(f"{output}.json", "w") as stream:
+        json.dump(dict(metadata=metadata, results=results), stream, indent=2)
+
+    # Results may not all have the same statistics (eg: plans only for some queries), so collect them from every result
+    stat_names = list(dict.fromkeys(k for result in results.values() for k, v in result.items()
+                                    if not isinstance(v, (list, dict))))
+    with open(f"{output}.csv", "w", newline="") as stream:
+        writer = csv.writer(stream)
+        writer.writerow(list(metadata) + ["query"] + stat_names)
+        for q_name, result in results.items():
+            writer.writerow(list(metadata.values()) + [q_name] + [result.get(s) for s in stat_names])
+    logger.info(f"Wrote results to {output}.json and {output}.csv")
+
+
+def positive_int(value):
+    """
+    argparse type for an integer of at least 1
+    """
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return value
 
 
 def parse_arguments():
@@ -52,12 +388,112 @@ def parse_arguments():
     )
     parser.add_argument(
         "-n",
+        type=positive_int,
         default=DEFAULT_N,
         help=f"Number of runs per query.  Default is {DEFAULT_N}"
     )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=DEFAULT_WARMUP,
+        help=f"Number of untimed runs per query before the timed runs.  Default is {DEFAULT_WARMUP}"
+    )
+    parser.add_argument(
+        "--fetch",
+        choices=FETCH_MODES,
+        default=DEFAULT_FETCH,
+        help="How query results are consumed.  'none' only executes the query, 'all' fetches every row through a "
+             "server-side cursor, and 'count' wraps the query in SELECT COUNT(*).  "
+             f"Default is {DEFAULT_FETCH}"
+    )
+    parser.add_argument(
+        "--fetch_size",
+        type=int,
+        default=DEFAULT_FETCH_SIZE,
+        help=f"Rows fetched per round trip when --fetch is 'all'.  Default is {DEFAULT_FETCH_SIZE}"
+    )
+    parser.add_argument(
+        "--explain",
+        choices=EXPLAIN_MODES,
+        default="none",
+        help="Captures each query's plan after its timed runs.  'plan' captures EXPLAIN only, 'analyze' also runs the "
+             "query to capture actual execution statistics (EXPLAIN ANALYZE on postgres, SVL_QUERY_SUMMARY on "
+             "redshift).  Plans are stored with the timings in --output.  Default is none"
+    )
+    parser.add_argument(
+        "--baseline",
+        action="store",
+        default=None,
+        help="json output of a previous run with --explain.  Plans are compared to their baseline and new sequential "
+             "scans, join strategy changes and row estimate blowups are reported"
+    )
+    parser.add_argument(
+        "--misestimate_factor",
+        type=float,
+        default=DEFAULT_MISESTIMATE_FACTOR,
+        help="Ratio between actual and estimated rows above which a plan node is reported.  "
+             f"Default is {DEFAULT_MISESTIMATE_FACTOR}"
+    )
+    parser.add_argument(
+        "--load_test",
+        action="store_true",
+        help="If set, runs a concurrent load test (a weighted random mix of queries from --concurrency connections "
+             "for --duration seconds) instead of timing each query in turn"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"Number of concurrent connections used by --load_test.  Default is {DEFAULT_CONCURRENCY}"
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=DEFAULT_DURATION,
+        help=f"Seconds to generate load for in --load_test.  Default is {DEFAULT_DURATION}"
+    )
+    parser.add_argument(
+        "--weight",
+        action="append",
+        default=None,
+        help="Relative weight of a query in --load_test, as 'query name=weight' (eg: "
+             "'OLAP: monthly sales by store=5').  Can be given multiple times.  If any are given, unlisted queries "
+             "are not run.  Default is equal weights for all queries"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Random seed for the --load_test query mix"
+    )
+    parser.add_argument(
+        "--result_cache",
+        action="store",
+        default=None,
+        help="If set, reads every query result through a result cache in this directory, so repeated queries are "
+             "answered from disk until the ETL reloads a table they read.  --fetch is ignored.  Default is no cache"
+    )
+    parser.add_argument(
+        "--result_cache_max_size_gb",
+        type=float,
+        default=DEFAULT_RESULT_CACHE_MAX_SIZE_GB,
+        help="Maximum size of the --result_cache in GB.  Least recently used results are evicted beyond this.  "
+             f"Default is {DEFAULT_RESULT_CACHE_MAX_SIZE_GB}"
+    )
+    parser.add_argument(
+        "--output",
+        action="store",
+        default=None,
+        help="If set, writes results to OUTPUT.json and OUTPUT.csv, tagged with the database and git revision"
+    )
     parser.add_argument(*logging_argparse_args, **logging_argparse_kwargs)
+    add_tracing_arguments(parser)
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    # Plans are only captured by the sequential benchmark
+    if args.load_test and (args.explain != "none" or args.baseline):
+        parser.error("--explain and --baseline cannot be used with --load_test")
+    return args
 
 
 if __name__ == "__main__":
@@ -69,14 +505,50 @@ if __name__ == "__main__":
     if args.set_logging_level:
         logger.setLevel(str(args.set_logging_level).upper())
 
+    start_tracing(Timer(name="analytics_timing_test", exit_message="--> analytics timing test complete",
+                        print_function=logger.info),
+                  trace_output=args.trace_output, metrics_output=args.metrics_output, trace_memory=args.trace_memory)
+
     secrets, data_cfg = load_settings()
 
-    engine = psycopg2.connect(
-        database=secrets[args.db]["database"],
-        user=secrets[args.db]["user"],
-        password=secrets[args.db]["password"],
-        host=secrets[args.db]["host"],
-        port=secrets[args.db]["port"],
+    metadata = dict(
+        db=args.db,
+        git_revision=get_git_revision(),
+        timestamp=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        fetch=args.fetch,
+        result_cache=args.result_cache is not None,
     )
 
-    run_analytical_queries(engine, args.n)
+    result_cache = None
+    if args.result_cache:
+        result_cache = ResultCache(cache_dir=args.result_cache, max_size_gb=args.result_cache_max_size_gb)
+
+    if args.load_test:
+        metadata.update(mode="load_test", concurrency=args.concurrency, duration=args.duration)
+        results = run_load_test(
+            connect=lambda: psycopg2.connect(**get_connection_kwargs(secrets, args.db)),
+            concurrency=args.concurrency,
+            duration=args.duration,
+            weights=parse_weights(args.weight, analytical_queries),
+            fetch=args.fetch,
+            fetch_size=args.fetch_size,
+            seed=args.seed,
+            result_cache=result_cache,
+        )
+    else:
+        metadata.update(mode="sequential", runs=args.n, warmup=args.warmup, explain=args.explain)
+        baseline = None
+        if args.baseline:
+            with open(args.baseline, "r") as stream:
+                baseline = json.load(stream)["results"]
+        engine = psycopg2.connect(**get_connection_kwargs(secrets, args.db))
+        results = run_analytical_queries(engine, args.n, warmup=args.warmup, fetch=args.fetch,
+                                         fetch_size=args.fetch_size, explain=args.explain, db_type=args.db,
+                                         baseline=baseline, misestimate_factor=args.misestimate_factor,
+                                         result_cache=result_cache)
+
+    if result_cache is not None:
+        logger.info(f"Result cache: {result_cache.hits} hits, {result_cache.misses} misses")
+
+    if args.output:
+        write_results(results, args.output, metadata)
@@ -0,0 +1,161 @@
+import os
+import tempfile
+import threading
+import time
+
+import pyarrow as pa
+
+CACHE_COMPRESSION = "zstd"
+CACHE_SUFFIX = ".arrow"
+
+
+class ArrowDiskCache:
+    def __init__(self, cache_dir, ttl_days=None, max_size_gb=None):
+        """
+        On-disk cache of arrow tables, addressed by a caller supplied key (typically a hash of whatever produced the
+        table).
+
+        Each entry is stored as a zstd compressed Arrow IPC file.  Entries older than ttl_days are treated as missing,
+        and the least recently used entries are evicted whenever the cache grows beyond max_size_gb.  Safe to use from
+        multiple threads and processes, though entries written by other processes only count towards max_size_gb once
+        this process next walks the cache (see evict).
+
+        Args:
+            cache_dir (str): Directory of the cache
+            ttl_days (float): Age in days after which an entry is treated as missing.  If None, entries never expire
+            max_size_gb (float): Maximum total size of the cache in GB.  If None, the cache is never evicted
+        """
+        self.cache_dir = cache_dir
+        self.ttl_seconds = None if ttl_days is None else ttl_days * 24 * 3600
+        self.max_size_bytes = None if max_size_gb is None else int(max_size_gb * 1024 ** 3)
+
+        self.hits = 0
+        self.misses = 0
+        # Running total of entry sizes, or None until the cache directory is first walked
+        self._size_bytes = None
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + CACHE_SUFFIX)
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _add_size(self, size):
+        with self._lock:
+            if self._size_bytes is not None:
+                self._size_bytes += size
+
+    def read(self, key):
+        """
+        Returns the table cached under key, or None if it is not cached, has expired or is corrupt (eg: truncated).
+        Corrupt entries are removed
+
+        Args:
+            key (str): Key of the entry
+
+        Returns:
+            (pa.Table)
+        """
+        path = self._path(key)
+        try:
+            if self.ttl_seconds is not None and time.time() - os.path.getmtime(path) > self.ttl_seconds:
+                return None
+            with pa.memory_map(path, "r") as source:
+                table = pa.ipc.open_file(source).read_all()
+            # Track recency of use for eviction without changing the entry's age for the ttl
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+        except FileNotFoundError:
+            return None
+        except (OSError, pa.ArrowInvalid):
+            # Arrow reports unreadable files as either, depending on where reading fails
+            try:
+                self.remove(key)
+            except OSError:
+                pass
+            return None
+        return table
+
+    def write(self, key, table):
+        """
+        Writes a table to the cache under key, then evicts entries if the cache is too large
+
+        Args:
+            key (str): Key of the entry
+            table (pa.Table): Table to cache.  Any schema metadata is stored with it
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            old_size = os.path.getsize(path)
+        except FileNotFoundError:
+            old_size = 0
+        # Write to a temporary file then rename so concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as sink:
+                options = pa.ipc.IpcWriteOptions(compression=CACHE_COMPRESSION)
+                with pa.ipc.new_file(sink, table.schema, options=options) as writer:
+                    writer.write_table(table)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        self._add_size(size - old_size)
+        self.evict()
+
+    def remove(self, key):
+        """
+        Removes the entry cached under key, if any
+        """
+        path = self._path(key)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        self._add_size(-size)
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is no larger than max_size_gb
+
+        The cache directory is only walked on the first call and whenever the running total of entry sizes kept by
+        write and remove exceeds max_size_gb, so most writes do not stat every entry
+        """
+        if self.max_size_bytes is None:
+            return
+
+        with self._lock:
+            if self._size_bytes is not None and self._size_bytes <= self.max_size_bytes:
+                return
+
+            entries = []
+            for dirpath, _, filenames in os.walk(self.cache_dir):
+                for filename in filenames:
+                    if not filename.endswith(CACHE_SUFFIX):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_atime, stat.st_size, path))
+
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total_size <= self.max_size_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+            self._size_bytes = total_size
@@ -1,15 +1,22 @@
 import argparse
+import datetime
 
 import psycopg2.errors
 
 from sql_queries import create_staging_table_queries, create_table_queries, drop_olap_table_queries, \
-    create_olap_table_queries, redshift_diststyle
-from sql_queries import drop_staging_table_queries, drop_table_queries
+    create_olap_table_queries, redshift_diststyle, create_etl_state_table_queries, redshift_sortkey, \
+    create_index_queries_postgres, postgres_indexes, partitioned_tables_postgres, \
+    create_partitioned_table_queries_postgres, create_partition_postgres
+from sql_queries import drop_staging_table_queries, drop_table_queries, drop_etl_state_table_queries
+from etl_olap import get_months, next_month_start
+from tracing import add_tracing_arguments, start_tracing
 from utilities import load_settings, Timer, logging_argparse_kwargs, \
     logging_argparse_args, get_logger
 
 logger = get_logger(name=__file__)
 
+PARTITION_BY_CHOICES = ["year", "month"]
+
 
 def drop_tables(engine):
     """
@@ -31,31 +38,117 @@ def drop_tables(engine):
         logger.info(f"\tDropping {name}")
         _execute_query(cur, q)
 
+    # Dropping data invalidates the record of which files have been loaded
+    for name, q in drop_etl_state_table_queries.items():
+        logger.info(f"\tDropping {name}")
+        _execute_query(cur, q)
+
     engine.commit()
 
 
-def create_tables(engine, apply_redshift_diststyle):
+def create_tables(engine, apply_redshift_diststyle, apply_redshift_sortkey=False, indexes=False, partition_by=None):
     """
     Creates all production and staging tables in database
     
     Args:
         engine: psycopg2 engine connected to postgres database
         apply_redshift_diststyle (bool): If True, adds distribution styles to all create statements
+        apply_redshift_sortkey (bool): If True, adds sort keys to all create statements that define one
+        indexes (bool): If True, creates secondary indexes (postgres only).  Loading is faster if indexes are instead
+                        created after the bulk load with create_indexes
+        partition_by (str): If "year" or "month", creates the tables in partitioned_tables_postgres as postgres range
+                            partitioned tables on date.  Partitions are added as data is loaded by create_partitions
     """
     cur = engine.cursor()
     for query_collection in [create_staging_table_queries.items(),
                              create_table_queries.items(),
-                             create_olap_table_queries.items()]:
+                             create_olap_table_queries.items(),
+                             create_etl_state_table_queries.items()]:
 
         for name, q in query_collection:
             logger.info(f"\tCreating {name}")
+            if partition_by and name in create_partitioned_table_queries_postgres:
+                q = create_partitioned_table_queries_postgres[name]
             if apply_redshift_diststyle:
                 # Add a redshift diststyle if one is defined for this table
                 q = q + redshift_diststyle.get(name, "")
+            if apply_redshift_sortkey:
+                # Add a redshift sortkey if one is defined for this table
+                q = q + redshift_sortkey.get(name, "")
             _execute_query(cur, q)
 
     engine.commit()
 
+    if indexes:
+        create_indexes(engine)
+
+
+def create_indexes(engine, table_names=None):
+    """
+    Creates secondary indexes (postgres only), skipping any that already exist
+
+    Building an index once after a bulk load is much faster than maintaining it during the load
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        table_names (list): (optional) Only create the indexes of these tables.  Default is all tables
+    """
+    cur = engine.cursor()
+    for table_name, indexes in postgres_indexes.items():
+        if table_names is not None and table_name not in table_names:
+            continue
+        for name in indexes:
+            logger.info(f"\tCreating index {name}")
+            _execute_query(cur, create_index_queries_postgres[name])
+
+    engine.commit()
+
+
+def get_partition_bounds(date_start, date_end, partition_by):
+    """
+    Returns the bounds of every partition needed to hold dates in [date_start, date_end]
+
+    Args:
+        date_start (datetime.date): First date (inclusive)
+        date_end (datetime.date): Last date (inclusive)
+        partition_by (str): year or month
+
+    Returns:
+        (list): List of (suffix, partition_start, partition_end) tuples, where partitions cover
+                [partition_start, partition_end) and suffix is a name for the partition (eg: 2015 or 2015_01)
+    """
+    bounds = []
+    if partition_by == "year":
+        for year in range(date_start.year, date_end.year + 1):
+            bounds.append((f"{year}", datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1)))
+    elif partition_by == "month":
+        for this_month in get_months(date_start, date_end):
+            bounds.append((f"{this_month:%Y_%m}", this_month, next_month_start(this_month)))
+    else:
+        raise ValueError(f"Unknown partition_by {partition_by}")
+    return bounds
+
+
+def create_partitions(engine, date_start, date_end, partition_by):
+    """
+    Creates any missing partitions of the partitioned tables needed to hold dates in [date_start, date_end]
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        date_start (datetime.date): First date (inclusive)
+        date_end (datetime.date): Last date (inclusive)
+        partition_by (str): year or month.  Must match the partition_by used by create_tables
+    """
+    cur = engine.cursor()
+    for suffix, partition_start, partition_end in get_partition_bounds(date_start, date_end, partition_by):
+        for table_name in partitioned_tables_postgres:
+            partition_name = f"{table_name}_{suffix}"
+            logger.debug(f"\tCreating partition {partition_name}")
+            _execute_query(cur, create_partition_postgres.format(partition_name=partition_name, table_name=table_name,
+                                                                 date_start=partition_start, date_end=partition_end))
+
+    engine.commit()
+
 
 def _execute_query(cur, q):
     """
@@ -73,7 +166,14 @@ def parse_arguments():
         default="postgres",
         help="Name of db credentials in secrets.yaml.  Use this to point at different dbs (postgres, redshift, ...)"
     )
+    parser.add_argument(
+        '--defer_indexes',
+        action="store_true",
+        help="If set, does not create secondary indexes.  Use etl.py --create_indexes to build them after the bulk "
+             "load, which is much faster than maintaining them during the load.  Indexes are only created on postgres"
+    )
     parser.add_argument(*logging_argparse_args, **logging_argparse_kwargs)
+    add_tracing_arguments(parser)
 
     return parser.parse_args()
 
@@ -87,10 +187,17 @@ if __name__ == "__main__":
     if args.set_logging_level:
         logger.setLevel(str(args.set_logging_level).upper())
 
+    start_tracing(Timer(name="create_tables", exit_message="--> create_tables complete", print_function=logger.info),
+                  trace_output=args.trace_output, metrics_output=args.metrics_output, trace_memory=args.trace_memory)
+
     # Get DB/login information
     secrets, _ = load_settings()
 
     apply_redshift_diststyle = secrets[args.db].get("apply_redshift_diststyle", False)
+    apply_redshift_sortkey = secrets[args.db].get("apply_redshift_sortkey", False)
+    partition_by = secrets[args.db].get("partition_by", None)
+    if partition_by not in PARTITION_BY_CHOICES + [None]:
+        raise ValueError(f"Unknown partition_by {partition_by} for {args.db}.  Must be one of {PARTITION_BY_CHOICES}")
 
     logger.info(f"Connecting to DB {args.db}")
     engine = psycopg2.connect(
@@ -117,4 +224,5 @@ if __name__ == "__main__":
 
     with Timer(enter_message="Creating new tables", exit_message="--> table creation complete",
                print_function=logger.info):
-        create_tables(engine, apply_redshift_diststyle)
+        create_tables(engine, apply_redshift_diststyle, apply_redshift_sortkey,
+                      indexes=args.db == "postgres" and not args.defer_indexes, partition_by=partition_by)
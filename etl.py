@@ -1,18 +1,57 @@
+import datetime
+import io
+import csv
+import json
 import psycopg2
+import psycopg2.extras
+import psycopg2.pool
 import argparse
-from uszipcode import SearchEngine
-import awswrangler as wr
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
-from sql_queries import insert_table_queries_postgres, get_station_latitude_longitude, insert_station_zipcode, \
-    load_staging_queries_postgres, load_staging_queries_redshift
-from utilities import test_table_has_rows, test_table_has_no_rows, lat_long_to_zip, load_settings, Timer, \
-    logging_argparse_kwargs, logging_argparse_args, get_logger
+from sql_queries import insert_table_queries_by_dedup, get_station_latitude_longitude, create_temp_station_zipcode, \
+    copy_temp_station_zipcode_postgres, insert_temp_station_zipcode, update_station_zipcode, \
+    drop_temp_station_zipcode, \
+    load_staging_queries_postgres, load_staging_queries_redshift, load_staging_manifest_queries_redshift, \
+    select_last_copy_rows_by_file, merge_table_queries_postgres_by_dedup, merge_table_queries_redshift_by_dedup, \
+    merge_table_queries_postgres_partitioned_by_dedup, \
+    dedup_setup_queries, dedup_cleanup_queries, table_dependencies, copy_staging_stdin_queries_postgres, \
+    create_etl_state_table_queries, select_loaded_files, insert_loaded_file, truncate, select_staged_sales_date_range, \
+    select_staged_weather_date_range, invoices, weather, \
+    weather_stations, store_weather_station, select_store_zipcodes, select_station_coverage, \
+    delete_store_weather_station, copy_store_weather_station_postgres, insert_store_weather_station, \
+    select_store_weather_station, select_store_invoice_date_range, \
+    table_import_rows_pattern, select_last_copy_count_redshift, create_olap_table_queries, \
+    indexes_before_olap_postgres
+from etl_olap import refresh_olap_tables_for_date_range, get_date_range
+from create_tables import create_indexes, create_partitions
+from storage import get_storage, join_key
+from validation import DataValidator, parse_null_rate_overrides
+from tracing import add_tracing_arguments, start_tracing, with_current_span
+from utilities import test_table_has_rows, test_table_has_no_rows, ZipcodeResolver, load_settings, Timer, \
+    logging_argparse_kwargs, logging_argparse_args, get_logger, get_connection_kwargs, record_table_versions, \
+    nearest_covered_stations
 
 logger = get_logger(name=__file__)
 
 DEFAULT_SALES_DATA_SPEC = "sales_raw"
 DEFAULT_WEATHER_DATA_SPEC = "weather_raw"
 DEFAULT_POPULATION_DATA_SPEC = "population_raw"
+DEFAULT_STAGING_WORKERS = 1
+DEFAULT_INSERT_WORKERS = 1
+DEFAULT_COPY_MODE = "per_file"
+DEFAULT_MANIFEST_KEY_BASE = "staging-manifests"
+DEFAULT_STAGING_METHOD_POSTGRES = "aws_s3"
+STAGING_METHODS_POSTGRES = ["aws_s3", "copy_stdin"]
+DEFAULT_COPY_BUFFER_SIZE = 8 * 1024 * 1024
+DEFAULT_ZIPCODE_CACHE = "zipcode_cache.json"
+DEFAULT_ZIPCODE_BATCH_SIZE = 10000
+DEFAULT_STATION_RADIUS = 50.0
+DEFAULT_MIN_STATION_COVERAGE = 0.5
+DEFAULT_DEDUP = "latest_by_key"
+DEFAULT_VALIDATION = "counts"
+VALIDATION_MODES = ["none", "counts", "full"]
+DEDUP_STRATEGIES = list(insert_table_queries_by_dedup)
 
 
 def _execute_query(cur, query):
@@ -33,6 +72,9 @@ def load_check_table(engine, table_name, query, check_before=True, check_after=T
         query (str): Query that will load destination table
         check_before (bool): If true, checks if a table is empty before load
         check_after (bool): If true, checks if a table has data after load
+
+    Returns:
+        (int): Number of rows the query reported loading
     """
     # Test destination table is empty
     if check_before:
@@ -41,12 +83,14 @@ def load_check_table(engine, table_name, query, check_before=True, check_after=T
     cur = engine.cursor()
     # Insert into table
     _execute_query(cur, query)
+    n_rows = cur.rowcount
 
     # Check for data in destination table
     if check_after:
         test_table_has_rows(engine, table_name)
 
     engine.commit()
+    return n_rows
 
 
 def get_load_query(table_name, data_cfg, file_to_stage, secrets, db_type="postgres"):
@@ -89,7 +133,152 @@ def get_load_query(table_name, data_cfg, file_to_stage, secrets, db_type="postgr
     return q.format(**q_settings)
 
 
-def load_check_staging_tables(engine, data_sources, data_cfg, secrets, db_type="postgres", sales_raw_data_type="csv", ):
+def get_staging_method(data_cfg, db_type="postgres"):
+    """
+    Returns how files of a data spec are staged, from staging_method_postgres in the data spec
+
+    Postgres supports aws_s3 (server-side import from S3 using the aws_s3 extension) and copy_stdin (files read
+    client-side from S3, an S3-compatible store, or local_dir, and streamed with COPY FROM STDIN).  Redshift always
+    stages with COPY from S3
+
+    Args:
+        data_cfg (dict): Data spec dictionary
+        db_type (str): postgres or redshift
+
+    Returns:
+        (str): Staging method
+    """
+    if db_type == "redshift":
+        if "local_dir" in data_cfg:
+            raise ValueError("Redshift can only stage from S3, but data spec specifies local_dir")
+        return "copy"
+
+    method = data_cfg.get("staging_method_postgres", DEFAULT_STAGING_METHOD_POSTGRES)
+    if method not in STAGING_METHODS_POSTGRES:
+        raise ValueError(f"Unknown staging_method_postgres {method}.  Must be one of {STAGING_METHODS_POSTGRES}")
+    if method == "aws_s3" and "local_dir" in data_cfg:
+        raise ValueError("staging_method_postgres aws_s3 cannot stage from local_dir.  Use copy_stdin")
+    return method
+
+
+def list_files_to_stage(storage, data_cfg, partitions=None):
+    """
+    Lists the files of a data spec
+
+    Args:
+        storage (Storage): Storage holding the files of the data spec
+        data_cfg (dict): Data spec dictionary.  Files are listed from key_base, or the root of the storage if the
+                         data spec has no key_base
+        partitions (list): (optional) Hive-style partitions relative to key_base (eg:
+                           ['year=2018/month=3', 'year=2018/month=4']).  If provided, only files within these
+                           partitions are listed
+
+    Returns:
+        (tuple): (path searched, list of file urls)
+    """
+    key_base = data_cfg.get("key_base", "")
+    path = storage.url(key_base)
+    if partitions:
+        files = []
+        for partition in partitions:
+            # Trailing slash so month=1 does not also match month=10, 11, 12
+            files.extend(storage.list(join_key(key_base, partition) + "/"))
+        path = f"{path}/{{{','.join(partitions)}}}"
+    else:
+        files = storage.list(key_base)
+
+    return path, files
+
+
+def copy_file_from_stdin(engine, table_name, data_cfg, file_to_stage, storage):
+    """
+    Stages a file into a postgres table by reading it client-side and streaming it with COPY FROM STDIN
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        table_name (str): Name of the destination table
+        data_cfg (dict): Data spec dictionary
+        file_to_stage (str): Url of the file to stage
+        storage (Storage): Storage holding the file
+
+    Returns:
+        (int): Number of rows staged
+    """
+    q = copy_staging_stdin_queries_postgres[table_name].format(source_format=data_cfg["source_format_postgres"])
+    buffer_size = data_cfg.get("copy_buffer_size", DEFAULT_COPY_BUFFER_SIZE)
+
+    cur = engine.cursor()
+    logger.debug(f"query = {q}")
+    f = storage.open(file_to_stage)
+    try:
+        cur.copy_expert(q, f, size=buffer_size)
+    finally:
+        f.close()
+    engine.commit()
+    return cur.rowcount
+
+
+def stage_file(engine, table_name, data_cfg, file_to_stage, secrets, db_type="postgres", storage=None):
+    """
+    Stages a single file into a staging table using the staging method of the data spec
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        table_name (str): Name of the destination table
+        data_cfg (dict): Data spec dictionary
+        file_to_stage (str): Url of the file to stage
+        secrets (dict): Dictionary of db/aws secrets
+        db_type (str): postgres or redshift
+        storage (Storage): (optional) Storage holding the file, used when the file is read client-side.  If None, one
+                           is created from data_cfg
+
+    Returns:
+        (int): Number of rows staged, as reported by the load, or None if it could not be determined
+    """
+    if get_staging_method(data_cfg, db_type) == "copy_stdin":
+        storage = storage or get_storage(data_cfg, secrets)
+        return copy_file_from_stdin(engine, table_name, data_cfg, file_to_stage, storage)
+
+    q = get_load_query(table_name, data_cfg, file_to_stage, secrets, db_type)
+    cur = engine.cursor()
+    _execute_query(cur, q)
+    n_rows = get_loaded_rows(cur, db_type)
+    engine.commit()
+    return n_rows
+
+
+def get_loaded_rows(cur, db_type="postgres"):
+    """
+    Returns the number of rows loaded by the staging query just executed on cur, without counting the table
+
+    Args:
+        cur: psycopg2 cursor that executed the staging query
+        db_type (str): postgres (aws_s3.table_import_from_s3) or redshift (COPY)
+
+    Returns:
+        (int): Number of rows loaded, or None if it could not be determined
+    """
+    if db_type == "postgres":
+        # table_import_from_s3 returns a message such as "1000 rows imported into relation ..."
+        match = table_import_rows_pattern.search(str(cur.fetchone()[0]))
+        return int(match.group(1)) if match else None
+    elif db_type == "redshift":
+        _execute_query(cur, select_last_copy_count_redshift)
+        return cur.fetchone()[0]
+    else:
+        raise ValueError(f"Unknown db_type {db_type}")
+
+
+def _sum_rows(counts):
+    """
+    Returns the sum of row counts, or None if any count is unknown
+    """
+    counts = list(counts)
+    return None if any(c is None for c in counts) else sum(counts)
+
+
+def load_check_staging_tables(engine, data_sources, data_cfg, secrets, db_type="postgres", sales_raw_data_type="csv",
+                              sales_partitions=None, **load_kwargs):
     """
     Loads and performs validity checks on all staging tables from S3 source
     
@@ -100,32 +289,51 @@ def load_check_staging_tables(engine, data_sources, data_cfg, secrets, db_type="
         data_sources (dict): Map of {'data_source_name': data_spec}
         secrets (dict): Dictionary of db/aws secrets
         db_type (str): postgres or redshift
-        sales_raw_data_type (str): file type of raw sales data.  csv or parquet
+        sales_raw_data_type (str): file type of raw sales data.  csv, parquet, or parquet_partitioned
+        sales_partitions (list): (optional) Partitions of a partitioned sales dataset to stage (eg:
+                                 ['year=2018/month=3']).  If None, all sales files are staged
+        load_kwargs: Additional keyword arguments passed to load_check_from_s3_prefix (pool, n_workers, copy_mode, ...)
+
+    Returns:
+        (tuple): (map of {table_name: [files staged]}, map of {table_name: rows staged or None if unknown})
     """
     logger.info("Loading and checking staging tables")
+    staged_files = {}
+    staged_rows = {}
 
     # Stage sales
     table_name = "staging_sales"
 
     # Find staging files
     with Timer(enter_message=f"\tLoading table {table_name}", exit_message=f"\t--> load {table_name} complete",
-               print_function=logger.info):
+               print_function=logger.info, attributes=dict(table=table_name)) as span:
         this_data_cfg = data_cfg[data_sources["sales"]][sales_raw_data_type]
-        load_check_from_s3_prefix(this_data_cfg, db_type, engine, secrets, table_name)
+        staged_files[table_name], staged_rows[table_name] = load_check_from_s3_prefix(
+            this_data_cfg, db_type, engine, secrets, table_name, partitions=sales_partitions, **load_kwargs
+        )
+        span.set_attributes(rows=staged_rows[table_name], files=len(staged_files[table_name]))
 
     # Stage weather/population
     for case_name in ["weather", "population"]:
         table_name = f"staging_{case_name}"
         # Load data from all raw files
         with Timer(enter_message=f"\tLoading table {table_name}", exit_message=f"\t--> load {table_name} complete",
-                   print_function=logger.info):
+                   print_function=logger.info, attributes=dict(table=table_name)) as span:
             this_data_cfg = data_cfg[data_sources[case_name]]
-            load_check_from_s3_prefix(this_data_cfg, db_type, engine, secrets, table_name)
+            staged_files[table_name], staged_rows[table_name] = load_check_from_s3_prefix(
+                this_data_cfg, db_type, engine, secrets, table_name, **load_kwargs
+            )
+            span.set_attributes(rows=staged_rows[table_name], files=len(staged_files[table_name]))
+
+    return staged_files, staged_rows
 
 
-def load_check_from_s3_prefix(data_cfg, db_type, engine, secrets, table_name):
+def load_check_from_s3_prefix(data_cfg, db_type, engine, secrets, table_name, pool=None,
+                              n_workers=DEFAULT_STAGING_WORKERS, copy_mode=DEFAULT_COPY_MODE, incremental=False,
+                              partitions=None, cache_dir=None):
     """
-    Checks if a staging table is empty then loads data from one or more files specified by an S3 location
+    Checks if a staging table is empty then loads data from one or more files specified by an S3 location or local
+    directory
 
     Args:
         data_cfg (dict): Data spec dictionary
@@ -133,24 +341,232 @@ def load_check_from_s3_prefix(data_cfg, db_type, engine, secrets, table_name):
         engine: psycopg2 engine connected to postgres database
         secrets (dict): Dictionary of db/aws secrets
         table_name (str): Name of the destination table
+        pool: (optional) psycopg2 connection pool.  If provided and n_workers > 1, files are staged concurrently with
+              each worker using its own connection from the pool
+        n_workers (int): Number of files staged concurrently when a pool is provided
+        copy_mode (str): Redshift only.  'per_file' issues one COPY per file, 'manifest' issues a single COPY of all
+                         files using a manifest so Redshift can parallelize the load across slices
+        incremental (bool): If True, files already recorded as loaded into table_name are skipped.  A prefix with no
+                            new files is not an error
+        partitions (list): (optional) Hive-style partitions relative to the data spec's key_base (eg:
+                           ['year=2018/month=3', 'year=2018/month=4']).  If provided, only files within these
+                           partitions are staged
+        cache_dir (str): (optional) Directory of a local read-through cache for files read client-side, so files
+                         are not downloaded again when the same data is reloaded
+
+    Returns:
+        (tuple): (list of files staged, number of rows staged as reported by the loads or None if unknown)
     """
     # Check the staging table is empty before loading
     test_table_has_no_rows(engine, table_name)
     # Glob all raw files and stage each separately
-    path = f"s3://{data_cfg['bucket']}/{data_cfg['key_base']}"
-    files_to_stage = wr.s3.list_objects(path=path)
+    storage = get_storage(data_cfg, secrets, cache_dir=cache_dir)
+    path, files_to_stage = list_files_to_stage(storage, data_cfg, partitions)
 
     if len(files_to_stage) == 0:
         raise ValueError(f"Found no files to load for {table_name} in {path}")
 
-    for file_to_stage in files_to_stage:
-        with Timer(enter_message=f"\t\tstaging file .../{file_to_stage.split('/')[-1]}", exit_message="\t\t--> ",
-                   print_function=logger.info):
-            q = get_load_query(table_name, data_cfg, file_to_stage, secrets, db_type)
-            load_check_table(engine, table_name, q, check_before=False)
+    if incremental:
+        loaded_files = get_loaded_files(engine, table_name)
+        files_to_stage = [f for f in files_to_stage if f not in loaded_files]
+        logger.info(f"\t\tfound {len(files_to_stage)} new files ({len(loaded_files)} previously loaded)")
+        if len(files_to_stage) == 0:
+            return files_to_stage, 0
+
+    if db_type == "redshift" and copy_mode == "manifest":
+        n_rows = load_redshift_manifest(engine, table_name, data_cfg, files_to_stage, secrets, storage)
+    elif pool is None or n_workers <= 1:
+        file_rows = []
+        for file_to_stage in files_to_stage:
+            with Timer(enter_message=f"\t\tstaging file .../{file_to_stage.split('/')[-1]}",
+                       exit_message="\t\t--> ", print_function=logger.info, name="stage file",
+                       attributes=dict(file=file_to_stage, table=table_name)) as span:
+                file_rows.append(stage_file(engine, table_name, data_cfg, file_to_stage, secrets, db_type, storage))
+                span.set_attributes(rows=file_rows[-1])
+        n_rows = _sum_rows(file_rows)
+    else:
+        n_rows = load_files_concurrently(pool, n_workers, table_name, data_cfg, files_to_stage, secrets, db_type,
+                                         storage)
 
+    # Check the staging table has data after all files are loaded
+    test_table_has_rows(engine, table_name)
+    logger.info(f"\t\tstaged {n_rows} rows from {len(files_to_stage)} files")
 
-def insert_check_tables(engine):
+    return files_to_stage, n_rows
+
+
+def _load_file_from_pool(pool, table_name, data_cfg, file_to_stage, secrets, db_type, storage=None):
+    """
+    Stages a single file using a connection borrowed from pool, returning the connection when complete and the number
+    of rows staged
+
+    Connections are rolled back on error so they are returned to the pool in a usable state
+    """
+    engine = pool.getconn()
+    try:
+        with Timer(exit_message=f"\t\t--> staged file .../{file_to_stage.split('/')[-1]}",
+                   print_function=logger.info, name="stage file",
+                   attributes=dict(file=file_to_stage, table=table_name)) as span:
+            n_rows = stage_file(engine, table_name, data_cfg, file_to_stage, secrets, db_type, storage)
+            span.set_attributes(rows=n_rows)
+        return n_rows
+    except Exception:
+        engine.rollback()
+        raise
+    finally:
+        pool.putconn(engine)
+
+
+def load_files_concurrently(pool, n_workers, table_name, data_cfg, files_to_stage, secrets, db_type="postgres",
+                            storage=None):
+    """
+    Stages files into a table concurrently, each worker using its own connection from pool
+
+    All files are attempted even if some fail.  Any failures are logged per file and then raised together as a
+    single ValueError
+
+    Args:
+        pool: psycopg2 connection pool (eg: psycopg2.pool.ThreadedConnectionPool) with maxconn >= n_workers
+        n_workers (int): Number of files staged concurrently
+        table_name (str): Name of the destination table
+        data_cfg (dict): Data spec dictionary
+        files_to_stage (list): List of urls to stage
+        secrets (dict): Dictionary of db/aws secrets
+        db_type (str): postgres or redshift
+        storage (Storage): (optional) Storage holding the files, used when files are read client-side
+
+    Returns:
+        (int): Number of rows staged, or None if unknown for any file
+    """
+    logger.info(f"\t\tstaging {len(files_to_stage)} files using {n_workers} workers")
+    failures = {}
+    file_rows = []
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {
+            executor.submit(with_current_span(_load_file_from_pool), pool, table_name, data_cfg, file_to_stage,
+                            secrets, db_type, storage): file_to_stage
+            for file_to_stage in files_to_stage
+        }
+        for future in as_completed(futures):
+            file_to_stage = futures[future]
+            try:
+                file_rows.append(future.result())
+            except Exception as e:
+                logger.error(f"\t\tfailed to stage file {file_to_stage}: {e}")
+                failures[file_to_stage] = e
+
+    if failures:
+        raise ValueError(f"Failed to stage {len(failures)} of {len(files_to_stage)} files into {table_name}: "
+                         f"{sorted(failures)}")
+    return _sum_rows(file_rows)
+
+
+def build_copy_manifest(files_to_stage, storage):
+    """
+    Builds a Redshift COPY manifest for a list of S3 objects
+
+    Object sizes are included as content_length metadata, which Redshift requires for columnar (parquet) sources
+
+    Args:
+        files_to_stage (list): List of s3 urls
+        storage (Storage): Storage holding the files
+
+    Returns:
+        (dict): Manifest in the format expected by Redshift COPY ... MANIFEST
+    """
+    sizes = storage.sizes(files_to_stage)
+    return {
+        "entries": [
+            {"url": f, "mandatory": True, "meta": {"content_length": sizes[f]}}
+            for f in files_to_stage
+        ]
+    }
+
+
+def write_copy_manifest(manifest, data_cfg, table_name, storage):
+    """
+    Writes a COPY manifest to S3, returning the key it was written to
+
+    Manifests are written outside data_cfg's key_base so they are never listed as data to be staged
+
+    Args:
+        manifest (dict): Manifest from build_copy_manifest
+        data_cfg (dict): Data spec dictionary.  May include manifest_key_base to override the default location
+        table_name (str): Name of the destination table
+        storage (Storage): Storage the manifest is written to
+
+    Returns:
+        (str): Key (without bucket) of the manifest
+    """
+    manifest_key_base = data_cfg.get("manifest_key_base", DEFAULT_MANIFEST_KEY_BASE)
+    manifest_key = f"{manifest_key_base}/{table_name}.manifest"
+    storage.upload(io.BytesIO(json.dumps(manifest).encode()), manifest_key)
+    return manifest_key
+
+
+def load_redshift_manifest(engine, table_name, data_cfg, files_to_stage, secrets, storage):
+    """
+    Stages all files into a Redshift table using a single COPY from a manifest, logging rows loaded per file
+
+    Args:
+        engine: psycopg2 engine connected to redshift database
+        table_name (str): Name of the destination table
+        data_cfg (dict): Data spec dictionary
+        files_to_stage (list): List of s3 urls to stage
+        secrets (dict): Dictionary of db/aws secrets
+        storage (Storage): Storage holding the files
+
+    Returns:
+        (int): Number of rows staged
+    """
+    with Timer(enter_message=f"\t\tstaging {len(files_to_stage)} files using a single manifest COPY",
+               exit_message="\t\t--> ", print_function=logger.info, name="stage manifest",
+               attributes=dict(table=table_name, files=len(files_to_stage))) as span:
+        manifest_key = write_copy_manifest(build_copy_manifest(files_to_stage, storage), data_cfg, table_name, storage)
+        q = load_staging_manifest_queries_redshift[table_name].format(
+            source_format=data_cfg["source_format_redshift"],
+            bucket=data_cfg["bucket"],
+            manifest_key=manifest_key,
+            iam=secrets["redshift"]["arn"],
+        )
+        cur = engine.cursor()
+        _execute_query(cur, q)
+        n_rows = get_loaded_rows(cur, db_type="redshift")
+        span.set_attributes(rows=n_rows)
+        _execute_query(cur, select_last_copy_rows_by_file)
+        rows_by_file = cur.fetchall()
+        engine.commit()
+
+    for filename, file_rows in rows_by_file:
+        logger.info(f"\t\t\tstaged {file_rows} rows from .../{filename.split('/')[-1]}")
+    return n_rows
+
+
+def check_dedup(dedup, db_type):
+    """
+    Raises a ValueError if a dedup strategy is unknown or not supported by db_type
+    """
+    if dedup not in DEDUP_STRATEGIES:
+        raise ValueError(f"Unknown dedup strategy {dedup}.  Must be one of {DEDUP_STRATEGIES}")
+    if dedup == "distinct_on" and db_type != "postgres":
+        raise ValueError(f"dedup strategy {dedup} is only supported on postgres")
+
+
+def run_dedup_queries(engine, queries):
+    """
+    Runs the setup or cleanup queries of a dedup strategy, eg: building the staging_sales_dimensions temp table
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        queries (list): Queries to run, in order
+    """
+    cur = engine.cursor()
+    for q in queries:
+        _execute_query(cur, q)
+    engine.commit()
+
+
+def insert_check_tables(engine, dedup=DEFAULT_DEDUP, db_type="postgres", pool=None, n_workers=DEFAULT_INSERT_WORKERS):
     """
     Inserts staged data into production tables
     
@@ -158,13 +574,239 @@ def insert_check_tables(engine):
     
     Args:
         engine: psycopg2 engine connected to postgres database
+        dedup (str): Strategy used to deduplicate staged rows.  One of DEDUP_STRATEGIES
+        db_type (str): postgres or redshift
+        pool: (optional) psycopg2 connection pool (eg: psycopg2.pool.ThreadedConnectionPool) with
+              maxconn >= n_workers.  If specified with n_workers > 1, tables that do not depend on each other through
+              foreign keys are inserted concurrently
+        n_workers (int): Number of tables inserted concurrently
+
+    Returns:
+        (dict): Map of {table_name: rows inserted}
     """
     logger.info("Loading and checking production tables")
+    check_dedup(dedup, db_type)
+
+    with Timer(exit_message=f"\t--> {dedup} dedup setup complete", print_function=logger.debug):
+        run_dedup_queries(engine, dedup_setup_queries.get(dedup, []))
+
+    queries = insert_table_queries_by_dedup[dedup]
+    if pool is not None and n_workers > 1:
+        _, inserted_rows = insert_tables_concurrently(pool, n_workers, queries, table_dependencies)
+    else:
+        inserted_rows = {}
+        for table_name, q in queries.items():
+            with Timer(enter_message=f"\tInserting into table {table_name}",
+                       exit_message=f"\t--> insert into {table_name} complete", print_function=logger.debug,
+                       attributes=dict(table=table_name)) as span:
+                inserted_rows[table_name] = load_check_table(engine, table_name, q)
+                span.set_attributes(rows=inserted_rows[table_name])
+
+    run_dedup_queries(engine, dedup_cleanup_queries.get(dedup, []))
+    return inserted_rows
+
+
+def _insert_table_from_pool(pool, table_name, query, in_progress, lock):
+    """
+    Inserts into a single table using a connection borrowed from pool, returning the time taken in seconds and the
+    number of rows inserted
+
+    While running, the connection is registered in in_progress so the insert can be cancelled from another thread.
+    Connections are rolled back on error so they are returned to the pool in a usable state
+    """
+    engine = pool.getconn()
+    with lock:
+        in_progress[table_name] = engine
+    try:
+        timer = Timer(enter_message=f"\tInserting into table {table_name}",
+                      exit_message=f"\t--> insert into {table_name} complete", print_function=logger.info,
+                      attributes=dict(table=table_name))
+        with timer:
+            n_rows = load_check_table(engine, table_name, query)
+            timer.set_attributes(rows=n_rows)
+            elapsed = timer.elapsed()
+        return elapsed, n_rows
+    except Exception:
+        engine.rollback()
+        raise
+    finally:
+        with lock:
+            in_progress.pop(table_name)
+        pool.putconn(engine)
+
+
+def insert_tables_concurrently(pool, n_workers, queries, dependencies):
+    """
+    Inserts into tables concurrently, starting each table once every table it depends on has been loaded
+
+    On the first failure no further tables are started and any inserts in progress are cancelled.  Failures are then
+    raised together as a single ValueError
+
+    Args:
+        pool: psycopg2 connection pool (eg: psycopg2.pool.ThreadedConnectionPool) with maxconn >= n_workers
+        n_workers (int): Number of tables inserted concurrently
+        queries (dict): {table_name: insert query}
+        dependencies (dict): {table_name: set of table names that must be loaded first}.  Dependencies that are not
+                             in queries are ignored
+
+    Returns:
+        (tuple): ({table_name: seconds taken to insert}, {table_name: rows inserted})
+    """
+    logger.info(f"\tinserting {len(queries)} tables using {n_workers} workers")
+    pending = set(queries)
+    done = set()
+    timings = {}
+    inserted_rows = {}
+    failures = {}
+    in_progress = {}
+    lock = threading.Lock()
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {}
+
+        def submit_ready():
+            for table_name in [t for t in queries if t in pending]:
+                if (dependencies.get(table_name, set()) & set(queries)) <= done:
+                    pending.remove(table_name)
+                    futures[executor.submit(with_current_span(_insert_table_from_pool), pool, table_name,
+                                            queries[table_name], in_progress, lock)] = table_name
 
-    for table_name, q in insert_table_queries_postgres.items():
-        with Timer(enter_message=f"\tInserting into table {table_name}",
-                   exit_message=f"\t--> insert into {table_name} complete", print_function=logger.debug):
-            load_check_table(engine, table_name, q)
+        submit_ready()
+        while futures:
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                table_name = futures.pop(future)
+                try:
+                    timings[table_name], inserted_rows[table_name] = future.result()
+                    done.add(table_name)
+                except Exception as e:
+                    logger.error(f"\tfailed to insert into {table_name}: {e}")
+                    failures[table_name] = e
+
+            if failures:
+                # Fail fast: start nothing new and cancel anything still running
+                pending.clear()
+                with lock:
+                    for engine in in_progress.values():
+                        engine.cancel()
+            else:
+                submit_ready()
+
+    if failures:
+        raise ValueError(f"Failed to insert into {len(failures)} of {len(queries)} tables: {sorted(failures)}.  "
+                         f"Tables not attempted: {sorted(set(queries) - done - set(failures))}")
+
+    logger.info("\tInsert time per table: " + ", ".join(f"{t}={s:.1f}s" for t, s in timings.items()))
+    return timings, inserted_rows
+
+
+def get_loaded_files(engine, table_name):
+    """
+    Returns the set of files previously recorded as loaded into a staging table
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        table_name (str): Name of the staging table
+
+    Returns:
+        (set): Set of s3 urls
+    """
+    cur = engine.cursor()
+    cur.execute(select_loaded_files, (table_name,))
+    return {r[0] for r in cur.fetchall()}
+
+
+def record_loaded_files(engine, staged_files):
+    """
+    Records files as loaded in the ETL state table.  Does not commit, so this can share a transaction with the merge
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        staged_files (dict): Map of {table_name: [files staged]}
+    """
+    loaded_at = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    records = [(table_name, f, loaded_at) for table_name, files in staged_files.items() for f in files]
+    cur = engine.cursor()
+    cur.executemany(insert_loaded_file, records)
+
+
+def create_etl_state_tables(engine):
+    """
+    Creates the ETL state tables if they do not already exist
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+    """
+    cur = engine.cursor()
+    for q in create_etl_state_table_queries.values():
+        _execute_query(cur, q)
+    engine.commit()
+
+
+def merge_check_tables(engine, staged_files, db_type="postgres", dedup=DEFAULT_DEDUP, partition_by=None):
+    """
+    Merges staged data into existing production tables, records the staged files as loaded, and empties staging
+
+    Rows with an existing primary key are replaced by the newly staged row.  Stores, items and product categories are
+    only replaced by rows staged from sales on the same or a later date than they were last seen, so the most recent
+    name for a store, item, etc. wins even if an older month is staged again.  The merge and the record of loaded files
+    are committed together
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        staged_files (dict): Map of {table_name: [files staged]}
+        db_type (str): postgres or redshift
+        dedup (str): Strategy used to deduplicate staged rows.  One of DEDUP_STRATEGIES
+        partition_by (str): (optional) Partitioning of the postgres tables (see create_tables.create_tables).  If set,
+                            partitioned tables are merged on their partitioned primary keys, which include date
+
+    Returns:
+        (dict): Map of {table_name: rows inserted or updated}
+    """
+    logger.info("Merging staged data into production tables")
+    merge_query_map = {
+        'redshift': merge_table_queries_redshift_by_dedup,
+        'postgres': merge_table_queries_postgres_partitioned_by_dedup if partition_by
+        else merge_table_queries_postgres_by_dedup,
+    }
+    check_dedup(dedup, db_type)
+
+    with Timer(exit_message=f"\t--> {dedup} dedup setup complete", print_function=logger.debug):
+        run_dedup_queries(engine, dedup_setup_queries.get(dedup, []))
+
+    cur = engine.cursor()
+    merged_rows = {}
+    for table_name, q in merge_query_map[db_type][dedup].items():
+        with Timer(enter_message=f"\tMerging into table {table_name}",
+                   exit_message=f"\t--> merge into {table_name} complete", print_function=logger.info,
+                   attributes=dict(table=table_name)) as span:
+            _execute_query(cur, q)
+            merged_rows[table_name] = cur.rowcount
+            span.set_attributes(rows=merged_rows[table_name])
+        test_table_has_rows(engine, table_name)
+
+    record_loaded_files(engine, staged_files)
+    record_table_versions(engine, merge_query_map[db_type][dedup])
+    engine.commit()
+
+    run_dedup_queries(engine, dedup_cleanup_queries.get(dedup, []))
+
+    truncate_staging_tables(engine, staged_files)
+    return merged_rows
+
+
+def truncate_staging_tables(engine, table_names):
+    """
+    Empties staging tables once their data is in the production tables, so the next run can stage into them
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        table_names (list): Names of the staging tables
+    """
+    cur = engine.cursor()
+    for table_name in table_names:
+        _execute_query(cur, truncate.format(table_name=table_name))
+    engine.commit()
 
 
 def parse_arguments():
@@ -201,35 +843,302 @@ def parse_arguments():
         '--sales_raw_data_type',
         default="csv",
         help="File type to load sales data from.  "
-             "Can be 'csv' for postgres, or either of ('csv', 'parquet') for redshift"
+             "Can be 'csv' for postgres, or any of ('csv', 'parquet', 'parquet_partitioned') for redshift"
+    )
+    parser.add_argument(
+        '--sales_partitions',
+        action="store",
+        nargs="+",
+        default=None,
+        help="Partitions of a partitioned sales dataset to stage, relative to the data spec's key_base (eg: "
+             "'year=2018/month=3' 'year=2018/month=4').  If unset, all sales files are staged"
+    )
+    parser.add_argument(
+        '--staging_workers',
+        action="store",
+        type=int,
+        default=DEFAULT_STAGING_WORKERS,
+        help="Number of files staged concurrently, each using its own database connection.  "
+             f"Default is {DEFAULT_STAGING_WORKERS} (stage files sequentially)"
+    )
+    parser.add_argument(
+        '--copy_mode',
+        action="store",
+        choices=["per_file", "manifest"],
+        default=DEFAULT_COPY_MODE,
+        help="Redshift only.  'per_file' issues one COPY per staged file, 'manifest' loads all files for a table "
+             f"using a single COPY from a generated manifest.  Default is {DEFAULT_COPY_MODE}"
+    )
+    parser.add_argument(
+        '--incremental',
+        action="store_true",
+        help="If set, stages only files not previously loaded and merges them into existing production tables "
+             "rather than requiring empty tables.  Staging tables are emptied after the merge"
+    )
+    parser.add_argument(
+        '--validation',
+        action="store",
+        default=DEFAULT_VALIDATION,
+        choices=VALIDATION_MODES,
+        help="Validation run after loading.  counts reconciles rows staged (as reported by each COPY or import) "
+             "against rows inserted into each production table.  full also checks staging tables have the rows "
+             "reported, and checks every loaded table for duplicate keys and null rates using one aggregate scan per "
+             "table (see sql_queries.validation_rules).  Tables with dates (invoices, weather and the OLAP tables) "
+             "are only checked over the dates staged by this load.  Use validation.py to check whole tables.  The ETL "
+             f"fails after loading if any check fails.  Default is {DEFAULT_VALIDATION}"
+    )
+    parser.add_argument(
+        '--max_null_rate',
+        action="append",
+        default=None,
+        help="Overrides the maximum null rate of a column checked by --validation full, as 'table.column=rate' (eg: "
+             "'stores.zipcode=0.05'), or 'table.column=none' to only report it.  Can be given multiple times"
+    )
+    parser.add_argument(
+        '--validation_output',
+        action="store",
+        default=None,
+        help="If set, writes the validation summary to this json file"
+    )
+    parser.add_argument(
+        '--skip_olap',
+        action="store_true",
+        help="If set, does not refresh the OLAP fact tables after loading.  Otherwise all months are built after a "
+             "full load, and only the months with newly staged sales are rebuilt after an incremental load"
+    )
+    parser.add_argument(
+        '--cache_dir',
+        action="store",
+        default=None,
+        help="Directory of a local read-through cache for files read client-side (staging_method_postgres "
+             "copy_stdin), so reloading the same data does not download it again.  Default is no cache"
+    )
+    parser.add_argument(
+        '--insert_workers',
+        action="store",
+        type=int,
+        default=DEFAULT_INSERT_WORKERS,
+        help="Number of production tables inserted concurrently, each on its own connection.  Tables are started once "
+             "all tables they reference by foreign key are loaded.  Only applies to full (non-incremental) loads.  "
+             f"Default is {DEFAULT_INSERT_WORKERS}"
+    )
+    parser.add_argument(
+        '--dedup',
+        action="store",
+        default=DEFAULT_DEDUP,
+        choices=DEDUP_STRATEGIES,
+        help="Strategy used to deduplicate staged rows into production tables.  row_number uses a window function "
+             "over staging for every table, distinct_on (postgres only) uses DISTINCT ON, and latest_by_key "
+             "reduces staged sales to their distinct store/item/category attributes in one pass before "
+             f"deduplicating those dimensions.  Default is {DEFAULT_DEDUP}"
+    )
+    parser.add_argument(
+        '--create_indexes',
+        action="store_true",
+        help="If set, creates any missing secondary indexes after loading (postgres only).  Use with "
+             "create_tables.py --defer_indexes so indexes are built once rather than maintained during the load"
+    )
+    parser.add_argument(
+        '--zipcode_cache',
+        action="store",
+        default=DEFAULT_ZIPCODE_CACHE,
+        help="File used to cache zip codes resolved from weather station coordinates between runs.  "
+             f"Default is {DEFAULT_ZIPCODE_CACHE}"
+    )
+    parser.add_argument(
+        '--zipcode_batch_size',
+        action="store",
+        type=int,
+        default=DEFAULT_ZIPCODE_BATCH_SIZE,
+        help="Maximum number of weather station zip codes sent to the database at once.  "
+             f"Default is {DEFAULT_ZIPCODE_BATCH_SIZE}"
+    )
+    parser.add_argument(
+        '--station_radius',
+        action="store",
+        type=float,
+        default=DEFAULT_STATION_RADIUS,
+        help="Maximum distance in miles from a store to the weather station used for it.  Stores with no station "
+             f"within this distance have no weather.  Default is {DEFAULT_STATION_RADIUS}"
+    )
+    parser.add_argument(
+        '--min_station_coverage',
+        action="store",
+        type=float,
+        default=DEFAULT_MIN_STATION_COVERAGE,
+        help="Fraction of the best covered station's days of weather data a station needs to be preferred over a "
+             f"nearer station with less data.  Default is {DEFAULT_MIN_STATION_COVERAGE}"
     )
     parser.add_argument(*logging_argparse_args, **logging_argparse_kwargs)
+    add_tracing_arguments(parser)
 
     return parser.parse_args()
 
 
-def add_zip_to_weather_stations(engine):
+def _chunks(records, chunk_size):
+    """
+    Yields successive lists of at most chunk_size records
+    """
+    for i in range(0, len(records), chunk_size):
+        yield records[i:i + chunk_size]
+
+
+def _load_records(cur, records, copy_query, insert_query, db_type="postgres", batch_size=DEFAULT_ZIPCODE_BATCH_SIZE):
+    """
+    Bulk loads records into a table in batches
+
+    Postgres streams each batch as csv using COPY FROM STDIN.  Redshift does not support COPY FROM STDIN, so each batch
+    is sent as a single multi-row parameterized insert
+
+    Args:
+        cur: psycopg2 cursor
+        records (list): List of tuples, in the column order of copy_query and insert_query
+        copy_query (str): COPY ... FROM STDIN WITH (FORMAT CSV) query used on postgres
+        insert_query (str): INSERT ... VALUES %s query used on redshift
+        db_type (str): postgres or redshift
+        batch_size (int): Maximum number of records sent to the database at once
+    """
+    for batch in _chunks(records, batch_size):
+        if db_type == "postgres":
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(batch)
+            buffer.seek(0)
+            logger.debug(f"query = {copy_query}")
+            cur.copy_expert(copy_query, buffer)
+        elif db_type == "redshift":
+            logger.debug(f"query = {insert_query}")
+            psycopg2.extras.execute_values(cur, insert_query, batch, page_size=batch_size)
+        else:
+            raise ValueError(f"Unknown db_type {db_type}")
+
+
+def load_temp_station_zipcodes(cur, zipcode_records, db_type="postgres", batch_size=DEFAULT_ZIPCODE_BATCH_SIZE):
+    """
+    Bulk loads (station_id, zipcode) records into the temporary new_zipcodes table in batches
+
+    Args:
+        cur: psycopg2 cursor
+        zipcode_records (list): List of (station_id, zipcode) tuples.  zipcode may be None
+        db_type (str): postgres or redshift
+        batch_size (int): Maximum number of records sent to the database at once
+    """
+    _load_records(cur, zipcode_records, copy_temp_station_zipcode_postgres, insert_temp_station_zipcode,
+                  db_type=db_type, batch_size=batch_size)
+
+
+def add_zip_to_weather_stations(engine, zipcode_cache=DEFAULT_ZIPCODE_CACHE, db_type="postgres",
+                                batch_size=DEFAULT_ZIPCODE_BATCH_SIZE):
     """
     Adds zip code to all records in weather_stations that have lat/long but not zip codes
 
     Args:
         engine: psycopg2 engine connected to postgres database
+        zipcode_cache (str): Filename of the on-disk cache of resolved coordinates, or None to disable caching
+        db_type (str): postgres or redshift
+        batch_size (int): Maximum number of zip codes sent to the database at once
     """
     cur = engine.cursor()
     _execute_query(cur, get_station_latitude_longitude)
     records = cur.fetchall()
+    if len(records) == 0:
+        logger.info("\tNo weather stations missing zip codes")
+        return
 
-    search = SearchEngine(simple_zipcode=True)
-    zip_fun = lambda t: (t[0], lat_long_to_zip(t[1], t[2], search))
-    zipcode_records = map(zip_fun, records)
+    station_ids, latitudes, longitudes = zip(*records)
+    resolver = ZipcodeResolver(cache_file=zipcode_cache)
+    zipcodes = resolver.resolve(latitudes, longitudes)
+    resolver.save_cache()
+    zipcode_records = list(zip(station_ids, zipcodes))
+
+    _execute_query(cur, create_temp_station_zipcode)
+    load_temp_station_zipcodes(cur, zipcode_records, db_type=db_type, batch_size=batch_size)
+    _execute_query(cur, update_station_zipcode)
+    _execute_query(cur, drop_temp_station_zipcode)
+    record_table_versions(engine, [weather_stations])
+    engine.commit()
 
-    # Values in format needed for sql (series of "(stn_id, zip), (stn_id, zip), ...")
-    values = ", ".join([str(r) for r in zipcode_records])
 
-    insert_query = insert_station_zipcode.format(values=values)
+def build_store_weather_stations(engine, db_type="postgres", radius=DEFAULT_STATION_RADIUS,
+                                 min_coverage=DEFAULT_MIN_STATION_COVERAGE, batch_size=DEFAULT_ZIPCODE_BATCH_SIZE):
+    """
+    Rebuilds the store_weather_station bridge table, matching every store to its nearest weather station
 
-    _execute_query(cur, insert_query)
+    Stores are located at the centroid of their zip code, and matched by a vectorized haversine search over station
+    coordinates that prefers stations with good weather data coverage (see utilities.nearest_covered_stations).  This
+    lets the sales/weather fact build join stores to weather directly rather than through zip codes.  The table is
+    only rewritten (and its load version bumped) if any store's station changed
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        db_type (str): postgres or redshift
+        radius (float): Maximum distance in miles from a store to its station
+        min_coverage (float): Fraction of the best covered station's days of data a station needs to be preferred
+        batch_size (int): Maximum number of records sent to the database at once
+
+    Returns:
+        (set): Ids of the stores whose station changed, including stores newly matched or no longer matched
+    """
+    cur = engine.cursor()
+    _execute_query(cur, select_store_zipcodes)
+    store_records = cur.fetchall()
+    _execute_query(cur, select_station_coverage)
+    station_records = cur.fetchall()
+    if len(store_records) == 0 or len(station_records) == 0:
+        logger.info("\tNo stores or weather stations to match")
+        return set()
+
+    store_ids, zipcodes = zip(*store_records)
+    station_ids, station_latitudes, station_longitudes, station_coverage = zip(*station_records)
+    latitudes, longitudes = ZipcodeResolver().locate(zipcodes)
+    i_stations, distances = nearest_covered_stations(latitudes, longitudes, station_latitudes, station_longitudes,
+                                                     station_coverage, min_coverage=min_coverage, radius=radius)
+    records = [(store_id, station_ids[i], round(float(d), 3))
+               for store_id, i, d in zip(store_ids, i_stations, distances) if i >= 0]
+
+    _execute_query(cur, select_store_weather_station)
+    current_stations = dict(cur.fetchall())
+    new_stations = {store_id: station_id for store_id, station_id, _ in records}
+    changed_stores = {store_id for store_id in set(current_stations) | set(new_stations)
+                      if current_stations.get(store_id) != new_stations.get(store_id)}
+    if not changed_stores:
+        engine.commit()
+        logger.info(f"\tMatched {len(records)} of {len(store_records)} stores to a weather station.  No stations "
+                    f"changed")
+        return changed_stores
+
+    _execute_query(cur, delete_store_weather_station)
+    _load_records(cur, records, copy_store_weather_station_postgres, insert_store_weather_station,
+                  db_type=db_type, batch_size=batch_size)
+    record_table_versions(engine, [store_weather_station])
     engine.commit()
+    logger.info(f"\tMatched {len(records)} of {len(store_records)} stores to a weather station.  "
+                f"{len(changed_stores)} stores changed station")
+    return changed_stores
+
+
+def get_olap_refresh_range(engine, date_ranges, changed_stores=None):
+    """
+    Returns the range of dates whose OLAP rows need rebuilding after a load
+
+    This is the union of the ranges of staged data (eg: sales and weather, as the sales/weather fact reads both),
+    widened to cover every sale of any store whose weather station changed, as the sales/weather fact joins weather
+    through store_weather_station
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        date_ranges (list): (datetime.date, datetime.date) ranges of staged data.  (None, None) if none was staged
+        changed_stores (set): (optional) Ids of stores whose station changed (see build_store_weather_stations)
+
+    Returns:
+        (tuple): (datetime.date, datetime.date), or (None, None) if nothing needs rebuilding
+    """
+    date_ranges = list(date_ranges)
+    if changed_stores:
+        date_ranges.append(get_date_range(engine, select_store_invoice_date_range,
+                                          dict(store_ids=tuple(sorted(changed_stores)))))
+    starts = [date_start for date_start, _ in date_ranges if date_start is not None]
+    ends = [date_end for _, date_end in date_ranges if date_end is not None]
+    return (min(starts) if starts else None), (max(ends) if ends else None)
 
 
 if __name__ == "__main__":
@@ -241,6 +1150,9 @@ if __name__ == "__main__":
     if args.set_logging_level:
         logger.setLevel(str(args.set_logging_level).upper())
 
+    start_tracing(Timer(name="etl", exit_message="--> etl complete", print_function=logger.info),
+                  trace_output=args.trace_output, metrics_output=args.metrics_output, trace_memory=args.trace_memory)
+
     data_sources = {
         'sales': args.sales_data_spec,
         'weather': args.weather_data_spec,
@@ -249,29 +1161,119 @@ if __name__ == "__main__":
 
     secrets, data_cfg = load_settings()
 
-    engine = psycopg2.connect(
-        database=secrets[args.db]["database"],
-        user=secrets[args.db]["user"],
-        password=secrets[args.db]["password"],
-        host=secrets[args.db]["host"],
-        port=secrets[args.db]["port"],
-    )
+    engine = psycopg2.connect(**get_connection_kwargs(secrets, args.db))
+
+    if args.staging_workers > 1 or args.insert_workers > 1:
+        pool = psycopg2.pool.ThreadedConnectionPool(minconn=1, maxconn=max(args.staging_workers, args.insert_workers),
+                                                    **get_connection_kwargs(secrets, args.db))
+    else:
+        pool = None
+
+    create_etl_state_tables(engine)
 
     with Timer(enter_message="Loading staging tables", exit_message="--> staging table load complete",
-               print_function=logger.info):
-        load_check_staging_tables(
+               print_function=logger.info) as span:
+        staged_files, staged_rows = load_check_staging_tables(
             engine,
             data_sources,
             data_cfg,
             secrets,
             db_type=args.db,
-            sales_raw_data_type=args.sales_raw_data_type
+            sales_raw_data_type=args.sales_raw_data_type,
+            sales_partitions=args.sales_partitions,
+            pool=pool,
+            n_workers=args.staging_workers,
+            copy_mode=args.copy_mode,
+            incremental=args.incremental,
+            cache_dir=args.cache_dir,
         )
+        span.set_attributes(rows=_sum_rows(staged_rows.values()))
 
-    with Timer(enter_message="Inserting data into tables", exit_message="--> table insert complete",
-               print_function=logger.info):
-        insert_check_tables(engine)
+    validator = DataValidator(engine, rules=parse_null_rate_overrides(args.max_null_rate))
+    if args.validation == "full":
+        with Timer(enter_message="Validating staging tables", exit_message="--> staging validation complete",
+                   print_function=logger.info):
+            validator.profile([t for t, files in staged_files.items() if files], loaded_rows=staged_rows)
+
+    # Months with new sales or weather are those whose OLAP rows need rebuilding.  Find them before staging is emptied
+    olap_date_start, olap_date_end = get_date_range(engine, select_staged_sales_date_range)
+    weather_date_range = get_date_range(engine, select_staged_weather_date_range)
+
+    partition_by = secrets[args.db].get("partition_by", None)
+    if partition_by and olap_date_start is not None:
+        with Timer(enter_message="Creating partitions", exit_message="--> partition creation complete",
+                   print_function=logger.info):
+            create_partitions(engine, olap_date_start, olap_date_end, partition_by)
+
+    if args.incremental:
+        with Timer(enter_message="Merging data into tables", exit_message="--> table merge complete",
+                   print_function=logger.info) as span:
+            inserted_rows = merge_check_tables(engine, staged_files, db_type=args.db, dedup=args.dedup,
+                                               partition_by=partition_by)
+            span.set_attributes(rows=sum(inserted_rows.values()))
+    else:
+        with Timer(enter_message="Inserting data into tables", exit_message="--> table insert complete",
+                   print_function=logger.info) as span:
+            inserted_rows = insert_check_tables(engine, dedup=args.dedup, db_type=args.db, pool=pool,
+                                                n_workers=args.insert_workers)
+            span.set_attributes(rows=sum(inserted_rows.values()))
+            # Record what was loaded so later incremental runs only stage new files
+            record_loaded_files(engine, staged_files)
+            record_table_versions(engine, insert_table_queries_by_dedup[args.dedup])
+            engine.commit()
+            truncate_staging_tables(engine, staged_files)
+
+    if pool is not None:
+        pool.closeall()
+
+    # Nothing later writes to these tables, and their indexes (eg: invoice dates) speed up the reads of later steps
+    if args.create_indexes and args.db == "postgres":
+        with Timer(enter_message="Creating production table indexes", exit_message="--> index creation complete",
+                   print_function=logger.info):
+            create_indexes(engine, table_names=indexes_before_olap_postgres)
 
     with Timer(enter_message="Adding zip code to weather stations table", exit_message="--> add zip complete",
                print_function=logger.info):
-        add_zip_to_weather_stations(engine)
+        add_zip_to_weather_stations(engine, zipcode_cache=args.zipcode_cache, db_type=args.db,
+                                    batch_size=args.zipcode_batch_size)
+
+    with Timer(enter_message="Matching stores to weather stations", exit_message="--> store station match complete",
+               print_function=logger.info):
+        changed_stores = build_store_weather_stations(engine, db_type=args.db, radius=args.station_radius,
+                                                      min_coverage=args.min_station_coverage,
+                                                      batch_size=args.zipcode_batch_size)
+
+    # Months with newly staged sales or weather, or with sales from stores whose weather station changed, are rebuilt
+    sales_date_range = (olap_date_start, olap_date_end)
+    olap_date_range = get_olap_refresh_range(engine, [sales_date_range, weather_date_range], changed_stores)
+    if not args.skip_olap:
+        if args.incremental and olap_date_range[0] is None:
+            logger.info("No new sales or weather staged and no store stations changed.  Skipping OLAP refresh")
+        else:
+            with Timer(enter_message="Refreshing OLAP tables", exit_message="--> OLAP refresh complete",
+                       print_function=logger.info):
+                refresh_olap_tables_for_date_range(engine, *olap_date_range)
+
+    # Indexes of the remaining tables are built once every bulk write (zip codes, store stations and OLAP) is done
+    if args.create_indexes and args.db == "postgres":
+        with Timer(enter_message="Creating indexes", exit_message="--> index creation complete",
+                   print_function=logger.info):
+            create_indexes(engine)
+
+    if args.validation != "none":
+        with Timer(enter_message="Validating loaded tables", exit_message="--> validation complete",
+                   print_function=logger.info):
+            validator.reconcile({t: n for t, n in staged_rows.items() if n is not None}, inserted_rows)
+            if args.validation == "full":
+                # Only the dates touched by this load are profiled.  Tables with no dates staged are skipped
+                date_ranges = {invoices: sales_date_range, weather: weather_date_range}
+                validated_tables = list(inserted_rows) + [store_weather_station]
+                if not args.skip_olap:
+                    date_ranges.update({t: olap_date_range for t in create_olap_table_queries})
+                    validated_tables += list(create_olap_table_queries)
+                validator.profile([t for t in validated_tables if None not in date_ranges.get(t, ())],
+                                  date_ranges=date_ranges)
+        validator.log_summary()
+        if args.validation_output:
+            validator.write_summary(args.validation_output)
+        validator.raise_for_failures()
@@ -0,0 +1,193 @@
+import argparse
+import datetime
+
+import psycopg2
+
+from sql_queries import refresh_olap_table_queries, select_invoice_date_range
+from tracing import add_tracing_arguments, start_tracing
+from utilities import load_settings, Timer, logging_argparse_kwargs, logging_argparse_args, get_logger, \
+    get_connection_kwargs, record_table_versions
+
+logger = get_logger(name=__file__)
+
+
+def _execute_query(cur, query, params=None):
+    """
+    Helper to apply debug printing to queries when required
+    """
+    logger.debug(f"query = {query}, params = {params}")
+    cur.execute(query, params)
+
+
+def month_start(date):
+    """
+    Returns the first day of the month containing date
+
+    Args:
+        date (datetime.date): Any date
+
+    Returns:
+        (datetime.date)
+    """
+    return datetime.date(date.year, date.month, 1)
+
+
+def next_month_start(date):
+    """
+    Returns the first day of the month after the month containing date
+
+    Args:
+        date (datetime.date): Any date
+
+    Returns:
+        (datetime.date)
+    """
+    if date.month == 12:
+        return datetime.date(date.year + 1, 1, 1)
+    return datetime.date(date.year, date.month + 1, 1)
+
+
+def get_months(date_start, date_end):
+    """
+    Returns the first day of every month that overlaps [date_start, date_end]
+
+    Args:
+        date_start (datetime.date): First date (inclusive)
+        date_end (datetime.date): Last date (inclusive)
+
+    Returns:
+        (list): List of datetime.date
+    """
+    months = []
+    this_month = month_start(date_start)
+    while this_month <= date_end:
+        months.append(this_month)
+        this_month = next_month_start(this_month)
+    return months
+
+
+def get_date_range(engine, query=select_invoice_date_range, params=None):
+    """
+    Returns the (min, max) date returned by a query, or (None, None) if there is no data
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        query (str): Query that returns a single row of (min_date, max_date)
+        params (dict): Query parameters, or None
+
+    Returns:
+        (tuple): (datetime.date, datetime.date)
+    """
+    cur = engine.cursor()
+    _execute_query(cur, query, params)
+    return cur.fetchone()
+
+
+def refresh_olap_tables(engine, months):
+    """
+    Recomputes the OLAP fact tables for the given months from the OLTP tables
+
+    Each month is refreshed by deleting the existing rows for that month then re-inserting them, committing once per
+    month so a failure leaves every other month consistent.  The load version of each table is bumped with every month
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        months (list): List of datetime.date of the first day of each month to refresh
+    """
+    logger.info(f"Refreshing OLAP tables for {len(months)} months")
+    cur = engine.cursor()
+    for this_month in months:
+        params = dict(
+            date_start=this_month,
+            date_end=next_month_start(this_month),
+            year=this_month.year,
+            month=this_month.month,
+        )
+        with Timer(enter_message=f"\tRefreshing {this_month:%Y-%m}",
+                   exit_message=f"\t--> refresh {this_month:%Y-%m} complete", print_function=logger.info,
+                   name="refresh month", attributes=dict(month=f"{this_month:%Y-%m}")) as month_span:
+            month_rows = 0
+            for table_name, (delete_query, insert_query) in refresh_olap_table_queries.items():
+                with Timer(exit_message=f"\t\t--> {table_name}", print_function=logger.debug,
+                           attributes=dict(table=table_name)) as span:
+                    _execute_query(cur, delete_query, params)
+                    _execute_query(cur, insert_query, params)
+                    span.set_attributes(rows=cur.rowcount)
+                    month_rows += cur.rowcount
+            month_span.set_attributes(rows=month_rows)
+            record_table_versions(engine, refresh_olap_table_queries)
+            engine.commit()
+
+
+def refresh_olap_tables_for_date_range(engine, date_start=None, date_end=None):
+    """
+    Recomputes the OLAP fact tables for all months overlapping a date range
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        date_start (datetime.date): First date to refresh.  If None, uses the earliest invoice
+        date_end (datetime.date): Last date to refresh (inclusive).  If None, uses the latest invoice
+    """
+    if date_start is None or date_end is None:
+        invoice_start, invoice_end = get_date_range(engine)
+        if invoice_start is None:
+            raise ValueError("No invoices found to build OLAP tables from")
+        date_start = date_start or invoice_start
+        date_end = date_end or invoice_end
+
+    refresh_olap_tables(engine, get_months(date_start, date_end))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Builds or refreshes the OLAP fact tables from the OLTP tables, "
+                                                 "one month at a time")
+    parser.add_argument(
+        '--db',
+        action="store",
+        default="postgres",
+        help="Name of db credentials in secrets.yaml.  Use this to point at different dbs (postgres, redshift, ...)"
+    )
+    parser.add_argument(
+        '--month_start',
+        action="store",
+        default=None,
+        help="First month to refresh (inclusive, in YYYY-MM format).  Default is the month of the earliest invoice"
+    )
+    parser.add_argument(
+        '--month_end',
+        action="store",
+        default=None,
+        help="Last month to refresh (inclusive, in YYYY-MM format).  Default is the month of the latest invoice"
+    )
+    parser.add_argument(*logging_argparse_args, **logging_argparse_kwargs)
+    add_tracing_arguments(parser)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    """
+    Builds or refreshes the OLAP fact tables from the OLTP tables
+    """
+    args = parse_arguments()
+
+    if args.set_logging_level:
+        logger.setLevel(str(args.set_logging_level).upper())
+
+    start_tracing(Timer(name="etl_olap", exit_message="--> etl_olap complete", print_function=logger.info),
+                  trace_output=args.trace_output, metrics_output=args.metrics_output, trace_memory=args.trace_memory)
+
+    secrets, _ = load_settings()
+
+    engine = psycopg2.connect(**get_connection_kwargs(secrets, args.db))
+
+    date_start = None
+    if args.month_start:
+        date_start = datetime.datetime.strptime(args.month_start, "%Y-%m").date()
+    date_end = None
+    if args.month_end:
+        date_end = datetime.datetime.strptime(args.month_end, "%Y-%m").date()
+
+    with Timer(enter_message="Refreshing OLAP tables", exit_message="--> OLAP refresh complete",
+               print_function=logger.info):
+        refresh_olap_tables_for_date_range(engine, date_start, date_end)
@@ -0,0 +1,394 @@
+import argparse
+import datetime
+import os
+import threading
+
+import psycopg2
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+from sql_queries import analytical_queries, export_tables, export_date_filters, export_date_filter, \
+    select_export_table, select_export_filtered, select_export_description, copy_export_to_stdout
+from tracing import add_tracing_arguments, start_tracing
+from utilities import load_settings, Timer, logging_argparse_kwargs, logging_argparse_args, get_logger, \
+    get_connection_kwargs
+
+logger = get_logger(name=__file__)
+
+DEFAULT_MODE = "cursor"
+EXPORT_MODES = ["cursor", "copy"]
+DEFAULT_FORMAT = "parquet"
+EXPORT_FORMATS = ["parquet", "arrow"]
+DEFAULT_BATCH_SIZE = 100000
+DEFAULT_PARQUET_COMPRESSION = "snappy"
+ARROW_COMPRESSION = "zstd"
+COPY_BLOCK_SIZE = 16 * 1024 * 1024
+
+# Arrow type each postgres/redshift type oid is exported as.  Unlisted types are exported as strings
+NUMERIC_OID = 1700
+POSTGRES_OID_ARROW_TYPES = {
+    16: pa.bool_(),
+    20: pa.int64(),
+    21: pa.int16(),
+    23: pa.int32(),
+    25: pa.string(),
+    700: pa.float32(),
+    701: pa.float64(),
+    1042: pa.string(),
+    1043: pa.string(),
+    1082: pa.date32(),
+    1114: pa.timestamp("us"),
+}
+
+
+def get_arrow_schema(description):
+    """
+    Returns the arrow schema of a query result from its cursor description
+
+    NUMERIC columns with a declared precision and scale are exported as decimals.  Unconstrained NUMERIC columns (eg:
+    the result of SUM) have no fixed scale, so are exported as float64
+
+    Args:
+        description: psycopg2 cursor.description
+
+    Returns:
+        (pa.Schema)
+    """
+    fields = []
+    for column in description:
+        if column.type_code == NUMERIC_OID:
+            if column.precision is not None and column.scale is not None:
+                arrow_type = pa.decimal128(column.precision, column.scale)
+            else:
+                arrow_type = pa.float64()
+        else:
+            arrow_type = POSTGRES_OID_ARROW_TYPES.get(column.type_code, pa.string())
+        fields.append(pa.field(column.name, arrow_type))
+    return pa.schema(fields)
+
+
+def get_export_query(source, date_start=None, date_end=None):
+    """
+    Returns the query and parameters that export a fact table or analytical query, optionally filtered by date
+
+    Args:
+        source (str): Name of a table in export_tables or a key of analytical_queries.  Analytical queries can only
+                      be date filtered if their result has a date column
+        date_start (datetime.date): (optional) First date exported (inclusive)
+        date_end (datetime.date): (optional) Last date exported (exclusive)
+
+    Returns:
+        (tuple): (query, params), where params is None if there is no date filter
+    """
+    if source in export_tables:
+        query = select_export_table.format(table_name=source)
+        date_filter = export_date_filters[source]
+    elif source in analytical_queries:
+        query = analytical_queries[source]
+        date_filter = export_date_filter
+    else:
+        raise ValueError(f"Unknown export source {source}.  Must be one of {export_tables + list(analytical_queries)}")
+
+    if date_start is None and date_end is None:
+        return query, None
+
+    date_start = date_start or datetime.date.min
+    date_end = date_end or datetime.date.max
+    last_date = date_end - datetime.timedelta(days=1)
+    params = dict(
+        date_start=date_start,
+        date_end=date_end,
+        month_start=date_start.year * 100 + date_start.month,
+        month_end=last_date.year * 100 + last_date.month,
+    )
+    return select_export_filtered.format(query=query, date_filter=date_filter), params
+
+
+def open_writer(output, schema, file_format=DEFAULT_FORMAT, parquet_compression=DEFAULT_PARQUET_COMPRESSION):
+    """
+    Opens a writer that accepts arrow tables of schema
+
+    Args:
+        output (str): Output filename
+        schema (pa.Schema): Schema of the exported data
+        file_format (str): parquet, or arrow for a zstd compressed Arrow IPC file
+        parquet_compression (str): Compression codec for parquet files
+
+    Returns:
+        Writer with write_table and close methods
+    """
+    if file_format == "parquet":
+        return pq.ParquetWriter(output, schema, compression=parquet_compression)
+    elif file_format == "arrow":
+        return pa.ipc.new_file(output, schema, options=pa.ipc.IpcWriteOptions(compression=ARROW_COMPRESSION))
+    else:
+        raise ValueError(f"Unknown file_format {file_format}.  Must be one of {EXPORT_FORMATS}")
+
+
+def iter_cursor_batches(engine, query, params=None, batch_size=DEFAULT_BATCH_SIZE, cursor_name="export"):
+    """
+    Yields the result of a query as arrow tables of up to batch_size rows, fetched through a named (server-side) cursor
+
+    Only one batch is held in memory at a time.  At least one table is always yielded (empty if the query returns no
+    rows), so the schema of the result is always available.  Works on both postgres and redshift
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        query (str): Query to run
+        params (dict): Query parameters, or None
+        batch_size (int): Rows fetched at a time
+        cursor_name (str): Name of the server-side cursor
+
+    Yields:
+        (pa.Table)
+    """
+    cur = engine.cursor(name=cursor_name)
+    cur.itersize = batch_size
+    logger.debug(f"query = {query}, params = {params}")
+    cur.execute(query, params)
+
+    # Named cursors only have a description once rows have been fetched
+    rows = cur.fetchmany(batch_size)
+    schema = get_arrow_schema(cur.description)
+    # Decimals with varying scale cannot be built directly as float, so are inferred as decimal then cast
+    cast_columns = {i for i, column in enumerate(cur.description) if column.type_code == NUMERIC_OID}
+
+    if not rows:
+        yield schema.empty_table()
+    while rows:
+        arrays = []
+        for i, (field, values) in enumerate(zip(schema, zip(*rows))):
+            if i in cast_columns:
+                arrays.append(pa.array(values).cast(field.type))
+            else:
+                arrays.append(pa.array(values, type=field.type))
+        yield pa.Table.from_arrays(arrays, schema=schema)
+        rows = cur.fetchmany(batch_size)
+
+    cur.close()
+    engine.commit()
+
+
+def export_with_cursor(engine, query, params, output, file_format=DEFAULT_FORMAT, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Exports a query result by fetching it through a named (server-side) cursor in batches of batch_size rows
+
+    Only one batch is held in memory at a time.  Works on both postgres and redshift
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        query (str): Query to export
+        params (dict): Query parameters, or None
+        output (str): Output filename
+        file_format (str): parquet or arrow
+        batch_size (int): Rows fetched and written at a time
+
+    Returns:
+        (int): Number of rows exported
+    """
+    n_rows = 0
+    writer = None
+    try:
+        for table in iter_cursor_batches(engine, query, params, batch_size=batch_size):
+            if writer is None:
+                writer = open_writer(output, table.schema, file_format)
+            if table.num_rows:
+                writer.write_table(table)
+                n_rows += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    return n_rows
+
+
+def export_with_copy(engine, query, params, output, file_format=DEFAULT_FORMAT):
+    """
+    Exports a query result by streaming COPY ... TO STDOUT through a pipe into an arrow csv reader
+
+    Rows are never built as python objects, and memory use is bounded by the csv reader's block size.  Postgres only
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        query (str): Query to export
+        params (dict): Query parameters, or None
+        output (str): Output filename
+        file_format (str): parquet or arrow
+
+    Returns:
+        (int): Number of rows exported
+    """
+    cur = engine.cursor()
+    cur.execute(select_export_description.format(query=query), params)
+    schema = get_arrow_schema(cur.description)
+
+    # COPY does not accept parameters, so bind them client-side
+    if params is not None:
+        query = cur.mogrify(query, params).decode()
+    q = copy_export_to_stdout.format(query=query)
+    logger.debug(f"query = {q}")
+
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def copy_to_pipe():
+        try:
+            with os.fdopen(write_fd, "wb") as sink:
+                cur.copy_expert(q, sink, size=COPY_BLOCK_SIZE)
+        except Exception as e:
+            errors.append(e)
+
+    copy_thread = threading.Thread(target=copy_to_pipe)
+    copy_thread.start()
+
+    n_rows = 0
+    source = os.fdopen(read_fd, "rb")
+    writer = open_writer(output, schema, file_format)
+    try:
+        reader = pacsv.open_csv(
+            source,
+            read_options=pacsv.ReadOptions(column_names=schema.names, block_size=COPY_BLOCK_SIZE),
+            # COPY writes NULL as an empty unquoted field and empty strings as "".  Only that field is NULL, so values
+            # such as NA or null written unquoted stay strings
+            convert_options=pacsv.ConvertOptions(column_types=schema, null_values=[""], strings_can_be_null=True,
+                                                 quoted_strings_can_be_null=False, true_values=["t"],
+                                                 false_values=["f"]),
+        )
+        for batch in reader:
+            writer.write_table(pa.Table.from_batches([batch], schema=schema))
+            n_rows += batch.num_rows
+    finally:
+        writer.close()
+        # Closing the read end unblocks the copy if reading stopped early
+        source.close()
+        copy_thread.join()
+
+    if errors:
+        raise errors[0]
+    engine.commit()
+    return n_rows
+
+
+def export(engine, source, output, mode=DEFAULT_MODE, file_format=DEFAULT_FORMAT, batch_size=DEFAULT_BATCH_SIZE,
+           date_start=None, date_end=None, db_type="postgres"):
+    """
+    Exports a fact table or analytical query to a parquet or Arrow IPC file
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        source (str): Name of a table in export_tables or a key of analytical_queries
+        output (str): Output filename
+        mode (str): cursor (named cursor, postgres or redshift) or copy (COPY TO STDOUT, postgres only)
+        file_format (str): parquet or arrow
+        batch_size (int): Rows fetched at a time in cursor mode
+        date_start (datetime.date): (optional) First date exported (inclusive)
+        date_end (datetime.date): (optional) Last date exported (exclusive)
+        db_type (str): postgres or redshift
+
+    Returns:
+        (int): Number of rows exported
+    """
+    if mode == "copy" and db_type == "redshift":
+        raise ValueError("copy mode uses COPY TO STDOUT, which redshift does not support.  Use cursor mode")
+    query, params = get_export_query(source, date_start, date_end)
+    timer = Timer(enter_message=f"Exporting {source} to {output} using {mode}",
+                  exit_message="--> export complete", print_function=logger.info, name="export",
+                  attributes=dict(source=source, file=output, mode=mode))
+    with timer:
+        if mode == "cursor":
+            n_rows = export_with_cursor(engine, query, params, output, file_format=file_format,
+                                        batch_size=batch_size)
+        elif mode == "copy":
+            n_rows = export_with_copy(engine, query, params, output, file_format=file_format)
+        else:
+            raise ValueError(f"Unknown mode {mode}.  Must be one of {EXPORT_MODES}")
+        timer.set_attributes(rows=n_rows, bytes=os.path.getsize(output))
+        elapsed = timer.elapsed()
+
+    logger.info(f"Exported {n_rows} rows ({n_rows / max(elapsed, 1e-9):.0f} rows/s, "
+                f"{timer.attributes['bytes'] / 1024 ** 2:.1f} MB)")
+    return n_rows
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Streams a fact table or analytical query to a parquet or Arrow IPC "
+                                                 "file without holding the result in memory")
+    parser.add_argument(
+        'source',
+        help=f"Fact table ({', '.join(export_tables)}) or name of an analytical query to export"
+    )
+    parser.add_argument(
+        'output',
+        help="Output filename"
+    )
+    parser.add_argument(
+        '--db',
+        action="store",
+        default="postgres",
+        help="Name of db credentials in secrets.yaml.  Use this to point at different dbs (postgres, redshift, ...)"
+    )
+    parser.add_argument(
+        '--mode',
+        action="store",
+        default=DEFAULT_MODE,
+        choices=EXPORT_MODES,
+        help="How results are read.  cursor fetches batches through a server-side cursor (postgres or redshift), "
+             "copy streams COPY TO STDOUT straight into arrow (postgres only, fastest).  "
+             f"Default is {DEFAULT_MODE}"
+    )
+    parser.add_argument(
+        '--format',
+        action="store",
+        default=DEFAULT_FORMAT,
+        choices=EXPORT_FORMATS,
+        help=f"Output file format.  arrow writes a zstd compressed Arrow IPC file.  Default is {DEFAULT_FORMAT}"
+    )
+    parser.add_argument(
+        '--batch_size',
+        action="store",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help=f"Rows fetched at a time in cursor mode.  Default is {DEFAULT_BATCH_SIZE}"
+    )
+    parser.add_argument(
+        '--date_start',
+        action="store",
+        type=parse_date,
+        default=None,
+        help="First date to export (inclusive, in YYYY-MM-DD format).  Default is no lower bound"
+    )
+    parser.add_argument(
+        '--date_end',
+        action="store",
+        type=parse_date,
+        default=None,
+        help="Last date to export (exclusive, in YYYY-MM-DD format).  Default is no upper bound"
+    )
+    parser.add_argument(*logging_argparse_args, **logging_argparse_kwargs)
+    add_tracing_arguments(parser)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    """
+    Exports a fact table or analytical query to a file
+    """
+    args = parse_arguments()
+
+    if args.set_logging_level:
+        logger.setLevel(str(args.set_logging_level).upper())
+
+    start_tracing(Timer(name="export", exit_message="--> export run complete", print_function=logger.info),
+                  trace_output=args.trace_output, metrics_output=args.metrics_output, trace_memory=args.trace_memory)
+
+    secrets, _ = load_settings()
+
+    engine = psycopg2.connect(**get_connection_kwargs(secrets, args.db))
+
+    export(engine, args.source, args.output, mode=args.mode, file_format=args.format, batch_size=args.batch_size,
+           date_start=args.date_start, date_end=args.date_end, db_type=args.db)
@@ -1,12 +1,33 @@
 import argparse
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as pads
+import pyarrow.parquet as pq
 from sodapy import Socrata
-import awswrangler as wr
 
+from socrata_cache import SocrataCache, CachedSocrataClient, DEFAULT_CACHE_DIR, DEFAULT_CACHE_TTL_DAYS, \
+    DEFAULT_CACHE_MAX_SIZE_GB
+from storage import get_storage, join_key, DEFAULT_TRANSFER_WORKERS
+from tracing import add_tracing_arguments, start_tracing, with_current_span
 from utilities import load_settings, Timer
 from sql_queries import staging_sales_columns
 
-DEFAULT_LIMIT = 1000000
+DEFAULT_PAGE_SIZE = 50000
+DEFAULT_DOWNLOAD_WORKERS = 2
+DEFAULT_UPLOAD_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 2
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 5.0
+SOURCE_KEY = "m3tr-qhgy"
 
 # Map between the names used in this app and the original data source names
 SALES_NAME_MAP_APP_TO_SOURCE = {
@@ -39,6 +60,522 @@ SALES_NAME_MAP_APP_TO_SOURCE = {
 SALES_NAME_MAP_SOURCE_TO_APP = {v: k for k, v in SALES_NAME_MAP_APP_TO_SOURCE.items()}
 
 
+SALES_COLUMNS_SOURCE = [SALES_NAME_MAP_APP_TO_SOURCE[name] for name in staging_sales_columns]
+
+# Sales are paged by a keyset on the invoice line number, which is unique
+SALES_PAGE_KEY_SOURCE = SALES_NAME_MAP_APP_TO_SOURCE["invoice_id"]
+
+# Socrata returns everything as strings other than the date.  Pages are read with this fixed schema so every page
+# matches even if a page has a column that is entirely null
+SALES_ARROW_SCHEMA_SOURCE = pa.schema([
+    (name, pa.date32() if name == "date" else pa.string()) for name in staging_sales_columns
+])
+
+# Precision/scale used for DECIMAL staging columns.  Scale matches the money columns of the invoices table
+SALES_DECIMAL_TYPE = pa.decimal128(12, 3)
+
+# File type of hive-style partitioned parquet datasets in data.yml
+PARTITIONED_FILE_TYPE = "parquet_partitioned"
+
+# Columns derived from the sale date that partitioned datasets can be partitioned by.  These are only stored in the
+# partition path (eg: year=2018/month=3/day=5/), so files keep exactly the staging_sales columns
+DATE_PARTITION_COLUMNS = {
+    "year": pc.year,
+    "month": pc.month,
+    "day": pc.day,
+}
+DEFAULT_PARTITION_COLUMNS = ["year", "month", "day"]
+
+DEFAULT_PARQUET_COMPRESSION = "snappy"
+DEFAULT_PARQUET_ROW_GROUP_SIZE = 250000
+
+
+def get_arrow_type(name, spec):
+    """
+    Returns the arrow type used in parquet files for a staging column
+
+    DECIMAL id columns hold integer ids and are written as integers.  Other DECIMAL columns are written as decimals
+
+    Args:
+        name (str): Column name
+        spec (str): Column specification from sql_queries (eg: "DECIMAL NOT NULL")
+
+    Returns:
+        (pa.DataType)
+    """
+    sql_type = spec.split()[0].upper()
+    if sql_type == "DATE":
+        return pa.date32()
+    if sql_type == "DECIMAL":
+        return pa.int64() if name.endswith("_id") else SALES_DECIMAL_TYPE
+    if sql_type == "VARCHAR":
+        return pa.string()
+    raise ValueError(f"No arrow type defined for column {name} with specification {spec}")
+
+
+# Typed schema for parquet files, matching the staging_sales table
+SALES_ARROW_SCHEMA = pa.schema([
+    (name, get_arrow_type(name, spec)) for name, spec in staging_sales_columns.items()
+])
+
+
+def get_month_where(start_date, end_date):
+    """
+    Returns the SoQL where clause selecting sales in [start_date, end_date)
+
+    Args:
+        start_date (pd.Timestamp): First day of the month
+        end_date (pd.Timestamp): First day of the next month
+
+    Returns:
+        (str)
+    """
+    return f"date >= '{start_date.strftime('%Y-%m')}' AND date < '{end_date.strftime('%Y-%m')}'"
+
+
+def iter_sales_pages(source_client, where, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Yields pages of sales data matching a where clause as DataFrames, using keyset pagination on invoice line number
+
+    Only a single page of records is held at a time.  Pages are returned with app column names in
+    staging_sales_columns order, with date converted to a date
+
+    Args:
+        source_client: sodapy Socrata client
+        where (str): SoQL where clause
+        page_size (int): Number of records requested per page
+
+    Yields:
+        (pd.DataFrame)
+    """
+    last_key = None
+    while True:
+        page_where = where
+        if last_key is not None:
+            page_where = f"{where} AND {SALES_PAGE_KEY_SOURCE} > '{last_key}'"
+        results = source_client.get(SOURCE_KEY,
+                                    select=", ".join(SALES_COLUMNS_SOURCE),
+                                    where=page_where,
+                                    order=SALES_PAGE_KEY_SOURCE,
+                                    limit=page_size,
+                                    )
+        if len(results) == 0:
+            return
+        last_key = results[-1][SALES_PAGE_KEY_SOURCE]
+
+        # Columns with no data in a page are not returned, so reindex to ensure all columns exist in the expected order
+        df = pd.DataFrame(results).rename(columns=SALES_NAME_MAP_SOURCE_TO_APP)
+        df = df.reindex(columns=list(staging_sales_columns))
+        df['date'] = pd.to_datetime(df['date'], yearfirst=True).dt.date
+        yield df
+
+        if len(results) < page_size:
+            return
+
+
+def to_typed_table(df):
+    """
+    Converts a page of sales data to an arrow table typed by SALES_ARROW_SCHEMA
+
+    Args:
+        df (pd.DataFrame): Page from iter_sales_pages
+
+    Returns:
+        (pa.Table)
+    """
+    table = pa.Table.from_pandas(df, schema=SALES_ARROW_SCHEMA_SOURCE, preserve_index=False)
+    # Unsafe cast truncates any decimal places beyond the scale of SALES_DECIMAL_TYPE
+    return table.cast(SALES_ARROW_SCHEMA, safe=False)
+
+
+def download_month_to_files(source_client, where, csv_file=None, parquet_file=None, page_size=DEFAULT_PAGE_SIZE,
+                            parquet_compression=DEFAULT_PARQUET_COMPRESSION,
+                            parquet_row_group_size=DEFAULT_PARQUET_ROW_GROUP_SIZE):
+    """
+    Streams a month of sales data page by page to local csv and/or parquet files
+
+    Parquet files are typed by SALES_ARROW_SCHEMA and compressed.  Pages are buffered until a full row group is
+    available so row group size is independent of page size
+
+    Args:
+        source_client: sodapy Socrata client
+        where (str): SoQL where clause
+        csv_file (str): Filename of csv output, or None to skip
+        parquet_file (str): Filename of parquet output, or None to skip
+        page_size (int): Number of records requested per page
+        parquet_compression (str): Parquet compression codec (eg: snappy, zstd, none)
+        parquet_row_group_size (int): Number of rows per parquet row group
+
+    Returns:
+        (int): Number of records written
+    """
+    n_records = 0
+    parquet_writer = None
+    row_group_buffer = []
+    if parquet_file:
+        parquet_writer = pq.ParquetWriter(parquet_file, SALES_ARROW_SCHEMA, compression=parquet_compression)
+    try:
+        for df in iter_sales_pages(source_client, where, page_size=page_size):
+            if csv_file:
+                df.to_csv(csv_file, mode="w" if n_records == 0 else "a", header=n_records == 0, index=False)
+            if parquet_writer:
+                row_group_buffer.append(to_typed_table(df))
+                buffered = pa.concat_tables(row_group_buffer)
+                n_full = (buffered.num_rows // parquet_row_group_size) * parquet_row_group_size
+                if n_full:
+                    # Write only full row groups, carrying any remainder into the next row group
+                    parquet_writer.write_table(buffered.slice(0, n_full), row_group_size=parquet_row_group_size)
+                    buffered = buffered.slice(n_full)
+                row_group_buffer = [buffered]
+            n_records += len(df)
+        if parquet_writer and row_group_buffer and row_group_buffer[0].num_rows:
+            parquet_writer.write_table(pa.concat_tables(row_group_buffer), row_group_size=parquet_row_group_size)
+    finally:
+        if parquet_writer:
+            parquet_writer.close()
+    return n_records
+
+
+def get_month_key(this_data_cfg, start_date):
+    """
+    Returns the storage key of the monthly file for a data spec
+
+    Args:
+        this_data_cfg (dict): Data spec dictionary for a single file type (eg: data_cfg['sales_raw']['csv'])
+        start_date (pd.Timestamp): First day of the month
+
+    Returns:
+        (str)
+    """
+    return join_key(this_data_cfg.get("key_base", ""), f'{start_date.year:02d}', f'{start_date.month:02d}',
+                    f'{start_date.year:04d}-{start_date.month:02d}{this_data_cfg["suffix"]}')
+
+
+def write_partitioned_dataset(parquet_file, out_dir, start_date, partition_cols=None,
+                              parquet_compression=DEFAULT_PARQUET_COMPRESSION, **kwargs):
+    """
+    Rewrites a local parquet file as a hive-style partitioned dataset (eg: out_dir/year=2018/month=3/day=5/...)
+
+    The file is scanned in batches, so memory use does not scale with the size of the file
+
+    Args:
+        parquet_file (str): Filename of a sales parquet file
+        out_dir (str): Directory to write the dataset to
+        start_date (pd.Timestamp): First day of the month in parquet_file.  Used to name the files in each partition
+                                   so rewriting a month replaces its files
+        partition_cols (list): Columns from DATE_PARTITION_COLUMNS to partition by, in order
+        parquet_compression (str): Parquet compression codec
+        kwargs: Unused.  Allows passing the same parquet options as download_month_to_files
+    """
+    partition_cols = partition_cols or DEFAULT_PARTITION_COLUMNS
+    unknown = [c for c in partition_cols if c not in DATE_PARTITION_COLUMNS]
+    if unknown:
+        raise ValueError(f"Cannot partition by {unknown}.  Partition columns must be in {list(DATE_PARTITION_COLUMNS)}")
+
+    dataset = pads.dataset(parquet_file)
+    columns = {name: pads.field(name) for name in dataset.schema.names}
+    columns.update({c: DATE_PARTITION_COLUMNS[c](pads.field("date")) for c in partition_cols})
+
+    pads.write_dataset(
+        dataset.scanner(columns=columns),
+        out_dir,
+        format="parquet",
+        partitioning=partition_cols,
+        partitioning_flavor="hive",
+        basename_template=f"{start_date.year:04d}-{start_date.month:02d}-part-{{i}}.parquet",
+        file_options=pads.ParquetFileFormat().make_write_options(compression=parquet_compression),
+        existing_data_behavior="overwrite_or_ignore",
+    )
+
+
+def get_parquet_options(this_data_cfg):
+    """
+    Returns parquet writer options from a parquet data spec, using defaults for any that are not specified
+
+    Args:
+        this_data_cfg (dict): Data spec dictionary for parquet files (eg: data_cfg['sales_raw']['parquet'])
+
+    Returns:
+        (dict): kwargs for download_month_to_files
+    """
+    return dict(
+        parquet_compression=this_data_cfg.get("compression", DEFAULT_PARQUET_COMPRESSION),
+        parquet_row_group_size=this_data_cfg.get("row_group_size", DEFAULT_PARQUET_ROW_GROUP_SIZE),
+    )
+
+
+def get_partitioned_options(this_data_cfg):
+    """
+    Returns partitioned dataset options from a partitioned parquet data spec, using defaults for any not specified
+
+    Args:
+        this_data_cfg (dict): Data spec dictionary for partitioned parquet
+                              (eg: data_cfg['sales_raw']['parquet_partitioned'])
+
+    Returns:
+        (dict): kwargs for write_partitioned_dataset
+    """
+    return dict(
+        partition_cols=this_data_cfg.get("partition_cols", DEFAULT_PARTITION_COLUMNS),
+        parquet_compression=this_data_cfg.get("compression", DEFAULT_PARQUET_COMPRESSION),
+    )
+
+
+def with_retries(fn, description, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+    """
+    Calls fn, retrying with exponential backoff if it raises
+
+    Args:
+        fn: Function that takes no arguments
+        description (str): Description of fn used when reporting retries
+        retries (int): Number of times to retry after the first failure
+        backoff (float): Seconds waited before the first retry.  Doubles after each retry
+
+    Returns:
+        Return value of fn
+    """
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == retries:
+                raise
+            wait = backoff * 2 ** attempt
+            print(f"WARNING: {description} failed ({e}).  Retrying in {wait:.0f}s")
+            time.sleep(wait)
+
+
+def download_month(source_client, start_date, end_date, tmp_dir, write_csv=True, write_parquet=True,
+                   page_size=DEFAULT_PAGE_SIZE, parquet_options=None, write_partitioned=False,
+                   partitioned_options=None):
+    """
+    Downloads a month of sales data to local files in tmp_dir
+
+    Args:
+        source_client: sodapy Socrata client
+        start_date (pd.Timestamp): First day of the month
+        end_date (pd.Timestamp): First day of the next month
+        tmp_dir (str): Directory for the local files
+        write_csv (bool): If True, writes a csv file
+        write_parquet (bool): If True, writes a parquet file
+        page_size (int): Number of records requested per page
+        parquet_options (dict): Additional kwargs for download_month_to_files (parquet_compression,
+                                parquet_row_group_size)
+        write_partitioned (bool): If True, writes a hive-style partitioned parquet dataset directory
+        partitioned_options (dict): Additional kwargs for write_partitioned_dataset (partition_cols,
+                                    parquet_compression)
+
+    Returns:
+        (dict): Map of {file_type: local filename or directory} for files containing data.  Empty if there were no
+                records
+    """
+    parquet_options = parquet_options or {}
+    partitioned_options = partitioned_options or {}
+    where = get_month_where(start_date, end_date)
+    local_files = {}
+    if write_csv:
+        local_files["csv"] = os.path.join(tmp_dir, "sales.csv")
+    if write_parquet:
+        local_files["parquet"] = os.path.join(tmp_dir, "sales.parquet")
+
+    # A partitioned dataset is built from a local parquet file, even if that file is not uploaded itself
+    parquet_file = local_files.get("parquet")
+    if write_partitioned and not parquet_file:
+        parquet_file = os.path.join(tmp_dir, "sales_to_partition.parquet")
+
+    # Stream pages to local files so only a page of records is in memory at once
+    with Timer(enter_message=f"Downloading data where {where}", exit_message=f"--> download {where} complete",
+               name="download month", attributes=dict(month=f"{start_date:%Y-%m}")) as span:
+        n_records = download_month_to_files(source_client, where, csv_file=local_files.get("csv"),
+                                            parquet_file=parquet_file, page_size=page_size, **parquet_options)
+        span.set_attributes(rows=n_records, bytes=sum(os.path.getsize(f) for f in (local_files.get("csv"), parquet_file)
+                                                      if f and os.path.exists(f)))
+    print(f"Downloaded {n_records} records where {where}")
+
+    if n_records == 0:
+        return {}
+
+    if write_partitioned:
+        local_files[PARTITIONED_FILE_TYPE] = os.path.join(tmp_dir, PARTITIONED_FILE_TYPE)
+        write_partitioned_dataset(parquet_file, local_files[PARTITIONED_FILE_TYPE], start_date, **partitioned_options)
+    return local_files
+
+
+def upload_month(local_files, start_date, data_spec_cfg, storages):
+    """
+    Uploads a month of local sales files to the storage of each file type
+
+    Partitioned datasets are uploaded file by file, keeping their partition paths relative to the data spec's key_base
+
+    Args:
+        local_files (dict): Map of {file_type: local filename or directory} from download_month
+        start_date (pd.Timestamp): First day of the month
+        data_spec_cfg (dict): Data spec dictionary containing a spec for each file type
+        storages (dict): Map of {file_type: Storage} that each file type is written to
+
+    Returns:
+        (dict): Map of {stage: seconds} of the upload of each file type
+    """
+    upload_times = {}
+    for file_type, local_file in local_files.items():
+        storage = storages[file_type]
+        if file_type == PARTITIONED_FILE_TYPE:
+            t_start = time.perf_counter()
+            upload_partitioned_dataset(local_file, data_spec_cfg[file_type], storage)
+            upload_times[f"upload_{file_type}"] = time.perf_counter() - t_start
+            continue
+
+        output_key = get_month_key(data_spec_cfg[file_type], start_date)
+        t_start = time.perf_counter()
+        with Timer(enter_message=f"Uploading {file_type} data to {storage.url(output_key)}",
+                   exit_message=f"--> upload {file_type} complete", name=f"upload {file_type}",
+                   attributes=dict(file=storage.url(output_key), bytes=os.path.getsize(local_file))):
+            storage.upload(local_file, output_key)
+        upload_times[f"upload_{file_type}"] = time.perf_counter() - t_start
+    return upload_times
+
+
+def upload_partitioned_dataset(local_dir, this_data_cfg, storage, n_workers=DEFAULT_TRANSFER_WORKERS):
+    """
+    Uploads every file of a local partitioned dataset concurrently, keeping paths relative to the data spec's key_base
+
+    Args:
+        local_dir (str): Directory of the local dataset
+        this_data_cfg (dict): Data spec dictionary for partitioned parquet files
+        storage (Storage): Storage the dataset is written to
+        n_workers (int): Number of files uploaded concurrently
+    """
+    key_base = this_data_cfg.get("key_base", "")
+    files = {}
+    for root, _, filenames in os.walk(local_dir):
+        for filename in filenames:
+            local_file = os.path.join(root, filename)
+            files[local_file] = join_key(key_base, os.path.relpath(local_file, local_dir).replace(os.sep, "/"))
+
+    with Timer(enter_message=f"Uploading {len(files)} {PARTITIONED_FILE_TYPE} files to {storage.url(key_base)}",
+               exit_message=f"--> upload {PARTITIONED_FILE_TYPE} complete", name=f"upload {PARTITIONED_FILE_TYPE}",
+               attributes=dict(files=len(files), bytes=sum(os.path.getsize(f) for f in files))):
+        storage.upload_many(files, n_workers=n_workers)
+
+
+def run_pipeline(months, make_client, data_spec_cfg, storages, write_csv=True, write_parquet=True,
+                 page_size=DEFAULT_PAGE_SIZE, n_download_workers=DEFAULT_DOWNLOAD_WORKERS,
+                 n_upload_workers=DEFAULT_UPLOAD_WORKERS, queue_size=DEFAULT_QUEUE_SIZE, retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF, write_partitioned=False):
+    """
+    Downloads and uploads months of sales data using concurrent download and upload workers
+
+    Download workers write each month to a temporary directory and pass it to the upload workers through a bounded
+    queue, so downloads of later months overlap uploads of earlier ones while limiting how many downloaded months
+    wait on local disk.  Each month's download and upload are retried independently.
+
+    Args:
+        months (list): List of (start_date, end_date) tuples
+        make_client: Function that returns a new sodapy Socrata client.  Each download worker uses its own client
+        data_spec_cfg (dict): Data spec dictionary containing a spec for each file type
+        storages (dict): Map of {file_type: Storage} that each file type is written to
+        write_csv (bool): If True, writes csv files
+        write_parquet (bool): If True, writes parquet files
+        page_size (int): Number of records requested per page
+        n_download_workers (int): Number of months downloaded concurrently
+        n_upload_workers (int): Number of months uploaded concurrently
+        queue_size (int): Maximum number of downloaded months waiting to be uploaded
+        retries (int): Number of retries for each month's download and upload
+        backoff (float): Seconds waited before the first retry
+        write_partitioned (bool): If True, writes hive-style partitioned parquet datasets
+
+    Returns:
+        (tuple): (stage_times, failures), where stage_times is a map of {stage: [seconds, ...]} and failures is a map
+                 of {month: exception}
+    """
+    stage_times = defaultdict(list)
+    failures = {}
+
+    month_queue = queue.Queue()
+    for month in months:
+        month_queue.put(month)
+    upload_queue = queue.Queue(maxsize=queue_size)
+
+    def download_worker():
+        # Created with the first month so a failure to connect is reported as that month's failure
+        source_client = None
+        while True:
+            try:
+                start_date, end_date = month_queue.get_nowait()
+            except queue.Empty:
+                return
+            tmp_dir = tempfile.mkdtemp()
+            parquet_options = get_parquet_options(data_spec_cfg.get("parquet", {}))
+            partitioned_options = get_partitioned_options(data_spec_cfg.get(PARTITIONED_FILE_TYPE, {}))
+            try:
+                if source_client is None:
+                    source_client = make_client()
+                t_start = time.perf_counter()
+                local_files = with_retries(
+                    lambda: download_month(source_client, start_date, end_date, tmp_dir, write_csv=write_csv,
+                                           write_parquet=write_parquet, page_size=page_size,
+                                           parquet_options=parquet_options, write_partitioned=write_partitioned,
+                                           partitioned_options=partitioned_options),
+                    description=f"download of {start_date:%Y-%m}", retries=retries, backoff=backoff,
+                )
+                stage_times["download"].append(time.perf_counter() - t_start)
+                upload_queue.put((start_date, local_files, tmp_dir))
+            except Exception as e:
+                print(f"ERROR: download of {start_date:%Y-%m} failed: {e}")
+                failures[f"{start_date:%Y-%m}"] = e
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def upload_worker():
+        while True:
+            item = upload_queue.get()
+            if item is None:
+                return
+            start_date, local_files, tmp_dir = item
+            try:
+                upload_times = with_retries(
+                    lambda: upload_month(local_files, start_date, data_spec_cfg, storages),
+                    description=f"upload of {start_date:%Y-%m}", retries=retries, backoff=backoff,
+                )
+                # Only the attempt that succeeded is timed, so retries do not inflate the stage summary
+                for stage, seconds in upload_times.items():
+                    stage_times[stage].append(seconds)
+            except Exception as e:
+                print(f"ERROR: upload of {start_date:%Y-%m} failed: {e}")
+                failures[f"{start_date:%Y-%m}"] = e
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # Workers run in their own threads, so pass them the current span to keep their spans nested under it
+    download_threads = [threading.Thread(target=with_current_span(download_worker)) for _ in range(n_download_workers)]
+    upload_threads = [threading.Thread(target=with_current_span(upload_worker)) for _ in range(n_upload_workers)]
+    for t in download_threads + upload_threads:
+        t.start()
+
+    for t in download_threads:
+        t.join()
+    # All months downloaded.  Tell each upload worker to stop once the queue is drained
+    for _ in upload_threads:
+        upload_queue.put(None)
+    for t in upload_threads:
+        t.join()
+
+    return stage_times, failures
+
+
+def print_stage_summary(stage_times, wall_time):
+    """
+    Prints the total, mean and max time spent in each pipeline stage
+
+    Args:
+        stage_times (dict): Map of {stage: [seconds, ...]}
+        wall_time (float): Total elapsed time of the pipeline in seconds
+    """
+    print(f"Pipeline took {wall_time:.1f}s.  Time per stage:")
+    for stage, times in stage_times.items():
+        print(f"\t{stage:>15}: n={len(times):4d}, total={sum(times):8.1f}s, mean={sum(times) / len(times):6.1f}s, "
+              f"max={max(times):6.1f}s")
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Gets Iowa Liquor Sales data from API and stores to a bucket as "
                                                  "monthly files")
@@ -59,116 +596,140 @@ def parse_args():
     parser.add_argument(
         '--no_csv',
         action='store_true',
-        help='If set, will not output csv files to S3',
+        help='If set, will not output csv files',
     )
     parser.add_argument(
         '--no_pq',
         action='store_true',
-        help='If set, will not output parquet files to S3',
+        help='If set, will not output parquet files',
+    )
+    parser.add_argument(
+        '--partitioned',
+        action='store_true',
+        help=f'If set, also outputs a hive-style partitioned parquet dataset (eg: year=2018/month=3/day=5/) '
+             f'using the {PARTITIONED_FILE_TYPE} entry of the data spec',
     )
     parser.add_argument(
-        '--limit',
+        '--page_size',
         action='store',
-        default=DEFAULT_LIMIT,
-        help=f'Maximum number of records requested per month (default: {DEFAULT_LIMIT}'
+        type=int,
+        default=DEFAULT_PAGE_SIZE,
+        help=f'Number of records requested per API call.  Months of any size are downloaded in pages of this size '
+             f'(default: {DEFAULT_PAGE_SIZE})'
     )
     parser.add_argument(
-        '--action_on_limit',
+        '--download_workers',
         action='store',
-        default='raise',
-        help='Action if record limit reached for a given month.  Options are "raise" or "warn"'
+        type=int,
+        default=DEFAULT_DOWNLOAD_WORKERS,
+        help=f'Number of months downloaded concurrently (default: {DEFAULT_DOWNLOAD_WORKERS})'
+    )
+    parser.add_argument(
+        '--upload_workers',
+        action='store',
+        type=int,
+        default=DEFAULT_UPLOAD_WORKERS,
+        help=f'Number of months uploaded concurrently (default: {DEFAULT_UPLOAD_WORKERS})'
+    )
+    parser.add_argument(
+        '--queue_size',
+        action='store',
+        type=int,
+        default=DEFAULT_QUEUE_SIZE,
+        help=f'Maximum number of downloaded months waiting to be uploaded (default: {DEFAULT_QUEUE_SIZE})'
+    )
+    parser.add_argument(
+        '--retries',
+        action='store',
+        type=int,
+        default=DEFAULT_RETRIES,
+        help=f'Number of times a month\'s download or upload is retried, with exponential backoff '
+             f'(default: {DEFAULT_RETRIES})'
     )
 
+    parser.add_argument(
+        '--cache_dir',
+        action='store',
+        default=DEFAULT_CACHE_DIR,
+        help=f'Directory of the on-disk cache of API responses.  Repeated queries (eg: re-running a month to write a '
+             f'different output format) are read from the cache instead of the API (default: {DEFAULT_CACHE_DIR})'
+    )
+    parser.add_argument(
+        '--no_cache',
+        action='store_true',
+        help='If set, API responses are neither read from nor written to the cache',
+    )
+    parser.add_argument(
+        '--refresh',
+        action='store_true',
+        help='If set, all data is requested from the API even if cached.  Responses are still written to the cache',
+    )
+    parser.add_argument(
+        '--cache_ttl_days',
+        action='store',
+        type=float,
+        default=DEFAULT_CACHE_TTL_DAYS,
+        help=f'Age in days after which a cached response is requested again (default: {DEFAULT_CACHE_TTL_DAYS})'
+    )
+    parser.add_argument(
+        '--cache_max_size_gb',
+        action='store',
+        type=float,
+        default=DEFAULT_CACHE_MAX_SIZE_GB,
+        help=f'Maximum size of the cache in GB.  Least recently used responses are evicted beyond this '
+             f'(default: {DEFAULT_CACHE_MAX_SIZE_GB})'
+    )
+    add_tracing_arguments(parser)
+
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = parse_args()
 
+    start_tracing(Timer(name="get_sales_data", exit_message="--> get_sales_data complete"),
+                  trace_output=args.trace_output, metrics_output=args.metrics_output, trace_memory=args.trace_memory)
+
     start_date = pd.to_datetime(args.month_start)
     end_date = pd.to_datetime(args.month_end)
     download_dates = pd.date_range(start_date, end_date, freq='MS')
 
     secrets, data_cfg = load_settings()
 
-    source_client = Socrata("data.iowa.gov",
-                            secrets['socrata']['access_key']
-                            )
-
-    columns = [SALES_NAME_MAP_APP_TO_SOURCE[name] for name in staging_sales_columns]
-    select = ", ".join(columns)
-    limit = int(args.limit)
-    order = "date"
-    source_key = "m3tr-qhgy"
-
-    s3_additional_kwargs = dict(
-        aws_access_key_id=secrets['aws']['access_key'],
-        aws_secret_access_key=secrets['aws']['secret_key']
-    )
-
-    for start_date, end_date in zip(download_dates[:-1], download_dates[1:]):
-
-        start_date_formatted = start_date.strftime("%Y-%m")
-        end_date_formatted = end_date.strftime("%Y-%m")
-        where = f"date >= '{start_date_formatted}' AND date < '{end_date_formatted}'"
-        with Timer(enter_message=f"Downloading data where {where}", exit_message="--> download complete"):
-            results = source_client.get(source_key,
-                                        select=select,
-                                        order="date",
-                                        where=where,
-                                        limit=limit,
-                                        )
-
-        # Catch if we maxed our return limit
-        if len(results) == limit:
-            if args.action_on_limit == 'warn':
-                print("WARNING: dowload limit reached")
-            elif args.action_on_limit == 'raise':
-                raise ValueError("Error: Download limit reached")
-            else:
-                raise ValueError("Error: Download limit reached and invalid action_on_limit specified "
-                                 f"({args.action_on_limit})")
-        df = pd.DataFrame(results).rename(columns=SALES_NAME_MAP_SOURCE_TO_APP)
-        df['date'] = pd.to_datetime(df['date'], yearfirst=True)
-        url_template = f's3://{{bucket}}/{{key_base}}/{start_date.year:02d}/{start_date.month:02d}/{start_date.year:04d}-{start_date.month:02d}{{suffix}}'
-
-        # Order of returned columns is not guaranteed.  Reorder them to be how we originally specified
-        df = df[staging_sales_columns.keys()]
-
-        # Save to csv
-        if not args.no_csv:
-            this_data_cfg = data_cfg[args.data_spec]["csv"]
-            with Timer(enter_message=f"Uploading csv data", exit_message="--> upload csv complete"):
-                output_url = url_template.format(
-                    bucket=this_data_cfg["bucket"],
-                    key_base=this_data_cfg["key_base"],
-                    suffix=this_data_cfg["suffix"]
-                )
+    cache = None
+    if not args.no_cache:
+        cache = SocrataCache(cache_dir=args.cache_dir, ttl_days=args.cache_ttl_days,
+                             max_size_gb=args.cache_max_size_gb, refresh=args.refresh)
 
-                # Could partition this data further (daily files)
-                wr.s3.to_csv(
-                    df=df,
-                    path=output_url,
-                    s3_additional_kwargs=s3_additional_kwargs,
-                    index=False,  # Do not export empty index column
-                )
+    def make_client():
+        client = Socrata("data.iowa.gov",
+                         secrets['socrata']['access_key']
+                         )
+        if cache is not None:
+            client = CachedSocrataClient(client, cache)
+        return client
 
-        # Save to parquet
-        if not args.no_pq:
-            this_data_cfg = data_cfg[args.data_spec]["parquet"]
-            with Timer(enter_message=f"Uploading parquet data", exit_message="--> upload csv complete"):
-                output_url = url_template.format(
-                    bucket=this_data_cfg["bucket"],
-                    key_base=this_data_cfg["key_base"],
-                    suffix=this_data_cfg["suffix"]
-                )
+    data_spec_cfg = data_cfg[args.data_spec]
+    storages = {file_type: get_storage(this_data_cfg, secrets) for file_type, this_data_cfg in data_spec_cfg.items()}
 
-                # Could partition this data further (daily files)
-                wr.s3.to_parquet(
-                    df=df,
-                    path=output_url,
-                    s3_additional_kwargs=s3_additional_kwargs,
-                    # compression=this_data_cfd["compression"],  # psycopg2 does not support copy redshift from
-                    # compressed parquet
-                    index=False,  # Do not export empty index column
-                )
+    timer = Timer()
+    stage_times, failures = run_pipeline(
+        months=list(zip(download_dates[:-1], download_dates[1:])),
+        make_client=make_client,
+        data_spec_cfg=data_spec_cfg,
+        storages=storages,
+        write_csv=not args.no_csv,
+        write_parquet=not args.no_pq,
+        page_size=args.page_size,
+        n_download_workers=args.download_workers,
+        n_upload_workers=args.upload_workers,
+        queue_size=args.queue_size,
+        retries=args.retries,
+        write_partitioned=args.partitioned,
+    )
+    print_stage_summary(stage_times, timer.elapsed())
+    if cache is not None:
+        print(f"API response cache: {cache.hits} hits, {cache.misses} misses")
+
+    if failures:
+        raise ValueError(f"Failed to get data for {len(failures)} months: {sorted(failures)}")
@@ -0,0 +1,162 @@
+import json
+import re
+
+from sql_queries import explain_analyze_postgres, explain_postgres, explain_redshift, \
+    select_last_query_id_redshift, select_query_summary_redshift
+
+DEFAULT_MISESTIMATE_FACTOR = 10.0
+EXPLAIN_MODES = ["none", "plan", "analyze"]
+
+# Matches a node of a redshift text plan, eg: "->  XN Hash Join DS_DIST_ALL_NONE  (cost=0.00..1.00 rows=10 width=4)"
+REDSHIFT_NODE_PATTERN = re.compile(
+    r"XN (?P<node_type>[A-Za-z ]+?)(?: DS_\w+)?(?: on (?P<relation>\w+)(?: \w+)?)?\s+\(cost=\S+ rows=(?P<rows>\d+)"
+)
+
+
+def capture_plan(engine, q, db_type="postgres", analyze=True):
+    """
+    Captures the query plan for a query
+
+    On postgres this is EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON), or EXPLAIN (FORMAT JSON) if analyze is False.  On
+    redshift this is the text EXPLAIN plan, plus the rows of SVL_QUERY_SUMMARY from actually running the query if
+    analyze is True
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        q (str): Query
+        db_type (str): postgres or redshift
+        analyze (bool): If True, runs the query to capture actual execution statistics
+
+    Returns:
+        (dict): {"db_type": db_type, "plan": plan, "summary": list of summary steps (redshift analyze only)}
+    """
+    cur = engine.cursor()
+    captured = dict(db_type=db_type, plan=None, summary=None)
+    if db_type == "postgres":
+        template = explain_analyze_postgres if analyze else explain_postgres
+        cur.execute(template.format(query=q))
+        plan = cur.fetchone()[0]
+        # psycopg2 parses json results, but fall back in case the plan was returned as text
+        captured["plan"] = json.loads(plan) if isinstance(plan, str) else plan
+    elif db_type == "redshift":
+        cur.execute(explain_redshift.format(query=q))
+        captured["plan"] = [r[0] for r in cur.fetchall()]
+        if analyze:
+            cur.execute(q)
+            cur.execute(select_last_query_id_redshift)
+            query_id = cur.fetchone()[0]
+            cur.execute(select_query_summary_redshift, (query_id,))
+            columns = ["stm", "seg", "step", "label", "rows", "bytes", "is_diskbased"]
+            captured["summary"] = [dict(zip(columns, r)) for r in cur.fetchall()]
+    else:
+        raise ValueError(f"Unknown db_type {db_type}")
+    engine.commit()
+    return captured
+
+
+def _postgres_nodes(node):
+    """
+    Yields every node of a postgres json plan, depth first
+    """
+    yield node
+    for child in node.get("Plans", []):
+        yield from _postgres_nodes(child)
+
+
+def plan_nodes(captured):
+    """
+    Returns the nodes of a captured plan in a common format across postgres and redshift
+
+    Args:
+        captured (dict): Plan from capture_plan
+
+    Returns:
+        (list): List of {"node_type", "relation", "plan_rows", "actual_rows"} dicts.  actual_rows is None if the plan
+                was not analyzed
+    """
+    nodes = []
+    if captured["db_type"] == "postgres":
+        for node in _postgres_nodes(captured["plan"][0]["Plan"]):
+            nodes.append(dict(
+                node_type=node["Node Type"],
+                relation=node.get("Relation Name"),
+                plan_rows=node.get("Plan Rows"),
+                actual_rows=node.get("Actual Rows"),
+            ))
+    else:
+        for line in captured["plan"]:
+            match = REDSHIFT_NODE_PATTERN.search(line)
+            if match:
+                nodes.append(dict(
+                    node_type=match.group("node_type"),
+                    relation=match.group("relation"),
+                    plan_rows=int(match.group("rows")),
+                    actual_rows=None,
+                ))
+    return nodes
+
+
+def _seq_scans(nodes):
+    return {n["relation"] for n in nodes if "Seq Scan" in n["node_type"] and n["relation"]}
+
+
+def _join_strategies(nodes):
+    return sorted(n["node_type"] for n in nodes if "Join" in n["node_type"] or n["node_type"] == "Nested Loop")
+
+
+def _misestimates(nodes, factor):
+    """
+    Returns (node_type, relation, plan_rows, actual_rows) for nodes whose actual rows differ from the estimate by more
+    than factor in either direction
+    """
+    misestimates = []
+    for n in nodes:
+        if n["actual_rows"] is None or n["plan_rows"] is None:
+            continue
+        high = max(n["actual_rows"], n["plan_rows"])
+        low = max(min(n["actual_rows"], n["plan_rows"]), 1)
+        if high / low > factor:
+            misestimates.append((n["node_type"], n["relation"], n["plan_rows"], n["actual_rows"]))
+    return misestimates
+
+
+def compare_plans(baseline, current, misestimate_factor=DEFAULT_MISESTIMATE_FACTOR):
+    """
+    Compares a captured plan to a baseline, returning descriptions of any likely regressions
+
+    Flags sequential scans on relations that were not sequentially scanned in the baseline, any change in the join
+    strategies used, row estimates that are off by more than misestimate_factor and were not in the baseline, and (on
+    redshift) steps that spilled to disk and did not in the baseline
+
+    Args:
+        baseline (dict): Plan from capture_plan for the baseline
+        current (dict): Plan from capture_plan to check
+        misestimate_factor (float): Ratio between actual and estimated rows above which a node is flagged
+
+    Returns:
+        (list): List of str descriptions.  Empty if no regressions were found
+    """
+    flags = []
+    baseline_nodes = plan_nodes(baseline)
+    current_nodes = plan_nodes(current)
+
+    for relation in sorted(_seq_scans(current_nodes) - _seq_scans(baseline_nodes)):
+        flags.append(f"new sequential scan on {relation}")
+
+    baseline_joins = _join_strategies(baseline_nodes)
+    current_joins = _join_strategies(current_nodes)
+    if baseline_joins != current_joins:
+        flags.append(f"join strategy changed from {baseline_joins} to {current_joins}")
+
+    baseline_misestimates = {m[:2] for m in _misestimates(baseline_nodes, misestimate_factor)}
+    for node_type, relation, plan_rows, actual_rows in _misestimates(current_nodes, misestimate_factor):
+        if (node_type, relation) not in baseline_misestimates:
+            flags.append(f"row estimate blowup in {node_type}{' on ' + relation if relation else ''}: "
+                         f"estimated {plan_rows}, actual {actual_rows}")
+
+    baseline_spills = {s["label"] for s in (baseline.get("summary") or []) if s["is_diskbased"] in ("t", True)}
+    for step in current.get("summary") or []:
+        if step["is_diskbased"] in ("t", True) and step["label"] not in baseline_spills:
+            flags.append(f"step {step['label']} spilled to disk")
+
+    return flags
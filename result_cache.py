@@ -0,0 +1,159 @@
+import hashlib
+import json
+import re
+
+import pyarrow as pa
+
+from arrow_cache import ArrowDiskCache
+from export import iter_cursor_batches, DEFAULT_BATCH_SIZE
+from sql_queries import create_table_queries, create_olap_table_queries
+from utilities import get_table_versions
+
+DEFAULT_RESULT_CACHE_DIR = ".result_cache"
+DEFAULT_RESULT_CACHE_MAX_SIZE_GB = 1.0
+VERSIONS_METADATA_KEY = b"table_versions"
+
+# Tables the ETL records load versions for.  Cached results are invalidated when any of these they read is reloaded
+VERSIONED_TABLES = list(create_table_queries) + list(create_olap_table_queries)
+
+# Matches quoted strings and identifiers, which are left untouched when normalizing a query
+QUOTED_PATTERN = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+
+def normalize_query(q):
+    """
+    Returns a query with whitespace collapsed, keywords and unquoted identifiers lowercased and any trailing semicolon
+    removed, so queries that differ only in formatting share a cache entry
+
+    Quoted strings and identifiers are left as is
+
+    Args:
+        q (str): Query
+
+    Returns:
+        (str)
+    """
+    parts = QUOTED_PATTERN.split(q.strip().rstrip(";"))
+    # split with a capturing group puts the quoted parts at odd indices
+    return "".join(part if i % 2 else re.sub(r"\s+", " ", part).lower() for i, part in enumerate(parts)).strip()
+
+
+def get_query_tables(q):
+    """
+    Returns the versioned tables a query reads from
+
+    Tables are found by name, so a column or alias that shares a table's name also counts.  This only ever
+    invalidates a result more often than necessary, never less
+
+    Args:
+        q (str): Query
+
+    Returns:
+        (list): Sorted list of table names
+    """
+    normalized = normalize_query(q)
+    return sorted(t for t in VERSIONED_TABLES if re.search(rf"\b{t}\b", normalized))
+
+
+class ResultCache(ArrowDiskCache):
+    def __init__(self, cache_dir=DEFAULT_RESULT_CACHE_DIR, max_size_gb=DEFAULT_RESULT_CACHE_MAX_SIZE_GB,
+                 ttl_days=None):
+        """
+        On-disk cache of query results, invalidated whenever the ETL reloads a table the query reads from.
+
+        Each result is stored as a zstd compressed Arrow IPC file named by a hash of the normalized query and its
+        parameters, along with the load version (see utilities.record_table_versions) of every table the query reads.
+        A cached result is only returned if those versions are still current, otherwise it is removed and the query
+        is run again.  The least recently used entries are evicted whenever the cache grows beyond max_size_gb.
+
+        Args:
+            cache_dir (str): Directory of the cache
+            max_size_gb (float): Maximum total size of the cache in GB.  If None, the cache is never evicted
+            ttl_days (float): (optional) Age in days after which an entry is treated as missing even if its tables
+                              have not been reloaded.  If None, entries never expire
+        """
+        super().__init__(cache_dir, ttl_days=ttl_days, max_size_gb=max_size_gb)
+
+    @staticmethod
+    def get_key(q, params=None):
+        """
+        Returns the content address of a query and its parameters
+
+        Returns:
+            (str): sha256 hex digest
+        """
+        query = dict(query=normalize_query(q), params=params)
+        return hashlib.sha256(json.dumps(query, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, q, params=None, versions=None):
+        """
+        Returns the cached result of a query, or None if it is not cached, has expired, or any table it reads has been
+        reloaded since it was cached
+
+        Args:
+            q (str): Query
+            params (dict): Query parameters, or None
+            versions (dict): Map of {table_name: current load version} for the tables the query reads
+
+        Returns:
+            (pa.Table)
+        """
+        key = self.get_key(q, params)
+        table = self.read(key)
+        cached_versions = None if table is None else (table.schema.metadata or {}).get(VERSIONS_METADATA_KEY)
+        if table is not None and cached_versions != _encode_versions(versions):
+            self.remove(key)
+            table = None
+
+        self._count(table is not None)
+        if table is None:
+            return None
+        return table.replace_schema_metadata(None)
+
+    def put(self, q, params, versions, table):
+        """
+        Writes the result of a query to the cache, then evicts entries if the cache is too large
+
+        Args:
+            q (str): Query
+            params (dict): Query parameters, or None
+            versions (dict): Map of {table_name: load version} for the tables the query reads, as of before the query
+                             was run
+            table (pa.Table): Result of the query
+        """
+        table = table.replace_schema_metadata({VERSIONS_METADATA_KEY: _encode_versions(versions)})
+        self.write(self.get_key(q, params), table)
+
+
+def _encode_versions(versions):
+    return json.dumps(versions or {}, sort_keys=True).encode()
+
+
+def run_cached_query(engine, q, params=None, cache=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Returns the result of a query, from the cache if it is still valid, otherwise by running the query and caching
+    the result
+
+    Table versions are read before the query is run, so a load that finishes while the query is running leaves the
+    cached result marked with the older version and it is run again on the next call
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        q (str): Query
+        params (dict): Query parameters, or None
+        cache (ResultCache): Cache of query results.  If None, uses a ResultCache with default settings
+        batch_size (int): Rows fetched at a time when the query is run
+
+    Returns:
+        (pa.Table)
+    """
+    cache = cache or ResultCache()
+    current_versions = get_table_versions(engine)
+    versions = {t: current_versions.get(t) for t in get_query_tables(q)}
+
+    table = cache.get(q, params, versions)
+    if table is None:
+        table = pa.concat_tables(iter_cursor_batches(engine, q, params, batch_size=batch_size,
+                                                     cursor_name="result_cache"))
+        cache.put(q, params, versions, table)
+    return table
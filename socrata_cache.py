@@ -0,0 +1,113 @@
+import hashlib
+import json
+
+import pyarrow as pa
+
+from arrow_cache import ArrowDiskCache
+from utilities import get_logger
+
+DEFAULT_CACHE_DIR = ".socrata_cache"
+DEFAULT_CACHE_TTL_DAYS = 30.0
+DEFAULT_CACHE_MAX_SIZE_GB = 5.0
+
+logger = get_logger(name=__file__)
+
+
+class SocrataCache(ArrowDiskCache):
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttl_days=DEFAULT_CACHE_TTL_DAYS,
+                 max_size_gb=DEFAULT_CACHE_MAX_SIZE_GB, refresh=False):
+        """
+        On-disk cache of Socrata query results, shared by any number of CachedSocrataClient objects.
+
+        Each result is stored as a zstd compressed Arrow IPC file named by a hash of the query (domain, dataset and
+        every query parameter, including the page), so a repeated query is answered without a request.  Entries older
+        than ttl_days are treated as missing, and the least recently used entries are evicted whenever the cache
+        grows beyond max_size_gb.  Safe to use from multiple threads.
+
+        Args:
+            cache_dir (str): Directory of the cache
+            ttl_days (float): Age in days after which an entry is fetched again.  If None, entries never expire
+            max_size_gb (float): Maximum total size of the cache in GB.  If None, the cache is never evicted
+            refresh (bool): If True, cached entries are never read, but results are still written to the cache
+        """
+        super().__init__(cache_dir, ttl_days=ttl_days, max_size_gb=max_size_gb)
+        self.refresh = refresh
+
+    @staticmethod
+    def get_key(domain, dataset, **kwargs):
+        """
+        Returns the content address of a query
+
+        Returns:
+            (str): sha256 hex digest
+        """
+        query = dict(domain=domain, dataset=dataset, **kwargs)
+        return hashlib.sha256(json.dumps(query, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached results of a query, or None if they are not cached, expired, or refresh is set
+
+        Args:
+            key (str): Key from get_key
+
+        Returns:
+            (list): List of records (dicts), as returned by sodapy
+        """
+        table = None if self.refresh else self.read(key)
+        self._count(table is not None)
+        if table is None:
+            return None
+
+        # Socrata omits null fields from records, so drop them to return exactly what was originally received
+        return [{k: v for k, v in row.items() if v is not None} for row in table.to_pylist()]
+
+    def put(self, key, results):
+        """
+        Writes the results of a query to the cache, then evicts entries if the cache is too large
+
+        Args:
+            key (str): Key from get_key
+            results (list): List of records (dicts), as returned by sodapy
+        """
+        # Records only include the fields they have values for, so collect every field in order of appearance
+        columns = list(dict.fromkeys(k for row in results for k in row))
+        table = pa.table({c: pa.array([row.get(c) for row in results]) for c in columns})
+        self.write(key, table)
+
+
+class CachedSocrataClient:
+    def __init__(self, client, cache):
+        """
+        Wraps a sodapy Socrata client so results of get are read from and written to a SocrataCache.
+
+        Args:
+            client: sodapy Socrata client
+            cache (SocrataCache): Cache of query results
+        """
+        self.client = client
+        self.cache = cache
+
+    def get(self, dataset, **kwargs):
+        """
+        Returns the results of a query from the cache if available, otherwise from Socrata
+
+        Results that cannot be cached (eg: a field with values of mixed types that arrow cannot convert) are logged and
+        returned uncached
+
+        Args:
+            dataset (str): Socrata dataset identifier
+            kwargs: Query parameters passed to the client's get (select, where, order, limit, offset, ...)
+
+        Returns:
+            (list): List of records (dicts)
+        """
+        key = self.cache.get_key(getattr(self.client, "domain", None), dataset, **kwargs)
+        results = self.cache.get(key)
+        if results is None:
+            results = self.client.get(dataset, **kwargs)
+            try:
+                self.cache.put(key, results)
+            except (pa.ArrowException, OSError) as e:
+                logger.warning(f"Could not cache results of {dataset} {kwargs}: {e}")
+        return results
@@ -1,3 +1,5 @@
+import re
+
 invoices = "invoices"
 items = "items"
 population = "population"
@@ -5,6 +7,7 @@ product_categories = "product_categories"
 stores = "stores"
 weather = "weather"
 weather_stations = "weather_stations"
+store_weather_station = "store_weather_station"
 
 staging_sales = "staging_sales"
 staging_weather = f"staging_{weather}"
@@ -14,10 +17,40 @@ olap_sales_weather_population = f"fact_sales_{weather}_{population}"
 olap_monthly_sales_store = f"fact_monthly_sales_store"
 olap_daily_sales_by_category = f"fact_daily_sales_by_category"
 
+# Primary key of each production table.  Used to build create statements and incremental merges
+primary_keys = {
+    invoices: ["invoice_id"],
+    items: ["item_id"],
+    population: ["year", "zipcode"],
+    product_categories: ["category_id"],
+    stores: ["store_id"],
+    weather: ["station_id", "date"],
+    weather_stations: ["station_id"],
+    store_weather_station: ["store_id"],
+}
+
+# Dimensions built from staged sales keep the date of the latest sale they were seen in.  Merges only replace a row with
+# one seen on the same or a later date, so re-staging an older month does not bring back an older store/item name
+last_seen_date = "last_seen_date"
+last_seen_tables = [product_categories, items, stores]
+
+# Primary keys of the tables that differ when postgres partitioning is enabled (see partitioned_tables_postgres), as a
+# primary key on a range partitioned table must include the partition key.  Used for the create statements and merge
+# conflict targets of partitioned databases only
+partitioned_primary_keys_postgres = {
+    **primary_keys,
+    invoices: primary_keys[invoices] + ["date"],
+}
+
 count_rows = """
 SELECT COUNT(*) from {table_name}
 """
 
+# Existence check that stops at the first row rather than scanning the whole table
+select_any_row = """
+SELECT 1 FROM {table_name} LIMIT 1
+"""
+
 drop = """
 DROP TABLE IF EXISTS {table_name} CASCADE
 """
@@ -30,6 +63,7 @@ drop_product_categories = drop.format(table_name=product_categories)
 drop_stores = drop.format(table_name=stores)
 drop_weather = drop.format(table_name=weather)
 drop_weather_stations = drop.format(table_name=weather_stations)
+drop_store_weather_station = drop.format(table_name=store_weather_station)
 
 drop_olap_sales_weather_population = drop.format(table_name=olap_sales_weather_population)
 drop_olap_monthly_sales_store = drop.format(table_name=olap_monthly_sales_store)
@@ -116,25 +150,28 @@ invoices_columns = {
     "total_sale": "DECIMAL(9,3) NOT NULL",
 }
 
-create_invoices = f"""
+# Format with primary_key
+_create_invoices = f"""
 CREATE TABLE {invoices} (
   {", ".join(f"{name} {spec}" for name, spec in invoices_columns.items())},
-  PRIMARY KEY (invoice_id),
+  PRIMARY KEY ({{primary_key}}),
   FOREIGN KEY (store_id) REFERENCES {stores},
   FOREIGN KEY (item_id) REFERENCES {items}
 )
 """
+create_invoices = _create_invoices.format(primary_key=", ".join(primary_keys[invoices]))
 
 stores_columns = {
     "store_id": "VARCHAR(4) NOT NULL",
     "store_name": "VARCHAR(50) NOT NULL",
     "zipcode": "VARCHAR(5)",
+    last_seen_date: "DATE NOT NULL",
 }
 
 create_stores = f"""
 CREATE TABLE {stores} (
   {", ".join(f"{name} {spec}" for name, spec in stores_columns.items())},
-  PRIMARY KEY (store_id)
+  PRIMARY KEY ({", ".join(primary_keys[stores])})
 )
 """
 
@@ -143,12 +180,13 @@ items_columns = {
     "item_description": "VARCHAR(70) NOT NULL",
     "category_id": "VARCHAR(7)",
     "vendor_id": "VARCHAR(3)",
+    last_seen_date: "DATE NOT NULL",
 }
 
 create_items = f"""
 CREATE TABLE {items} (
   {", ".join(f"{name} {spec}" for name, spec in items_columns.items())},
-  PRIMARY KEY (item_id),
+  PRIMARY KEY ({", ".join(primary_keys[items])}),
   FOREIGN KEY (category_id) REFERENCES {product_categories}
 )
 """
@@ -156,12 +194,13 @@ CREATE TABLE {items} (
 product_categories_columns = {
     "category_id": "VARCHAR(7) NOT NULL",
     "category_name": "VARCHAR(50)",
+    last_seen_date: "DATE NOT NULL",
 }
 
 create_product_categories = f"""
 CREATE TABLE {product_categories} (
   {", ".join(f"{name} {spec}" for name, spec in product_categories_columns.items())},
-  PRIMARY KEY (category_id)
+  PRIMARY KEY ({", ".join(primary_keys[product_categories])})
 )
 """
 
@@ -177,7 +216,7 @@ weather_columns = {
 create_weather = f"""
 CREATE TABLE {weather} (
   {", ".join(f"{name} {spec}" for name, spec in weather_columns.items())},
-  PRIMARY KEY (station_id, date),
+  PRIMARY KEY ({", ".join(primary_keys[weather])}),
   FOREIGN KEY (station_id) REFERENCES {weather_stations}
 )
 """
@@ -193,7 +232,23 @@ weather_stations_columns = {
 create_weather_stations = f"""
 CREATE TABLE {weather_stations} (
   {", ".join(f"{name} {spec}" for name, spec in weather_stations_columns.items())},
-  PRIMARY KEY (station_id)
+  PRIMARY KEY ({", ".join(primary_keys[weather_stations])})
+)
+"""
+
+# Bridge from each store to the weather station used for it, computed by the ETL after stores and weather are loaded
+store_weather_station_columns = {
+    "store_id": "VARCHAR(4) NOT NULL",
+    "station_id": "VARCHAR(11) NOT NULL",
+    "distance_miles": "REAL NOT NULL",
+}
+
+create_store_weather_station = f"""
+CREATE TABLE {store_weather_station} (
+  {", ".join(f"{name} {spec}" for name, spec in store_weather_station_columns.items())},
+  PRIMARY KEY ({", ".join(primary_keys[store_weather_station])}),
+  FOREIGN KEY (store_id) REFERENCES {stores},
+  FOREIGN KEY (station_id) REFERENCES {weather_stations}
 )
 """
 
@@ -206,7 +261,7 @@ population_columns = {
 create_population = f"""
 CREATE TABLE {population} (
   {", ".join(f"{name} {spec}" for name, spec in population_columns.items())},
-  PRIMARY KEY (year, zipcode)
+  PRIMARY KEY ({", ".join(primary_keys[population])})
 )
 """
 
@@ -221,14 +276,16 @@ olap_sales_weather_population_columns = {
     "population": "INTEGER",
 }
 
-create_olap_sales_weather_population = f"""
+# Format with primary_key
+_create_olap_sales_weather_population = f"""
 CREATE TABLE {olap_sales_weather_population} (
       {", ".join(f"{name} {spec}" for name, spec in olap_sales_weather_population_columns.items())},
-  PRIMARY KEY (invoice_id),
+  PRIMARY KEY ({{primary_key}}),
   FOREIGN KEY (category_id) REFERENCES {product_categories},
   FOREIGN KEY (store_id) REFERENCES {stores}
 )
 """
+create_olap_sales_weather_population = _create_olap_sales_weather_population.format(primary_key="invoice_id")
 
 olap_monthly_sales_store_columns = {
     "year": "INTEGER",
@@ -269,10 +326,23 @@ SELECT aws_s3.table_import_from_s3(
 )
 """
 
+# Matches the row count in the message returned by aws_s3.table_import_from_s3
+table_import_rows_pattern = re.compile(r"(\d+) rows imported")
+
 load_staging_sales_postgres = load_staging_postgres.format(table_name=staging_sales)
 load_staging_weather_postgres = load_staging_postgres.format(table_name=staging_weather)
 load_staging_population_postgres = load_staging_postgres.format(table_name=staging_population)
 
+# Client-side staging for postgres without the aws_s3 extension.  File contents are streamed to the server over the
+# connection with copy_expert
+copy_staging_stdin_postgres = """
+COPY {table_name} FROM STDIN WITH {{source_format}}
+"""
+
+copy_staging_sales_stdin_postgres = copy_staging_stdin_postgres.format(table_name=staging_sales)
+copy_staging_weather_stdin_postgres = copy_staging_stdin_postgres.format(table_name=staging_weather)
+copy_staging_population_stdin_postgres = copy_staging_stdin_postgres.format(table_name=staging_population)
+
 load_staging_redshift = """
 COPY {table_name} 
 FROM 's3://{{bucket}}/{{key}}' 
@@ -285,6 +355,33 @@ load_staging_sales_redshift = load_staging_redshift.format(table_name=staging_sa
 load_staging_weather_redshift = load_staging_redshift.format(table_name=staging_weather)
 load_staging_population_redshift = load_staging_redshift.format(table_name=staging_population)
 
+# Single COPY of every file listed in a manifest, letting redshift split the load across all slices
+load_staging_manifest_redshift = """
+COPY {table_name} 
+FROM 's3://{{bucket}}/{{manifest_key}}' 
+IAM_ROLE '{{iam}}' 
+{{source_format}} 
+MANIFEST
+COMPUPDATE OFF STATUPDATE OFF
+"""
+
+load_staging_sales_manifest_redshift = load_staging_manifest_redshift.format(table_name=staging_sales)
+load_staging_weather_manifest_redshift = load_staging_manifest_redshift.format(table_name=staging_weather)
+load_staging_population_manifest_redshift = load_staging_manifest_redshift.format(table_name=staging_population)
+
+# Rows loaded per file by the most recent COPY in this session
+select_last_copy_count_redshift = """
+SELECT pg_last_copy_count()
+"""
+
+select_last_copy_rows_by_file = """
+SELECT TRIM(filename), SUM(lines_scanned)
+FROM stl_load_commits
+WHERE query = pg_last_copy_id()
+GROUP BY filename
+ORDER BY filename
+"""
+
 # Query template to get a distinct row for each group that is generic across postgres and redshift
 select_distinct = """
 WITH cte AS
@@ -300,158 +397,293 @@ FROM cte
 WHERE row_number = 1
 """
 
-# Query template for inserting distinct rows for each group that is generic across postgres and redshift
-insert_distinct = f"""
-INSERT INTO {{table_name}} (
-{select_distinct}
-)
+# Postgres only alternative to select_distinct.  DISTINCT ON keeps the first row of each group in sort order without
+# computing then filtering on a window function.  Wrapped so the same filters can be appended as for select_distinct
+select_distinct_on_postgres = """
+SELECT
+    {columns}
+FROM (
+    SELECT DISTINCT ON ({partition_by})
+        {columns}
+    FROM {source_table}
+    ORDER BY {partition_by}, {order_by}
+) distinct_rows
+WHERE TRUE
 """
 
-insert_stores = insert_distinct.format(
-    table_name=stores,
-    columns=", ".join(stores_columns),
-    partition_by="store_id",
-    order_by="date DESC",
-    source_table=staging_sales
-)
+# Latest-by-key dedup: a single aggregate over staged sales reduces them to one row per distinct combination of
+# store/item/category attributes along with the latest date that combination was seen.  These dimensions are then
+# deduplicated from this much smaller table rather than each sorting all of staging.  This is a regular rather than
+# temporary table so that it is visible to inserts running on other connections
+staging_sales_dimensions = "staging_sales_dimensions"
 
-insert_items = insert_distinct.format(
-    table_name=items,
-    columns=", ".join(items_columns),
-    partition_by="item_id",
-    order_by="date DESC",
-    source_table=staging_sales
-)
+staging_sales_dimensions_columns = [
+    "store_id", "store_name", "zipcode", "item_id", "item_description", "category_id", "category_name", "vendor_id"
+]
+
+create_staging_sales_dimensions = f"""
+CREATE TABLE {staging_sales_dimensions} AS
+SELECT
+    {", ".join(staging_sales_dimensions_columns)},
+    MAX(date) AS date
+FROM {staging_sales}
+GROUP BY {", ".join(staging_sales_dimensions_columns)}
+"""
+
+drop_staging_sales_dimensions = drop.format(table_name=staging_sales_dimensions)
 
 # Handle product_categories differently so we ensure we get no null category id's
-insert_product_categories = f"""
-INSERT INTO {{table_name}} (
-{select_distinct} AND category_id IS NOT NULL
-)
-""".format(
-    table_name=product_categories,
-    columns=", ".join(product_categories_columns),
-    partition_by="category_id",
-    order_by="date DESC",
-    source_table=staging_sales
-)
+product_categories_filter = " AND category_id IS NOT NULL"
 
 # Handle invoices differently so we ensure we get no null price/bottle
-insert_invoices = f"""
-INSERT INTO {{table_name}} (
-{select_distinct} 
+invoices_filter = """
 AND bottle_cost IS NOT NULL
 AND bottle_retail IS NOT NULL
 AND bottles_sold IS NOT NULL
 AND total_sale IS NOT NULL
-)
-""".format(
-    table_name=invoices,
-    columns=", ".join(invoices_columns),
-    partition_by="invoice_id",
-    order_by="date DESC",
-    source_table=staging_sales
-)
+"""
 
 this_weather_stations_columns = [x for x in weather_stations_columns.keys() if x != "zipcode"]
 
-insert_weather_stations = insert_distinct.format(
-    table_name=weather_stations,
-    columns=", ".join(this_weather_stations_columns),
-    partition_by="station_id",
-    order_by="date DESC",
-    source_table=staging_weather
-)
-
 # Use NULLIF to catch blank strings as null.  Postgres does not need this, but without it redshift will raise type error
 # on cast
-insert_weather = f"""
-INSERT INTO {weather} (
+select_staged_weather = f"""
     SELECT 
-        CAST (station_id as VARCHAR),
-        CAST (date as DATE),
-        CAST (NULLIF(precipitation, '') as DECIMAL),
-        CAST (NULLIF(snowfall, '') as DECIMAL),
-        CAST (NULLIF(temperature_max, '') as INTEGER),
-        CAST (NULLIF(temperature_min, '') as INTEGER)
+        CAST (station_id as VARCHAR) as station_id,
+        CAST (date as DATE) as date,
+        CAST (NULLIF(precipitation, '') as DECIMAL) as precipitation,
+        CAST (NULLIF(snowfall, '') as DECIMAL) as snowfall,
+        CAST (NULLIF(temperature_max, '') as INTEGER) as temperature_max,
+        CAST (NULLIF(temperature_min, '') as INTEGER) as temperature_min
     FROM {staging_weather}
-)
 """
 
 # Use NULLIF to catch blank strings as null.  Postgres does not need this, but without it redshift will not see any
 # null gender fields
-insert_population = f"""
-INSERT INTO {population} (
+select_staged_population = f"""
     SELECT 
         {", ".join(population_columns)}
     FROM {staging_population}
     WHERE minimum_age IS NULL
       AND maximum_age IS NULL 
       AND NULLIF(gender, '') IS NULL
+"""
+
+
+def _get_staged_table_selects(distinct_template, sales_dimensions_source=staging_sales):
+    """
+    Returns the selects from staging that produce the rows of each production table, with the columns they populate
+
+    Args:
+        distinct_template (str): Template used to get the latest row for each key, eg: select_distinct
+        sales_dimensions_source (str): Table stores, items and product_categories are deduplicated from
+
+    Returns:
+        (dict): {table_name: (columns, select)}
+    """
+    def distinct(columns, partition_by, source_table):
+        return distinct_template.format(columns=", ".join(columns), partition_by=partition_by, order_by="date DESC",
+                                        source_table=source_table)
+
+    # Dimension rows are last seen on the date of the staged sale they are taken from
+    dimensions_source = f"(SELECT *, date AS {last_seen_date} FROM {sales_dimensions_source}) seen"
+
+    return {
+        product_categories: (list(product_categories_columns),
+                             distinct(product_categories_columns, "category_id", dimensions_source)
+                             + product_categories_filter),
+        items: (list(items_columns), distinct(items_columns, "item_id", dimensions_source)),
+        stores: (list(stores_columns), distinct(stores_columns, "store_id", dimensions_source)),
+        invoices: (list(invoices_columns), distinct(invoices_columns, "invoice_id", staging_sales) + invoices_filter),
+        weather_stations: (this_weather_stations_columns,
+                           distinct(this_weather_stations_columns, "station_id", staging_weather)),
+        weather: (list(weather_columns), select_staged_weather),
+        population: (list(population_columns), select_staged_population),
+    }
+
+
+# Strategies for deduplicating staged rows when building production tables:
+#   row_number: ROW_NUMBER() window over staging for each table.  Generic across postgres and redshift
+#   distinct_on: DISTINCT ON over staging for each table.  Postgres only
+#   latest_by_key: stores, items and product_categories from staging_sales_dimensions, others as row_number
+staged_table_selects_by_dedup = {
+    "row_number": _get_staged_table_selects(select_distinct),
+    "distinct_on": _get_staged_table_selects(select_distinct_on_postgres),
+    "latest_by_key": _get_staged_table_selects(select_distinct, sales_dimensions_source=staging_sales_dimensions),
+}
+
+staged_table_selects = staged_table_selects_by_dedup["row_number"]
+
+# Queries run before and after the inserts/merges of a dedup strategy
+dedup_setup_queries = {
+    "latest_by_key": [drop_staging_sales_dimensions, create_staging_sales_dimensions],
+}
+
+dedup_cleanup_queries = {
+    "latest_by_key": [drop_staging_sales_dimensions],
+}
+
+# Query template for inserting the result of a select that is generic across postgres and redshift
+insert_select = """
+INSERT INTO {table_name} ({columns}) (
+{select}
+)
+"""
+
+# Query template for merging the result of a select into a table on postgres.  Rows with an existing primary key are
+# updated to the newly staged values, unless condition (eg: the staged row was last seen earlier) excludes them
+upsert_select_postgres = """
+INSERT INTO {table_name} ({columns}) (
+{select}
 )
+ON CONFLICT ({primary_key}) DO UPDATE SET
+    {updates}{condition}
 """
 
+# Redshift has no ON CONFLICT, so merge by deleting any rows being replaced and inserting the new ones.  Redshift does
+# not enforce foreign keys so the delete does not conflict with referencing tables
+upsert_select_redshift = """
+DELETE FROM {table_name} USING (
+{select}
+) new
+WHERE {key_match};
+INSERT INTO {table_name} ({columns}) (
+{select}
+)
+"""
+
+# As upsert_select_redshift for tables in last_seen_tables.  Only rows seen on the same or a later date than the
+# existing row are replaced, and as redshift does not enforce primary keys, rows are only inserted where no row with
+# their key remains
+upsert_select_last_seen_redshift = """
+DELETE FROM {table_name} USING (
+{select}
+) new
+WHERE {key_match}
+  AND new.{last_seen_date} >= {table_name}.{last_seen_date};
+INSERT INTO {table_name} ({columns})
+SELECT {columns} FROM (
+{select}
+) new
+WHERE NOT EXISTS (
+    SELECT 1 FROM {table_name} WHERE {key_match}
+)
+"""
+
+
+def _insert_query(table_name, selects=staged_table_selects):
+    columns, select = selects[table_name]
+    return insert_select.format(table_name=table_name, columns=", ".join(columns), select=select)
+
+
+def _upsert_query_postgres(table_name, selects=staged_table_selects, keys=None):
+    columns, select = selects[table_name]
+    primary_key = (keys or primary_keys)[table_name]
+    updates = [f"{c} = EXCLUDED.{c}" for c in columns if c not in primary_key]
+    condition = ""
+    if table_name in last_seen_tables:
+        condition = f"\nWHERE EXCLUDED.{last_seen_date} >= {table_name}.{last_seen_date}"
+    return upsert_select_postgres.format(
+        table_name=table_name,
+        columns=", ".join(columns),
+        select=select,
+        primary_key=", ".join(primary_key),
+        updates=",\n    ".join(updates),
+        condition=condition,
+    )
+
+
+def _upsert_query_redshift(table_name, selects=staged_table_selects):
+    columns, select = selects[table_name]
+    template = upsert_select_last_seen_redshift if table_name in last_seen_tables else upsert_select_redshift
+    return template.format(
+        table_name=table_name,
+        columns=", ".join(columns),
+        select=select,
+        key_match=" AND ".join(f"{table_name}.{k} = new.{k}" for k in primary_keys[table_name]),
+        last_seen_date=last_seen_date,
+    )
+
+
+insert_product_categories = _insert_query(product_categories)
+insert_items = _insert_query(items)
+insert_stores = _insert_query(stores)
+insert_invoices = _insert_query(invoices)
+insert_weather_stations = _insert_query(weather_stations)
+insert_weather = _insert_query(weather)
+insert_population = _insert_query(population)
+
 select_popoulation_by_year = f"""
 SELECT * FROM {population} WHERE year = {{year}}
 """
 
-select_oltp_sales_weather_population = f"""
+# Template for the OLTP sales/weather/population select.  date_filter is used to restrict to a range of invoice dates
+_select_oltp_sales_weather_population = f"""
 SELECT 
-    t.invoice_id as invoice_id,
-    t.date as date,
-    t.category_id as category_id,
-    t.store_id as store_id,
-    t.total_sale as total_sale,
-    t.precipitation as precipitation,
-    t.snowfall as snowfall,
-    t.population as population
-FROM (
-    SELECT 
-        inv.invoice_id,
-        inv.date,
-        it.category_id,
-        s.store_id,
-        inv.total_sale,
-        w.precipitation,
-        w.snowfall,
-        p.population,
-        row_number() over (partition by ws.zipcode, inv.invoice_id
-                           order by ws.station_id) as rn
-    FROM {invoices} inv
-    JOIN {stores} s ON (s.store_id = inv.store_id)
-    JOIN {items} it ON (it.item_id = inv.item_id)
-    JOIN {weather_stations} ws ON (ws.zipcode = s.zipcode)
-    JOIN {weather} w ON w.station_id = ws.station_id AND w.date = inv.date
-    JOIN ({select_popoulation_by_year.format(year=2010)}) p ON p.zipcode = s.zipcode
-    WHERE it.category_id IS NOT NULL
-    ORDER BY ws.zipcode, ws.station_id, inv.invoice_id
-) t
-WHERE rn = 1
-"""
-
-select_oltp_sales_weather_population_for_year = select_oltp_sales_weather_population + " and EXTRACT (YEAR FROM t.date) = {year}"
-
-select_oltp_monthly_sales_store = f"""
+    inv.invoice_id as invoice_id,
+    inv.date as date,
+    it.category_id as category_id,
+    s.store_id as store_id,
+    inv.total_sale as total_sale,
+    w.precipitation as precipitation,
+    w.snowfall as snowfall,
+    p.population as population
+FROM {invoices} inv
+JOIN {stores} s ON (s.store_id = inv.store_id)
+JOIN {items} it ON (it.item_id = inv.item_id)
+JOIN {store_weather_station} sws ON (sws.store_id = inv.store_id)
+JOIN {weather} w ON w.station_id = sws.station_id AND w.date = inv.date
+JOIN ({select_popoulation_by_year.format(year=2010)}) p ON p.zipcode = s.zipcode
+WHERE it.category_id IS NOT NULL{{date_filter}}
+"""
+
+# Filter applied to invoices when refreshing a partition of an OLAP table.  Uses psycopg2 parameters
+invoice_date_range_filter = "inv.date >= %(date_start)s AND inv.date < %(date_end)s"
+
+select_oltp_sales_weather_population = _select_oltp_sales_weather_population.format(date_filter="")
+select_oltp_sales_weather_population_for_date_range = _select_oltp_sales_weather_population.format(
+    date_filter=f"\n  AND {invoice_date_range_filter}"
+)
+
+# Year filters are written as date ranges rather than EXTRACT(YEAR FROM date) so they can use indexes and prune
+# partitions.  Format with year and next_year
+year_date_range_filter = "{alias}date >= DATE '{{year}}-01-01' AND {alias}date < DATE '{{next_year}}-01-01'"
+
+select_oltp_sales_weather_population_for_year = _select_oltp_sales_weather_population.format(
+    date_filter=f"\n  AND {year_date_range_filter.format(alias='inv.')}"
+)
+
+_select_oltp_monthly_sales_store = f"""
 SELECT
     EXTRACT (YEAR FROM inv.date) as year,
     EXTRACT (MONTH FROM inv.date) as month, 
     inv.store_id,
     SUM(inv.total_sale)
-FROM invoices inv
+FROM invoices inv{{date_filter}}
 GROUP BY year, month, inv.store_id
 """
 
-select_oltp_daily_sales_by_category = f"""
+select_oltp_monthly_sales_store = _select_oltp_monthly_sales_store.format(date_filter="")
+select_oltp_monthly_sales_store_for_date_range = _select_oltp_monthly_sales_store.format(
+    date_filter=f"\nWHERE {invoice_date_range_filter}"
+)
+
+_select_oltp_daily_sales_by_category = f"""
 SELECT
     inv.date as date,
     it.category_id as category_id,
     SUM(inv.total_sale)
 FROM invoices inv
 JOIN items it ON (it.item_id = inv.item_id)
-WHERE category_id IS NOT NULL
+WHERE category_id IS NOT NULL{{date_filter}}
 GROUP BY date, category_id
 """
 
+select_oltp_daily_sales_by_category = _select_oltp_daily_sales_by_category.format(date_filter="")
+select_oltp_daily_sales_by_category_for_date_range = _select_oltp_daily_sales_by_category.format(
+    date_filter=f"\n  AND {invoice_date_range_filter}"
+)
+
 insert_olap_sales_weather_population = f"""
 INSERT INTO {olap_sales_weather_population} (
     {select_oltp_sales_weather_population}
@@ -470,6 +702,54 @@ INSERT INTO {olap_daily_sales_by_category} (
 )
 """
 
+# Partitioned refresh of OLAP tables.  Each refresh deletes then re-inserts the rows for invoices in a single month,
+# [date_start, date_end), where year/month identify that month
+delete_olap_sales_weather_population_for_date_range = f"""
+DELETE FROM {olap_sales_weather_population}
+WHERE date >= %(date_start)s AND date < %(date_end)s
+"""
+
+delete_olap_monthly_sales_store_for_date_range = f"""
+DELETE FROM {olap_monthly_sales_store}
+WHERE year = %(year)s AND month = %(month)s
+"""
+
+delete_olap_daily_sales_by_category_for_date_range = f"""
+DELETE FROM {olap_daily_sales_by_category}
+WHERE date >= %(date_start)s AND date < %(date_end)s
+"""
+
+insert_olap_sales_weather_population_for_date_range = f"""
+INSERT INTO {olap_sales_weather_population} (
+    {select_oltp_sales_weather_population_for_date_range}
+)
+"""
+
+insert_olap_monthly_sales_store_for_date_range = f"""
+INSERT INTO {olap_monthly_sales_store} (
+    {select_oltp_monthly_sales_store_for_date_range}
+)
+"""
+
+insert_olap_daily_sales_by_category_for_date_range = f"""
+INSERT INTO {olap_daily_sales_by_category} (
+    {select_oltp_daily_sales_by_category_for_date_range}
+)
+"""
+
+# Range of invoice dates, used to find which months need an OLAP refresh
+select_invoice_date_range = f"""
+SELECT MIN(date), MAX(date) FROM {invoices}
+"""
+
+select_staged_sales_date_range = f"""
+SELECT MIN(date), MAX(date) FROM {staging_sales}
+"""
+
+select_staged_weather_date_range = f"""
+SELECT MIN(date), MAX(date) FROM {staging_weather}
+"""
+
 create_staging_table_queries = {
     staging_sales: create_staging_sales,
     staging_weather: create_staging_weather,
@@ -484,14 +764,38 @@ create_table_queries = {
     weather_stations: create_weather_stations,
     weather: create_weather,
     population: create_population,
+    store_weather_station: create_store_weather_station,
 }
 
+# Matches the referenced table of a FOREIGN KEY clause in a create statement
+foreign_key_pattern = re.compile(r"FOREIGN KEY \([^)]*\) REFERENCES (\w+)")
+
+
+def _get_table_dependencies(create_queries):
+    """
+    Returns the tables each table references through FOREIGN KEY clauses in its create statement
+
+    Args:
+        create_queries (dict): {table_name: create statement}
+
+    Returns:
+        (dict): {table_name: set of referenced table names}
+    """
+    return {
+        table_name: set(foreign_key_pattern.findall(q)) - {table_name}
+        for table_name, q in create_queries.items()
+    }
+
+
 create_olap_table_queries = {
     olap_sales_weather_population: create_olap_sales_weather_population,
     olap_monthly_sales_store: create_olap_monthly_sales_store,
     olap_daily_sales_by_category: create_olap_daily_sales_by_category
 }
 
+# Tables that must be loaded before each production table.  Used to run independent inserts concurrently
+table_dependencies = _get_table_dependencies(create_table_queries)
+
 drop_staging_table_queries = {
     staging_sales: drop_staging_sales,
     staging_weather: drop_staging_weather,
@@ -499,6 +803,7 @@ drop_staging_table_queries = {
 }
 
 drop_table_queries = {
+    store_weather_station: drop_store_weather_station,
     population: drop_population,
     weather: drop_weather,
     weather_stations: drop_weather_stations,
@@ -520,12 +825,24 @@ load_staging_queries_postgres = {
     staging_population: load_staging_population_postgres,
 }
 
+copy_staging_stdin_queries_postgres = {
+    staging_sales: copy_staging_sales_stdin_postgres,
+    staging_weather: copy_staging_weather_stdin_postgres,
+    staging_population: copy_staging_population_stdin_postgres,
+}
+
 load_staging_queries_redshift = {
     staging_sales: load_staging_sales_redshift,
     staging_weather: load_staging_weather_redshift,
     staging_population: load_staging_population_redshift,
 }
 
+load_staging_manifest_queries_redshift = {
+    staging_sales: load_staging_sales_manifest_redshift,
+    staging_weather: load_staging_weather_manifest_redshift,
+    staging_population: load_staging_population_manifest_redshift,
+}
+
 insert_table_queries_postgres = {
     product_categories: insert_product_categories,
     items: insert_items,
@@ -536,12 +853,114 @@ insert_table_queries_postgres = {
     population: insert_population,
 }
 
+merge_table_queries_postgres = {
+    table_name: _upsert_query_postgres(table_name) for table_name in insert_table_queries_postgres
+}
+
+merge_table_queries_redshift = {
+    table_name: _upsert_query_redshift(table_name) for table_name in insert_table_queries_postgres
+}
+
+# Insert and merge queries for each dedup strategy, as {dedup: {table_name: query}}
+insert_table_queries_by_dedup = {
+    dedup: {table_name: _insert_query(table_name, selects) for table_name in insert_table_queries_postgres}
+    for dedup, selects in staged_table_selects_by_dedup.items()
+}
+
+merge_table_queries_postgres_by_dedup = {
+    dedup: {table_name: _upsert_query_postgres(table_name, selects) for table_name in insert_table_queries_postgres}
+    for dedup, selects in staged_table_selects_by_dedup.items()
+}
+
+merge_table_queries_postgres_partitioned_by_dedup = {
+    dedup: {table_name: _upsert_query_postgres(table_name, selects, keys=partitioned_primary_keys_postgres)
+            for table_name in insert_table_queries_postgres}
+    for dedup, selects in staged_table_selects_by_dedup.items()
+}
+
+merge_table_queries_redshift_by_dedup = {
+    dedup: {table_name: _upsert_query_redshift(table_name, selects) for table_name in insert_table_queries_postgres}
+    for dedup, selects in staged_table_selects_by_dedup.items()
+}
+
 insert_olap_table_queries = {
     olap_monthly_sales_store: insert_olap_monthly_sales_store,
     olap_daily_sales_by_category: insert_olap_daily_sales_by_category,
     olap_sales_weather_population: insert_olap_sales_weather_population,
 }
 
+# ETL state, recording which source files have been loaded into which staging table
+etl_loaded_files = "etl_loaded_files"
+
+create_etl_loaded_files = f"""
+CREATE TABLE IF NOT EXISTS {etl_loaded_files} (
+  table_name VARCHAR(64) NOT NULL,
+  file_key VARCHAR(1024) NOT NULL,
+  loaded_at TIMESTAMP NOT NULL,
+  PRIMARY KEY (table_name, file_key)
+)
+"""
+
+drop_etl_loaded_files = drop.format(table_name=etl_loaded_files)
+
+select_loaded_files = f"""
+SELECT file_key FROM {etl_loaded_files} WHERE table_name = %s
+"""
+
+insert_loaded_file = f"""
+INSERT INTO {etl_loaded_files} (table_name, file_key, loaded_at) VALUES (%s, %s, %s)
+"""
+
+# Load version of each table, bumped whenever the ETL changes its contents.  Used to invalidate cached query results
+etl_table_versions = "etl_table_versions"
+
+create_etl_table_versions = f"""
+CREATE TABLE IF NOT EXISTS {etl_table_versions} (
+  table_name VARCHAR(64) NOT NULL,
+  version BIGINT NOT NULL,
+  loaded_at TIMESTAMP NOT NULL,
+  PRIMARY KEY (table_name)
+)
+"""
+
+drop_etl_table_versions = drop.format(table_name=etl_table_versions)
+
+select_table_versions = f"""
+SELECT table_name, version, loaded_at FROM {etl_table_versions}
+"""
+
+update_table_version = f"""
+UPDATE {etl_table_versions} SET version = version + 1, loaded_at = %s WHERE table_name = %s
+"""
+
+insert_table_version = f"""
+INSERT INTO {etl_table_versions} (table_name, version, loaded_at) VALUES (%s, 1, %s)
+"""
+
+truncate = """
+TRUNCATE {table_name}
+"""
+
+create_etl_state_table_queries = {
+    etl_loaded_files: create_etl_loaded_files,
+    etl_table_versions: create_etl_table_versions,
+}
+
+drop_etl_state_table_queries = {
+    etl_loaded_files: drop_etl_loaded_files,
+    etl_table_versions: drop_etl_table_versions,
+}
+
+# (delete, insert) pairs that refresh a date range of each OLAP table
+refresh_olap_table_queries = {
+    olap_monthly_sales_store: (delete_olap_monthly_sales_store_for_date_range,
+                               insert_olap_monthly_sales_store_for_date_range),
+    olap_daily_sales_by_category: (delete_olap_daily_sales_by_category_for_date_range,
+                                   insert_olap_daily_sales_by_category_for_date_range),
+    olap_sales_weather_population: (delete_olap_sales_weather_population_for_date_range,
+                                    insert_olap_sales_weather_population_for_date_range),
+}
+
 # Other queries
 get_station_latitude_longitude = f"""
 SELECT station_id, latitude, longitude FROM {weather_stations} 
@@ -561,15 +980,25 @@ WHERE
 # where ws.station_id = new.station_id
 # """
 
-insert_station_zipcode = f"""
+# Station zip codes are bulk loaded into a temporary table and then applied with a single update
+create_temp_station_zipcode = """
 CREATE TEMPORARY TABLE new_zipcodes (
   station_id VARCHAR(11) NOT NULL, 
   zipcode VARCHAR(5)
-);
-INSERT INTO new_zipcodes
-VALUES
-    {{values}}
-;
+)
+"""
+
+# Postgres loads the temporary table by streaming csv through COPY
+copy_temp_station_zipcode_postgres = """
+COPY new_zipcodes (station_id, zipcode) FROM STDIN WITH (FORMAT CSV)
+"""
+
+# Redshift does not support COPY FROM STDIN, so insert batches of rows using psycopg2.extras.execute_values
+insert_temp_station_zipcode = """
+INSERT INTO new_zipcodes (station_id, zipcode) VALUES %s
+"""
+
+update_station_zipcode = f"""
 UPDATE {weather_stations} 
 SET zipcode=selected.zipcode
 FROM (
@@ -580,6 +1009,45 @@ FROM (
 WHERE {weather_stations}.station_id=selected.station_id
 """
 
+drop_temp_station_zipcode = """
+DROP TABLE new_zipcodes
+"""
+
+# Store locations and per-station weather coverage used to match each store to a weather station
+select_store_zipcodes = f"""
+SELECT store_id, zipcode FROM {stores}
+WHERE zipcode IS NOT NULL
+"""
+
+select_station_coverage = f"""
+SELECT ws.station_id, ws.latitude, ws.longitude, COUNT(w.date) as n_days
+FROM {weather_stations} ws
+LEFT JOIN {weather} w ON w.station_id = ws.station_id
+GROUP BY ws.station_id, ws.latitude, ws.longitude
+"""
+
+select_store_weather_station = f"""
+SELECT store_id, station_id FROM {store_weather_station}
+"""
+
+# Dates of the sales of a set of stores.  Uses psycopg2 parameter store_ids as a tuple
+select_store_invoice_date_range = f"""
+SELECT MIN(date), MAX(date) FROM {invoices}
+WHERE store_id IN %(store_ids)s
+"""
+
+delete_store_weather_station = f"""
+DELETE FROM {store_weather_station}
+"""
+
+copy_store_weather_station_postgres = f"""
+COPY {store_weather_station} (store_id, station_id, distance_miles) FROM STDIN WITH (FORMAT CSV)
+"""
+
+insert_store_weather_station = f"""
+INSERT INTO {store_weather_station} (store_id, station_id, distance_miles) VALUES %s
+"""
+
 # Analytical queries
 select_olap_sales_weather_population = f"""
 SELECT
@@ -595,7 +1063,7 @@ FROM {olap_sales_weather_population}
 """
 
 select_olap_sales_weather_population_for_year = select_olap_sales_weather_population + \
-                                                " WHERE EXTRACT(YEAR from date) = {year}"
+                                                f" WHERE {year_date_range_filter.format(alias='')}"
 
 
 select_olap_monthly_sales_store = f"""
@@ -614,14 +1082,56 @@ FROM {olap_daily_sales_by_category}
 analytical_queries = {
     "OLTP: sales vs weather and population": select_oltp_sales_weather_population,
     "OLAP: sales vs weather and population": select_olap_sales_weather_population,
-    "OLTP: sales vs weather and population (2015)": select_oltp_sales_weather_population_for_year.format(year=2015),
-    "OLAP: sales vs weather and population (2015)": select_olap_sales_weather_population_for_year.format(year=2015),
+    "OLTP: sales vs weather and population (2015)": select_oltp_sales_weather_population_for_year.format(year=2015,
+                                                                                                        next_year=2016),
+    "OLAP: sales vs weather and population (2015)": select_olap_sales_weather_population_for_year.format(year=2015,
+                                                                                                        next_year=2016),
     "OLTP: monthly sales by store": select_oltp_monthly_sales_store,
     "OLAP: monthly sales by store": select_olap_monthly_sales_store,
     "OLTP: daily sales by category": select_oltp_daily_sales_by_category,
     "OLAP: daily sales by category": select_olap_daily_sales_by_category,
 }
 
+# Export of fact tables or analytical queries.  Date filters use psycopg2 parameters date_start (inclusive) and
+# date_end (exclusive)
+export_tables = [olap_sales_weather_population, olap_monthly_sales_store, olap_daily_sales_by_category]
+
+select_export_table = """
+SELECT * FROM {table_name}
+"""
+
+export_date_filter = "date >= %(date_start)s AND date < %(date_end)s"
+
+# Monthly tables have no date column, so filter on the months overlapping [date_start, date_end)
+export_month_filter = "year * 100 + month >= %(month_start)s AND year * 100 + month <= %(month_end)s"
+
+export_date_filters = {
+    olap_sales_weather_population: export_date_filter,
+    olap_monthly_sales_store: export_month_filter,
+    olap_daily_sales_by_category: export_date_filter,
+}
+
+select_export_filtered = """
+SELECT * FROM (
+{query}
+) exported
+WHERE {date_filter}
+"""
+
+# Returns no rows, but the cursor description gives the result's columns and types
+select_export_description = """
+SELECT * FROM (
+{query}
+) described
+LIMIT 0
+"""
+
+copy_export_to_stdout = """
+COPY (
+{query}
+) TO STDOUT WITH (FORMAT CSV, HEADER FALSE)
+"""
+
 redshift_diststyle = {
     product_categories: " DISTSTYLE ALL",
     items: " DISTSTYLE ALL",
@@ -630,15 +1140,171 @@ redshift_diststyle = {
     weather_stations: " DISTSTYLE ALL",
     weather: " DISTSTYLE ALL",
     population: " DISTSTYLE ALL",
+    store_weather_station: " DISTSTYLE ALL",
     staging_sales: " DISTSTYLE EVEN",
     staging_weather: " DISTSTYLE EVEN",
     staging_population: " DISTSTYLE EVEN",
+    etl_loaded_files: " DISTSTYLE ALL",
+    etl_table_versions: " DISTSTYLE ALL",
     olap_sales_weather_population: "",
     olap_monthly_sales_store: "",
     olap_daily_sales_by_category: ""
 }
 
+# Redshift sort keys, chosen for the columns the analytical queries filter, join and group on
+redshift_sortkey = {
+    invoices: " COMPOUND SORTKEY(date, store_id)",
+    stores: " SORTKEY(zipcode)",
+    items: " SORTKEY(category_id)",
+    weather_stations: " SORTKEY(zipcode)",
+    weather: " COMPOUND SORTKEY(station_id, date)",
+    population: " COMPOUND SORTKEY(year, zipcode)",
+    olap_sales_weather_population: " COMPOUND SORTKEY(date, category_id)",
+    olap_monthly_sales_store: " COMPOUND SORTKEY(year, month, store_id)",
+    olap_daily_sales_by_category: " COMPOUND SORTKEY(date, category_id)",
+}
+
+# Optional postgres declarative partitioning of the largest tables by date.  Partitions are created from the range of
+# loaded data by create_partitions, each covering [date_start, date_end)
+partitioned_tables_postgres = [invoices, olap_sales_weather_population]
+
+partition_by_range_postgres = " PARTITION BY RANGE (date)"
+
+# Create statements used for partitioned_tables_postgres when partitioning is enabled.  Postgres requires the partition
+# key in the primary key of a partitioned table, so these tables are keyed on (invoice_id, date) only when partitioned
+create_partitioned_table_queries_postgres = {
+    invoices: _create_invoices.format(
+        primary_key=", ".join(partitioned_primary_keys_postgres[invoices])) + partition_by_range_postgres,
+    olap_sales_weather_population: _create_olap_sales_weather_population.format(
+        primary_key="invoice_id, date") + partition_by_range_postgres,
+}
+
+create_partition_postgres = """
+CREATE TABLE IF NOT EXISTS {partition_name} PARTITION OF {table_name}
+FOR VALUES FROM ('{date_start}') TO ('{date_end}')
+"""
+
+create_index = """
+CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} {definition}
+"""
+
+# Postgres secondary indexes as {table_name: {index_name: definition}}.  Primary keys are already indexed, so
+# weather(station_id, date) and fact_daily_sales_by_category(date, category_id) need no additional index.  BRIN is
+# used for dates as rows are loaded roughly in date order, making BRIN far smaller and cheaper to build than B-tree
+postgres_indexes = {
+    invoices: {
+        "invoices_date_brin": "USING BRIN (date)",
+        "invoices_store_id": "(store_id)",
+        "invoices_item_id": "(item_id)",
+    },
+    items: {
+        "items_category_id": "(category_id)",
+    },
+    stores: {
+        "stores_zipcode": "(zipcode)",
+    },
+    weather_stations: {
+        "weather_stations_zipcode": "(zipcode)",
+    },
+    olap_sales_weather_population: {
+        "fact_sales_weather_population_date_brin": "USING BRIN (date)",
+        "fact_sales_weather_population_category_id": "(category_id)",
+    },
+    olap_monthly_sales_store: {
+        "fact_monthly_sales_store_store_id": "(store_id)",
+    },
+}
+
+# Tables whose indexes etl.py builds right after the production insert, as nothing later writes to them and their
+# indexes speed up the zip code, store station and OLAP steps.  Every other index is built after those steps
+indexes_before_olap_postgres = [invoices, items, stores]
+
+create_index_queries_postgres = {
+    index_name: create_index.format(index_name=index_name, table_name=table_name, definition=definition)
+    for table_name, indexes in postgres_indexes.items()
+    for index_name, definition in indexes.items()
+}
+
+# Data quality checks, computed for each table in a single aggregate scan
+select_table_profile = """
+SELECT
+    {aggregates}
+FROM {table_name}{where}
+"""
+
+null_count_aggregate = "SUM(CASE WHEN {column} IS NULL THEN 1 ELSE 0 END)"
+
+# Composite keys are concatenated as redshift does not support COUNT(DISTINCT (a, b))
+distinct_count_aggregate = "COUNT(DISTINCT {key})"
+
+# Checks applied to each table by validation.py as {table_name: rules}, where rules may include:
+#   unique: columns that should identify a row.  Redshift does not enforce primary keys, so duplicates are possible
+#   max_null_rate: {column: maximum fraction of rows that may be null, or None to only report the rate}
+#   max_dropped_fraction: maximum fraction of the rows staged for a table that may be filtered or deduplicated away
+#                         when inserting, or None to only report it
+validation_rules = {
+    product_categories: dict(unique=primary_keys[product_categories], max_null_rate={"category_name": None}),
+    items: dict(unique=primary_keys[items], max_null_rate={"category_id": None, "vendor_id": None}),
+    stores: dict(unique=primary_keys[stores], max_null_rate={"zipcode": None}),
+    invoices: dict(unique=primary_keys[invoices], max_dropped_fraction=0.01),
+    weather_stations: dict(unique=primary_keys[weather_stations], max_null_rate={"zipcode": None}),
+    weather: dict(unique=primary_keys[weather], max_dropped_fraction=0.0,
+                  max_null_rate={"precipitation": None, "snowfall": None, "temperature_max": None,
+                                 "temperature_min": None}),
+    population: dict(unique=primary_keys[population], max_null_rate={"population": 0.0}),
+    store_weather_station: dict(unique=primary_keys[store_weather_station]),
+    olap_sales_weather_population: dict(unique=["invoice_id"],
+                                        max_null_rate={"precipitation": None, "snowfall": None, "population": None}),
+    olap_monthly_sales_store: dict(unique=["year", "month", "store_id"]),
+    olap_daily_sales_by_category: dict(unique=["date", "category_id"]),
+}
+
+# Filters restricting the profile of a table to a range of dates, used to validate only the rows touched by a load.
+# Use psycopg2 parameters date_start and date_end (both inclusive), or month_start and month_end as year * 100 + month
+validation_date_filters = {
+    invoices: "date BETWEEN %(date_start)s AND %(date_end)s",
+    weather: "date BETWEEN %(date_start)s AND %(date_end)s",
+    olap_sales_weather_population: "date BETWEEN %(date_start)s AND %(date_end)s",
+    olap_daily_sales_by_category: "date BETWEEN %(date_start)s AND %(date_end)s",
+    olap_monthly_sales_store: "year * 100 + month BETWEEN %(month_start)s AND %(month_end)s",
+}
+
+# Staging table each production table is inserted from, used to reconcile staged and inserted row counts
+production_table_sources = {
+    product_categories: staging_sales,
+    items: staging_sales,
+    stores: staging_sales,
+    invoices: staging_sales,
+    weather_stations: staging_weather,
+    weather: staging_weather,
+    population: staging_population,
+}
+
 # Misc helper queries
 
 # very simple query used during performance testing to make sure there's no first-query-lag in timing
 discardable_query = f"""SELECT * FROM {staging_sales} LIMIT 1"""
+
+# Query plan capture used during performance testing
+explain_analyze_postgres = """
+EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}
+"""
+
+explain_postgres = """
+EXPLAIN (FORMAT JSON) {query}
+"""
+
+explain_redshift = """
+EXPLAIN {query}
+"""
+
+select_last_query_id_redshift = """
+SELECT pg_last_query_id()
+"""
+
+select_query_summary_redshift = """
+SELECT stm, seg, step, TRIM(label), rows, bytes, is_diskbased
+FROM svl_query_summary
+WHERE query = %s
+ORDER BY stm, seg, step
+"""
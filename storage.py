@@ -0,0 +1,318 @@
+import os
+import shutil
+import tempfile
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import botocore.config
+from boto3.s3.transfer import TransferConfig
+
+DEFAULT_MULTIPART_THRESHOLD = 64 * 1024 * 1024
+DEFAULT_MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_TRANSFER_WORKERS = 4
+
+
+def join_key(*parts):
+    """
+    Joins parts of a storage key with "/", skipping empty parts
+
+    Returns:
+        (str)
+    """
+    return "/".join(str(p).strip("/") for p in parts if p and str(p).strip("/"))
+
+
+class Storage(ABC):
+    def __init__(self, cache_dir=None):
+        """
+        Base class for a location raw data is listed, read from and written to.
+
+        Objects are addressed by keys relative to the root of the storage (eg: raw-data/sales/csv/2018/03/...) and
+        returned from listings as urls (eg: s3://bucket/raw-data/... or /local/root/raw-data/...), which are what is
+        recorded as loaded and passed to the database.
+
+        Args:
+            cache_dir (str): Directory of a local read-through cache of downloaded objects.  If None, objects are read
+                             from the storage every time
+        """
+        self.cache_dir = cache_dir
+
+    @abstractmethod
+    def url(self, key):
+        """
+        Returns the url of a key
+        """
+
+    @abstractmethod
+    def key(self, url):
+        """
+        Returns the key of a url
+        """
+
+    @abstractmethod
+    def list(self, prefix=""):
+        """
+        Returns the sorted urls of all objects whose key starts with prefix
+        """
+
+    @abstractmethod
+    def sizes(self, urls):
+        """
+        Returns {url: size in bytes} for a list of urls
+        """
+
+    @abstractmethod
+    def version(self, url):
+        """
+        Returns a token that changes whenever the object at url changes.  Used to validate cached copies
+        """
+
+    @abstractmethod
+    def upload(self, local_file, key):
+        """
+        Writes a local file (filename or binary file object) to key
+        """
+
+    @abstractmethod
+    def download(self, url, local_file):
+        """
+        Writes the object at url to a local filename
+        """
+
+    def open(self, url):
+        """
+        Opens the object at url for binary reading, through the local cache if one is configured
+
+        Returns:
+            Binary file object.  Caller is responsible for closing it
+        """
+        if self.cache_dir:
+            return open(self.fetch(url), "rb")
+        return self._open(url)
+
+    @abstractmethod
+    def _open(self, url):
+        """
+        Opens the object at url for binary reading directly from the storage
+        """
+
+    def fetch(self, url):
+        """
+        Returns a local filename holding the object at url, downloading it only if it is not already cached
+
+        Cached copies are validated against the object's current version, so changed objects are downloaded again
+
+        Args:
+            url (str): Url of the object
+
+        Returns:
+            (str): Local filename
+        """
+        key = self.key(url)
+        cached_file = os.path.join(self.cache_dir, self._cache_namespace(), *key.split("/"))
+        version_file = cached_file + ".version"
+        version = self.version(url)
+
+        if os.path.exists(cached_file) and os.path.exists(version_file):
+            with open(version_file, "r") as stream:
+                if stream.read() == version:
+                    return cached_file
+
+        # Download to a temporary file in the same directory so concurrent readers never see a partial object
+        os.makedirs(os.path.dirname(cached_file), exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cached_file))
+        os.close(fd)
+        try:
+            self.download(url, tmp_file)
+            os.replace(tmp_file, cached_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        with open(version_file, "w") as stream:
+            stream.write(version)
+        return cached_file
+
+    @abstractmethod
+    def _cache_namespace(self):
+        """
+        Returns the subdirectory of cache_dir used for this storage, so storages sharing a cache do not collide
+        """
+
+    def upload_many(self, files, n_workers=DEFAULT_TRANSFER_WORKERS):
+        """
+        Uploads many local files concurrently
+
+        Args:
+            files (dict): Map of {local filename: key}
+            n_workers (int): Number of files uploaded concurrently
+        """
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            # list() so any exception raised by an upload is raised here
+            list(executor.map(lambda item: self.upload(*item), files.items()))
+
+
+class LocalStorage(Storage):
+    def __init__(self, root, cache_dir=None):
+        """
+        Storage on a local (or locally mounted) filesystem.
+
+        Objects are already local, so reads never go through the cache
+
+        Args:
+            root (str): Directory that keys are relative to
+            cache_dir (str): Unused
+        """
+        super().__init__(cache_dir=None)
+        self.root = root
+
+    def url(self, key):
+        return os.path.join(self.root, *key.split("/")) if key else self.root
+
+    def key(self, url):
+        return os.path.relpath(url, self.root).replace(os.sep, "/")
+
+    def list(self, prefix=""):
+        urls = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                url = os.path.join(dirpath, filename)
+                if self.key(url).startswith(prefix):
+                    urls.append(url)
+        return sorted(urls)
+
+    def sizes(self, urls):
+        return {url: os.path.getsize(url) for url in urls}
+
+    def version(self, url):
+        stat = os.stat(url)
+        return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+    def upload(self, local_file, key):
+        destination = self.url(key)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        if isinstance(local_file, (str, os.PathLike)):
+            shutil.copyfile(local_file, destination)
+        else:
+            with open(destination, "wb") as stream:
+                shutil.copyfileobj(local_file, stream)
+
+    def download(self, url, local_file):
+        shutil.copyfile(url, local_file)
+
+    def _open(self, url):
+        return open(url, "rb")
+
+    def _cache_namespace(self):
+        # Never used, as local storage is not cached
+        return "local"
+
+
+class S3Storage(Storage):
+    def __init__(self, bucket, region=None, access_key=None, secret_key=None, endpoint_url=None, cache_dir=None,
+                 multipart_threshold=DEFAULT_MULTIPART_THRESHOLD, multipart_chunksize=DEFAULT_MULTIPART_CHUNKSIZE,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        """
+        Storage in an S3 bucket, or a bucket of any S3-compatible store (eg: MinIO or a moto server) at endpoint_url.
+
+        Large objects are uploaded and downloaded as multipart transfers with parts moved concurrently.
+
+        Args:
+            bucket (str): Bucket name
+            region (str): AWS region
+            access_key (str): AWS access key.  If None, the default boto3 credential chain is used
+            secret_key (str): AWS secret key
+            endpoint_url (str): (optional) Url of an S3-compatible store, eg: http://localhost:9000
+            cache_dir (str): Directory of a local read-through cache of downloaded objects.  If None, objects are
+                             streamed from S3 every time they are read
+            multipart_threshold (int): Objects of at least this many bytes are transferred in parts
+            multipart_chunksize (int): Size in bytes of each part
+            max_concurrency (int): Number of parts of a single object transferred concurrently
+        """
+        super().__init__(cache_dir=cache_dir)
+        self.bucket = bucket
+        self.endpoint_url = endpoint_url
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_threshold,
+                                              multipart_chunksize=multipart_chunksize,
+                                              max_concurrency=max_concurrency)
+        # Enough pooled connections for several concurrent multipart transfers
+        self.client = boto3.client(
+            "s3",
+            region_name=region,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            endpoint_url=endpoint_url,
+            config=botocore.config.Config(max_pool_connections=max_concurrency * DEFAULT_TRANSFER_WORKERS),
+        )
+
+    def url(self, key):
+        return f"s3://{self.bucket}/{key}"
+
+    def key(self, url):
+        prefix = f"s3://{self.bucket}/"
+        if not url.startswith(prefix):
+            raise ValueError(f"Url {url} is not in bucket {self.bucket}")
+        return url[len(prefix):]
+
+    def list(self, prefix=""):
+        urls = []
+        for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=prefix):
+            # Skip zero-byte "directory" placeholder objects
+            urls.extend(self.url(o["Key"]) for o in page.get("Contents", []) if not o["Key"].endswith("/"))
+        return sorted(urls)
+
+    def _head(self, url):
+        return self.client.head_object(Bucket=self.bucket, Key=self.key(url))
+
+    def sizes(self, urls):
+        with ThreadPoolExecutor(max_workers=DEFAULT_TRANSFER_WORKERS) as executor:
+            heads = executor.map(self._head, urls)
+            return {url: head["ContentLength"] for url, head in zip(urls, heads)}
+
+    def version(self, url):
+        return self._head(url)["ETag"]
+
+    def upload(self, local_file, key):
+        if isinstance(local_file, (str, os.PathLike)):
+            self.client.upload_file(str(local_file), self.bucket, key, Config=self.transfer_config)
+        else:
+            self.client.upload_fileobj(local_file, self.bucket, key, Config=self.transfer_config)
+
+    def download(self, url, local_file):
+        self.client.download_file(self.bucket, self.key(url), local_file, Config=self.transfer_config)
+
+    def _open(self, url):
+        return self.client.get_object(Bucket=self.bucket, Key=self.key(url))["Body"]
+
+    def _cache_namespace(self):
+        return self.bucket
+
+
+def get_storage(data_cfg, secrets, cache_dir=None):
+    """
+    Returns the storage holding the files of a data spec
+
+    Data specs with local_dir use local storage rooted at local_dir.  Otherwise files are in the S3 bucket of the data
+    spec, or in an S3-compatible store if endpoint_url is set in the data spec or in the aws secrets
+
+    Args:
+        data_cfg (dict): Data spec dictionary
+        secrets (dict): Dictionary of db/aws secrets
+        cache_dir (str): Directory of a local read-through cache of downloaded objects.  If None, no cache is used
+
+    Returns:
+        (Storage)
+    """
+    if "local_dir" in data_cfg:
+        return LocalStorage(data_cfg["local_dir"])
+
+    aws = secrets.get("aws", {})
+    return S3Storage(
+        bucket=data_cfg["bucket"],
+        region=data_cfg.get("region"),
+        access_key=aws.get("access_key"),
+        secret_key=aws.get("secret_key"),
+        endpoint_url=data_cfg.get("endpoint_url", aws.get("endpoint_url")),
+        cache_dir=cache_dir,
+    )
@@ -0,0 +1,344 @@
+import atexit
+import contextvars
+import functools
+import itertools
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import tracemalloc
+
+DEFAULT_METRICS_PREFIX = "etl"
+
+# Span (utilities.Timer) that spans opened in the current thread or task are children of
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def get_current_span():
+    """
+    Returns the innermost span (utilities.Timer used as a context manager) open in the current thread, or None
+    """
+    return _current_span.get()
+
+
+def set_current_span(span):
+    """
+    Makes span the current span, returning a token for reset_current_span
+    """
+    return _current_span.set(span)
+
+
+def reset_current_span(token):
+    """
+    Restores the span that was current before the set_current_span call that returned token
+    """
+    _current_span.reset(token)
+
+
+def with_current_span(fn):
+    """
+    Returns a wrapper of fn that runs with the span that is current now as its current span
+
+    Threads do not inherit the current span, so wrap work handed to a thread or executor with this to keep any spans
+    it opens as children of the span that started it, eg:
+        executor.submit(with_current_span(stage_file), ...)
+
+    Args:
+        fn: Function to wrap
+
+    Returns:
+        Function taking the same arguments as fn
+    """
+    span = get_current_span()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = set_current_span(span)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            reset_current_span(token)
+
+    return wrapper
+
+
+class Tracer:
+    def __init__(self):
+        """
+        Collects finished spans and exports them as a JSON trace or Prometheus metrics.
+
+        Spans are utilities.Timer objects used as context managers, which add themselves here when they exit.  A
+        single module level Tracer (tracing.tracer) is shared by every Timer.
+        """
+        self.spans = []
+        self.trace_memory = False
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            return next(self._ids)
+
+    def add(self, span):
+        """
+        Records a finished span
+        """
+        with self._lock:
+            self.spans.append(span)
+
+    def clear(self):
+        """
+        Removes all recorded spans
+        """
+        with self._lock:
+            self.spans = []
+
+    def start_memory_tracing(self):
+        """
+        Starts tracemalloc so every span opened afterwards records the peak memory allocated while it was open
+
+        tracemalloc slows down allocation heavy code considerably, so this is off by default
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.trace_memory = True
+
+    def get_paths(self):
+        """
+        Returns the path of each recorded span, being the names of its ancestors and itself joined by "/"
+
+        Returns:
+            (dict): Map of {span_id: path}
+        """
+        with self._lock:
+            spans = list(self.spans)
+        by_id = {span.span_id: span for span in spans}
+        paths = {}
+
+        def get_path(span):
+            if span.span_id not in paths:
+                parent = by_id.get(span.parent_id)
+                paths[span.span_id] = span.name if parent is None else f"{get_path(parent)}/{span.name}"
+            return paths[span.span_id]
+
+        for span in spans:
+            get_path(span)
+        return paths
+
+    def to_trace(self):
+        """
+        Returns the recorded spans in Chrome trace event format, which can be opened in Perfetto or chrome://tracing
+
+        Each span is a complete ("X") event with its attributes, derived rates, peak memory, id, parent id and path in
+        args.  Thread names are added as metadata events
+
+        Returns:
+            (dict)
+        """
+        paths = self.get_paths()
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start_time)
+        pid = os.getpid()
+
+        events = []
+        threads = {}
+        for span in spans:
+            threads[span.thread_id] = span.thread_name
+            events.append(dict(
+                name=span.name,
+                cat="span",
+                ph="X",
+                ts=span.start_time * 1e6,
+                dur=span.duration * 1e6,
+                pid=pid,
+                tid=span.thread_id,
+                args=dict(path=paths[span.span_id], **span.to_dict()),
+            ))
+        for thread_id, thread_name in threads.items():
+            events.append(dict(name="thread_name", ph="M", pid=pid, tid=thread_id, args=dict(name=thread_name)))
+        return dict(traceEvents=events, displayTimeUnit="ms")
+
+    def write_trace(self, output):
+        """
+        Writes the recorded spans to a JSON trace file (see to_trace)
+        """
+        _write_atomic(output, json.dumps(self.to_trace(), indent=1, default=str))
+
+    def get_metrics(self):
+        """
+        Returns the recorded spans aggregated by path and table attribute
+
+        Spans that run many times (eg: once per staged file) are summed, so each stage has one set of metrics however
+        many files or months it ran for
+
+        Returns:
+            (dict): Map of {(path, table or None): {count, errors, seconds, rows, bytes, peak_memory_bytes}}.  errors
+                    is the number of spans that exited with an exception.  rows and bytes are None if no span of the
+                    group had them, and peak_memory_bytes is the largest of any span
+        """
+        paths = self.get_paths()
+        with self._lock:
+            spans = list(self.spans)
+
+        metrics = {}
+        for span in spans:
+            key = (paths[span.span_id], span.attributes.get("table"))
+            metric = metrics.setdefault(key, dict(count=0, errors=0, seconds=0.0, rows=None, bytes=None,
+                                                  peak_memory_bytes=None))
+            metric["count"] += 1
+            if span.error is not None:
+                metric["errors"] += 1
+            metric["seconds"] += span.duration
+            for attribute in ("rows", "bytes"):
+                if span.attributes.get(attribute) is not None:
+                    metric[attribute] = (metric[attribute] or 0) + span.attributes[attribute]
+            if span.peak_memory_bytes is not None:
+                metric["peak_memory_bytes"] = max(metric["peak_memory_bytes"] or 0, span.peak_memory_bytes)
+        return metrics
+
+    def to_prometheus(self, job, prefix=DEFAULT_METRICS_PREFIX):
+        """
+        Returns the recorded spans as metrics in the Prometheus text exposition format (see get_metrics)
+
+        Every metric is labelled by job, span path and, if set, table.  Rates are total rows or bytes divided by total
+        seconds of the group
+
+        Args:
+            job (str): Value of the job label, typically the name of the CLI
+            prefix (str): Prefix of every metric name
+
+        Returns:
+            (str)
+        """
+        metrics = self.get_metrics()
+        definitions = [
+            ("span_count", "Number of times the span ran", lambda m: m["count"]),
+            ("span_errors", "Number of times the span exited with an exception", lambda m: m["errors"]),
+            ("span_duration_seconds", "Total time spent in the span", lambda m: m["seconds"]),
+            ("span_rows", "Total rows processed by the span", lambda m: m["rows"]),
+            ("span_rows_per_second", "Rows processed per second by the span",
+             lambda m: _rate(m["rows"], m["seconds"])),
+            ("span_bytes", "Total bytes processed by the span", lambda m: m["bytes"]),
+            ("span_bytes_per_second", "Bytes processed per second by the span",
+             lambda m: _rate(m["bytes"], m["seconds"])),
+            ("span_peak_memory_bytes", "Largest peak of memory allocated while the span was open",
+             lambda m: m["peak_memory_bytes"]),
+        ]
+
+        lines = []
+        for name, description, get_value in definitions:
+            samples = [(key, get_value(metric)) for key, metric in metrics.items()]
+            samples = [(key, value) for key, value in samples if value is not None]
+            if not samples:
+                continue
+            metric_name = f"{prefix}_{name}"
+            lines.append(f"# HELP {metric_name} {description}")
+            lines.append(f"# TYPE {metric_name} gauge")
+            for (path, table), value in samples:
+                labels = dict(job=job, span=path)
+                if table is not None:
+                    labels["table"] = table
+                label_text = ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels.items())
+                lines.append(f"{metric_name}{{{label_text}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, output, job, prefix=DEFAULT_METRICS_PREFIX):
+        """
+        Writes the recorded spans as a Prometheus textfile (see to_prometheus), eg: for the node_exporter textfile
+        collector
+        """
+        _write_atomic(output, self.to_prometheus(job, prefix=prefix))
+
+
+def _rate(amount, seconds):
+    if amount is None or seconds <= 0:
+        return None
+    return amount / seconds
+
+
+def _escape_label(value):
+    return re.sub(r'(["\\])', r"\\\1", str(value)).replace("\n", "\\n")
+
+
+def _write_atomic(output, text):
+    # Write to a temporary file then rename so collectors never read a partial file
+    directory = os.path.dirname(os.path.abspath(output))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as stream:
+            stream.write(text)
+        os.replace(tmp_path, output)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+tracer = Tracer()
+
+
+def start_tracing(root, trace_output=None, metrics_output=None, trace_memory=False):
+    """
+    Opens a root span for a CLI run and registers writing the trace and metrics when the process exits
+
+    Outputs are written at exit even if the run fails, so a failed run still shows which stages it completed.  An
+    uncaught exception is recorded as the error of the root span
+
+    Args:
+        root (utilities.Timer): Span covering the whole run.  Its name is used as the job label of the metrics
+        trace_output (str): (optional) JSON trace file to write (see Tracer.write_trace)
+        metrics_output (str): (optional) Prometheus textfile to write (see Tracer.write_prometheus)
+        trace_memory (bool): If True, records the peak memory of every span using tracemalloc
+
+    Returns:
+        (utilities.Timer): root, already entered
+    """
+    if trace_memory:
+        tracer.start_memory_tracing()
+    root.__enter__()
+
+    # Uncaught exceptions reach sys.excepthook before atexit handlers run, so keep the exception to close root with
+    exc_info = [None, None, None]
+    previous_excepthook = sys.excepthook
+
+    def excepthook(exc_type, exc_val, exc_tb):
+        exc_info[:] = [exc_type, exc_val, exc_tb]
+        previous_excepthook(exc_type, exc_val, exc_tb)
+
+    sys.excepthook = excepthook
+
+    def finish():
+        root.__exit__(*exc_info)
+        if trace_output:
+            tracer.write_trace(trace_output)
+        if metrics_output:
+            tracer.write_prometheus(metrics_output, job=root.name)
+
+    atexit.register(finish)
+    return root
+
+
+def add_tracing_arguments(parser):
+    """
+    Adds the --trace_output, --metrics_output and --trace_memory arguments shared by every CLI to an argparse parser
+    """
+    parser.add_argument(
+        '--trace_output',
+        action="store",
+        default=None,
+        help="If set, writes every timed stage of the run, nested by parent and with any rows/bytes processed, to this "
+             "JSON trace file (Chrome trace event format, viewable in Perfetto or chrome://tracing)"
+    )
+    parser.add_argument(
+        '--metrics_output',
+        action="store",
+        default=None,
+        help="If set, writes duration, rows/sec, bytes/sec and peak memory per stage to this Prometheus textfile (eg: "
+             "for the node_exporter textfile collector)"
+    )
+    parser.add_argument(
+        '--trace_memory',
+        action="store_true",
+        help="If set, records the peak memory allocated during each stage using tracemalloc.  This slows down the run"
+    )
@@ -1,8 +1,18 @@
+import datetime
+import json
 import logging
+import os
+import re
+import threading
 import time
+import tracemalloc
+import numpy as np
 from uszipcode import SearchEngine
 import yaml
 
+import tracing
+from sql_queries import select_table_versions, update_table_version, insert_table_version, select_any_row
+
 # Shared code for logging use
 logging_format = '%(asctime)20s - %(name)12s - %(funcName)20s() -%(levelname)7s - %(message)s'
 logging_datefmt = '%Y/%m/%d %H:%M:%S'
@@ -27,7 +37,8 @@ def get_logger(name):
 
 def test_table_has_rows(engine, table_name):
     """
-    Test whether a table has any rows, raising a ValueError if it does not
+    Test whether a table has any rows, raising a ValueError if it does not.  Stops at the first row, so is cheap on
+    tables of any size
 
     Args:
         engine: psycopg2 engine connected to a database
@@ -37,9 +48,8 @@ def test_table_has_rows(engine, table_name):
         True if successful
     """
     cur = engine.cursor()
-    cur.execute(f"SELECT COUNT(*) FROM {table_name}")
-    results = cur.fetchone()
-    if results[0] > 0:
+    cur.execute(select_any_row.format(table_name=table_name))
+    if cur.fetchone() is not None:
         return True
     else:
         raise ValueError(f"Table {table_name} has no data")
@@ -47,7 +57,8 @@ def test_table_has_rows(engine, table_name):
 
 def test_table_has_no_rows(engine, table_name):
     """
-    Test whether a table has no rows, raising a ValueError if it does not
+    Test whether a table has no rows, raising a ValueError if it does not.  Stops at the first row, so is cheap on
+    tables of any size
 
     Args:
         engine: psycopg2 engine connected to a database
@@ -57,14 +68,48 @@ def test_table_has_no_rows(engine, table_name):
         True if successful
     """
     cur = engine.cursor()
-    cur.execute(f"SELECT COUNT(*) FROM {table_name}")
-    results = cur.fetchone()
-    if results[0] == 0:
+    cur.execute(select_any_row.format(table_name=table_name))
+    if cur.fetchone() is None:
         return True
     else:
         raise ValueError(f"Table {table_name} has data")
 
 
+def record_table_versions(engine, table_names):
+    """
+    Bumps the load version of tables whose contents have changed.  Does not commit, so this can share a transaction
+    with the load that changed them
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        table_names (list): Names of the tables that were loaded
+    """
+    loaded_at = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    cur = engine.cursor()
+    for table_name in table_names:
+        cur.execute(update_table_version, (loaded_at, table_name))
+        if cur.rowcount == 0:
+            cur.execute(insert_table_version, (table_name, loaded_at))
+
+
+def get_table_versions(engine):
+    """
+    Returns the current load version of every table the ETL has recorded one for
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+
+    Returns:
+        (dict): Map of {table_name: "version@loaded_at"}.  loaded_at is included so versions restarted by dropping
+                and recreating the tables never repeat
+    """
+    cur = engine.cursor()
+    cur.execute(select_table_versions)
+    versions = {table_name: f"{version}@{loaded_at.isoformat()}" for table_name, version, loaded_at in cur.fetchall()}
+    engine.commit()
+    return versions
+
+
 def lat_long_to_zip(latitude, longitude, search=None):
     """
     Converts coordinates of latitude and longitude to zip code using uszipcode package
@@ -85,6 +130,202 @@ def lat_long_to_zip(latitude, longitude, search=None):
     return search.by_coordinates(latitude, longitude, returns=1)[0].zipcode
 
 
+EARTH_RADIUS_MILES = 3958.8
+
+
+def haversine_miles(latitudes_1, longitudes_1, latitudes_2, longitudes_2):
+    """
+    Returns the great circle distance in miles between coordinates in radians, broadcasting like any numpy operation
+
+    Args:
+        latitudes_1 (np.ndarray): Latitudes of the first coordinates, in radians
+        longitudes_1 (np.ndarray): Longitudes of the first coordinates, in radians
+        latitudes_2 (np.ndarray): Latitudes of the second coordinates, in radians
+        longitudes_2 (np.ndarray): Longitudes of the second coordinates, in radians
+
+    Returns:
+        (np.ndarray)
+    """
+    a = np.sin((latitudes_2 - latitudes_1) / 2) ** 2 + \
+        np.cos(latitudes_1) * np.cos(latitudes_2) * np.sin((longitudes_2 - longitudes_1) / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(a))
+
+
+def nearest_covered_stations(latitudes, longitudes, station_latitudes, station_longitudes, station_coverage,
+                             min_coverage=0.5, radius=50.0, chunk_size=1000):
+    """
+    Returns the nearest weather station to each coordinate, preferring stations with good data coverage
+
+    A station is well covered if it has at least min_coverage times as many days of data as the best covered station.
+    Each coordinate is matched to its nearest well covered station within radius, or failing that its nearest station
+    with any data within radius
+
+    Args:
+        latitudes (iterable): Latitudes of the coordinates to match, in degrees.  May be nan
+        longitudes (iterable): Longitudes of the coordinates to match, in degrees.  May be nan
+        station_latitudes (iterable): Latitudes of the stations, in degrees
+        station_longitudes (iterable): Longitudes of the stations, in degrees
+        station_coverage (iterable): Number of days of data for each station
+        min_coverage (float): Fraction of the best covered station's days of data a station needs to be preferred
+        radius (float): Maximum distance in miles to a station
+        chunk_size (int): Number of coordinates matched per vectorized distance computation
+
+    Returns:
+        (tuple): (index of the matched station or -1 if there is none, distance in miles or nan) as numpy arrays
+    """
+    latitudes = np.radians(np.asarray(latitudes, dtype=float))
+    longitudes = np.radians(np.asarray(longitudes, dtype=float))
+    station_latitudes = np.radians(np.asarray(station_latitudes, dtype=float))
+    station_longitudes = np.radians(np.asarray(station_longitudes, dtype=float))
+    station_coverage = np.asarray(station_coverage, dtype=float)
+
+    has_data = station_coverage > 0
+    covered = has_data & (station_coverage >= min_coverage * station_coverage.max(initial=0))
+
+    i_stations = np.full(len(latitudes), -1, dtype=int)
+    station_distances = np.full(len(latitudes), np.nan)
+    for i_start in range(0, len(latitudes), chunk_size):
+        chunk = slice(i_start, i_start + chunk_size)
+        # Distance from every coordinate (rows) to every station (columns)
+        distances = haversine_miles(latitudes[chunk, np.newaxis], longitudes[chunk, np.newaxis],
+                                    station_latitudes, station_longitudes)
+        rows = np.arange(distances.shape[0])
+
+        # Fall back to any station with data, then prefer a well covered one if it is within radius
+        for candidates in [has_data, covered]:
+            candidate_distances = np.where(candidates, distances, np.inf)
+            i_nearest = np.argmin(candidate_distances, axis=1)
+            nearest_distances = candidate_distances[rows, i_nearest]
+            in_radius = nearest_distances <= radius
+            i_stations[chunk][in_radius] = i_nearest[in_radius]
+            station_distances[chunk][in_radius] = nearest_distances[in_radius]
+
+    return i_stations, station_distances
+
+
+class ZipcodeResolver:
+    def __init__(self, search=None, cache_file=None, radius=25.0, precision=4, chunk_size=1000):
+        """
+        Resolves many latitude/longitude coordinates to their nearest zip code in vectorized batches.
+
+        Zip code centroids are loaded from the uszipcode database once and held as numpy arrays, and every coordinate
+        is then resolved by a haversine nearest-neighbour search over those arrays.  Results are optionally kept in a
+        json cache on disk, keyed by coordinates rounded to precision decimal places, so coordinates already resolved
+        are not searched again.
+
+        Args:
+            search: uszipcode SearchEngine object, or None (to build one by default)
+            cache_file (str): Filename of the json cache.  If None, no cache is used
+            radius (float): Maximum distance in miles to a zip code centroid.  Coordinates with no zip code within
+                            this distance resolve to None (same as the uszipcode by_coordinates default)
+            precision (int): Number of decimal places coordinates are rounded to for the cache key
+            chunk_size (int): Number of coordinates resolved per vectorized distance computation.  Bounds memory to
+                              roughly chunk_size * (number of zip codes) floats
+        """
+        self.search = search
+        self.cache_file = cache_file
+        self.radius = radius
+        self.precision = precision
+        self.chunk_size = chunk_size
+
+        self.zipcodes = None
+        self.zipcode_latitudes = None
+        self.zipcode_longitudes = None
+        self.zipcode_index = None
+
+        self.cache = {}
+        if self.cache_file and os.path.exists(self.cache_file):
+            with open(self.cache_file, 'r') as stream:
+                self.cache = json.load(stream)
+
+    def _load_zipcodes(self):
+        """
+        Loads all standard zip code centroids from the uszipcode database into numpy arrays
+        """
+        if not self.search:
+            self.search = SearchEngine(simple_zipcode=True)
+        klass = self.search.zip_klass
+        rows = self.search.ses.query(klass.zipcode, klass.lat, klass.lng).filter(
+            klass.zipcode_type == "Standard",
+            klass.lat.isnot(None),
+            klass.lng.isnot(None),
+        ).all()
+        self.zipcodes = np.array([r[0] for r in rows])
+        self.zipcode_latitudes = np.radians(np.array([r[1] for r in rows], dtype=float))
+        self.zipcode_longitudes = np.radians(np.array([r[2] for r in rows], dtype=float))
+        self.zipcode_index = {str(z): i for i, z in enumerate(self.zipcodes)}
+
+    def _key(self, latitude, longitude):
+        return f"{latitude:.{self.precision}f},{longitude:.{self.precision}f}"
+
+    def _nearest(self, latitudes, longitudes):
+        """
+        Returns the nearest zip code (or None if outside radius) for arrays of coordinates in degrees
+        """
+        if self.zipcodes is None:
+            self._load_zipcodes()
+
+        latitudes = np.radians(latitudes)[:, np.newaxis]
+        longitudes = np.radians(longitudes)[:, np.newaxis]
+
+        # Haversine distance from every coordinate (rows) to every zip code centroid (columns)
+        distances = haversine_miles(latitudes, longitudes, self.zipcode_latitudes, self.zipcode_longitudes)
+
+        i_nearest = np.argmin(distances, axis=1)
+        nearest_distances = distances[np.arange(len(i_nearest)), i_nearest]
+        return [str(z) if d <= self.radius else None for z, d in zip(self.zipcodes[i_nearest], nearest_distances)]
+
+    def locate(self, zipcodes):
+        """
+        Returns the centroid of each zip code
+
+        Args:
+            zipcodes (iterable): Zip codes (str)
+
+        Returns:
+            (tuple): (latitudes, longitudes) in degrees as numpy arrays.  Unknown zip codes are nan
+        """
+        if self.zipcodes is None:
+            self._load_zipcodes()
+
+        i_zipcodes = np.array([self.zipcode_index.get(str(z), -1) for z in zipcodes], dtype=int)
+        known = i_zipcodes >= 0
+        latitudes = np.where(known, np.degrees(self.zipcode_latitudes[i_zipcodes]), np.nan)
+        longitudes = np.where(known, np.degrees(self.zipcode_longitudes[i_zipcodes]), np.nan)
+        return latitudes, longitudes
+
+    def resolve(self, latitudes, longitudes):
+        """
+        Returns the nearest zip code for each coordinate
+
+        Args:
+            latitudes (iterable): Latitudes (float or str)
+            longitudes (iterable): Longitudes (float or str)
+
+        Returns:
+            (list): Zip code (str) or None for each coordinate
+        """
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        keys = [self._key(lat, lng) for lat, lng in zip(latitudes, longitudes)]
+
+        i_missing = np.array([i for i, k in enumerate(keys) if k not in self.cache], dtype=int)
+        for i_start in range(0, len(i_missing), self.chunk_size):
+            i_chunk = i_missing[i_start:i_start + self.chunk_size]
+            for i, zipcode in zip(i_chunk, self._nearest(latitudes[i_chunk], longitudes[i_chunk])):
+                self.cache[keys[i]] = zipcode
+
+        return [self.cache[k] for k in keys]
+
+    def save_cache(self):
+        """
+        Writes the cache to cache_file, if one was specified
+        """
+        if self.cache_file:
+            with open(self.cache_file, 'w') as stream:
+                json.dump(self.cache, stream)
+
+
 def load_settings(secrets='secrets.yml', data_cfg='data.yml'):
     """
     Loads and returns settings files
@@ -103,8 +344,28 @@ def load_settings(secrets='secrets.yml', data_cfg='data.yml'):
     return secrets, data_cfg
 
 
+def get_connection_kwargs(secrets, db):
+    """
+    Returns the keyword arguments needed by psycopg2.connect (or a psycopg2 pool) for a database in secrets
+
+    Args:
+        secrets (dict): Secrets loaded from secrets.yml
+        db (str): Name of the database entry in secrets (postgres, redshift, ...)
+
+    Returns:
+        (dict): Connection keyword arguments
+    """
+    return dict(
+        database=secrets[db]["database"],
+        user=secrets[db]["user"],
+        password=secrets[db]["password"],
+        host=secrets[db]["host"],
+        port=secrets[db]["port"],
+    )
+
+
 class Timer:
-    def __init__(self, enter_message=None, exit_message=None, print_function=print):
+    def __init__(self, enter_message=None, exit_message=None, print_function=print, name=None, attributes=None):
         """
         Construct a simple timer class.
 
@@ -112,10 +373,21 @@ class Timer:
             with Timer():
                 pass
 
+        Used as a context manager, the timer is also a span of the run's trace (see tracing.py).  A timer opened
+        inside another is recorded as its child, attributes describing the work done (rows, bytes, file, table, ...)
+        can be attached, and rows/sec and bytes/sec are derived from them when the timer exits, eg:
+            with Timer(name="stage file", attributes=dict(file=url, table=table_name)) as span:
+                span.set_attributes(rows=stage_file(...))
+
         Args:
             enter_message (str): If used as context manager, this message is printed at enter
             exit_message (str): If used as a context manager, this message is prepended to the context exit message
-            print_function: Function used for printing.  Default is print, but could be a logger.info, etc.
+            print_function: Function used for printing.  Default is print, but could be a logger.info, etc.  If None,
+                            nothing is printed
+            name (str): Name of the span in the trace.  Default is the enter (or exit) message stripped of indentation
+                        and arrows.  Give a name to timers whose messages include per-file or per-month values so
+                        their metrics are grouped together
+            attributes (dict): (optional) Attributes of the span.  More can be added using set_attributes
         """
         self.reference_time = None
         self.reset()
@@ -131,6 +403,24 @@ class Timer:
 
         self.print_function = print_function
 
+        if name is None:
+            message = enter_message if enter_message is not None else exit_message
+            name = re.sub(r"^-->\s*", "", str(message).strip()).rstrip(":") if message is not None else "timer"
+        self.name = name
+        self.attributes = dict(attributes or {})
+
+        self.span_id = None
+        self.parent_id = None
+        self.thread_id = None
+        self.thread_name = None
+        self.start_time = None
+        self.duration = None
+        self.error = None
+        self.peak_memory_bytes = None
+        self._token = None
+        self._memory_start = None
+        self._memory_peak = 0
+
     def elapsed(self):
         """
         Return the time elapsed between when this object was instantiated (or last reset) and now
@@ -149,10 +439,88 @@ class Timer:
         """
         self.reference_time = time.perf_counter()
 
+    def set_attributes(self, **attributes):
+        """
+        Attaches attributes to the span, eg: set_attributes(rows=1000, bytes=2 ** 20, file=url, table=table_name)
+
+        rows and bytes are used to derive rows_per_second and bytes_per_second
+        """
+        self.attributes.update(attributes)
+
+    def get_rates(self):
+        """
+        Returns rows_per_second and bytes_per_second of the span, for whichever of rows and bytes are set
+
+        Returns:
+            (dict)
+        """
+        duration = self.elapsed() if self.duration is None else self.duration
+        rates = {}
+        for attribute in ("rows", "bytes"):
+            if self.attributes.get(attribute) is not None and duration > 0:
+                rates[f"{attribute}_per_second"] = self.attributes[attribute] / duration
+        return rates
+
+    def to_dict(self):
+        """
+        Returns the span as a dict of its ids, timing, attributes, derived rates and peak memory
+
+        Returns:
+            (dict)
+        """
+        return dict(
+            name=self.name,
+            span_id=self.span_id,
+            parent_id=self.parent_id,
+            thread=self.thread_name,
+            start_time=self.start_time,
+            duration=self.duration,
+            error=self.error,
+            attributes=self.attributes,
+            peak_memory_bytes=self.peak_memory_bytes,
+            **self.get_rates(),
+        )
+
     def __enter__(self):
-        self.reset()
-        if self.enter_message:
+        parent = tracing.get_current_span()
+        self.span_id = tracing.tracer.next_id()
+        self.parent_id = None if parent is None else parent.span_id
+        thread = threading.current_thread()
+        self.thread_id = thread.ident
+        self.thread_name = thread.name
+        self._token = tracing.set_current_span(self)
+
+        if tracing.tracer.trace_memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            # Resetting the peak for this span would lose the parent's peak so far, so fold it into the parent first
+            if parent is not None:
+                parent._memory_peak = max(parent._memory_peak, peak)
+            tracemalloc.reset_peak()
+            self._memory_start = current
+            self._memory_peak = current
+
+        if self.enter_message and self.print_function:
             self.print_function(self.enter_message)
+        self.start_time = time.time()
+        self.reset()
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.print_function(f"{self.exit_message}Process took {self.elapsed():.1f}s")
+        self.duration = self.elapsed()
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        tracing.reset_current_span(self._token)
+
+        if self._memory_start is not None and tracemalloc.is_tracing():
+            # Peaks are approximate when spans run concurrently in threads, as tracemalloc only tracks one peak
+            self._memory_peak = max(self._memory_peak, tracemalloc.get_traced_memory()[1])
+            self.peak_memory_bytes = self._memory_peak - self._memory_start
+            parent = tracing.get_current_span()
+            if parent is not None:
+                parent._memory_peak = max(parent._memory_peak, self._memory_peak)
+
+        tracing.tracer.add(self)
+        if self.print_function:
+            rates = self.get_rates()
+            rate_message = f" ({rates['rows_per_second']:,.0f} rows/s)" if "rows_per_second" in rates else ""
+            self.print_function(f"{self.exit_message}Process took {self.duration:.1f}s{rate_message}")
@@ -0,0 +1,346 @@
+import argparse
+import copy
+import json
+
+import psycopg2
+
+from sql_queries import select_table_profile, null_count_aggregate, distinct_count_aggregate, validation_rules, \
+    production_table_sources, create_table_queries, create_olap_table_queries, validation_date_filters
+from tracing import add_tracing_arguments, start_tracing
+from utilities import load_settings, Timer, logging_argparse_kwargs, logging_argparse_args, get_logger, \
+    get_connection_kwargs
+
+logger = get_logger(name=__file__)
+
+
+def get_key_expression(columns):
+    """
+    Returns an expression that is distinct for each distinct combination of columns
+
+    Args:
+        columns (list): Column names
+
+    Returns:
+        (str)
+    """
+    if len(columns) == 1:
+        return columns[0]
+    return " || '|' || ".join(f"CAST({c} AS VARCHAR)" for c in columns)
+
+
+def get_date_range_params(date_range):
+    """
+    Returns the parameters of the filters in sql_queries.validation_date_filters for a range of dates
+
+    Args:
+        date_range (tuple): (first date, last date), both inclusive
+
+    Returns:
+        (dict)
+    """
+    date_start, date_end = date_range
+    return dict(date_start=date_start, date_end=date_end, month_start=date_start.year * 100 + date_start.month,
+                month_end=date_end.year * 100 + date_end.month)
+
+
+def get_profile_query(table_name, rules=None, date_range=None):
+    """
+    Returns a query that computes every check for a table in a single aggregate scan
+
+    The query returns one row of the row count, then the null count of each column in max_null_rate, then the number
+    of distinct unique keys if unique is set
+
+    Args:
+        table_name (str): Name of the table
+        rules (dict): Rules for the table (see sql_queries.validation_rules).  If None, only rows are counted
+        date_range (tuple): (optional) (first date, last date).  If set, only rows in this range are profiled, using
+                            the table's filter in sql_queries.validation_date_filters.  Query parameters are then
+                            given by get_date_range_params
+
+    Returns:
+        (str)
+    """
+    rules = rules or {}
+    aggregates = ["COUNT(*)"]
+    aggregates.extend(null_count_aggregate.format(column=column) for column in rules.get("max_null_rate", {}))
+    if rules.get("unique"):
+        aggregates.append(distinct_count_aggregate.format(key=get_key_expression(rules["unique"])))
+    where = ""
+    if date_range is not None:
+        if table_name not in validation_date_filters:
+            raise ValueError(f"Cannot profile a date range of {table_name}.  Tables with a date filter are "
+                             f"{list(validation_date_filters)}")
+        where = f"\nWHERE {validation_date_filters[table_name]}"
+    return select_table_profile.format(aggregates=",\n    ".join(aggregates), table_name=table_name, where=where)
+
+
+def profile_table(engine, table_name, rules=None, date_range=None):
+    """
+    Computes the row count, null rates and number of duplicate keys of a table in a single aggregate scan
+
+    Args:
+        engine: psycopg2 engine connected to postgres database
+        table_name (str): Name of the table
+        rules (dict): Rules for the table (see sql_queries.validation_rules).  If None, only rows are counted
+        date_range (tuple): (optional) (first date, last date).  If set, only rows in this range are profiled (see
+                            get_profile_query)
+
+    Returns:
+        (dict): {"rows": n, "null_rates": {column: fraction of rows null}, "duplicates": number of rows with a
+                 repeated unique key, or None if unique is not set}
+    """
+    rules = rules or {}
+    q = get_profile_query(table_name, rules, date_range)
+    logger.debug(f"query = {q}")
+    cur = engine.cursor()
+    cur.execute(q, None if date_range is None else get_date_range_params(date_range))
+    n_rows, *values = cur.fetchone()
+    engine.commit()
+
+    columns = list(rules.get("max_null_rate", {}))
+    # SUM of no rows is NULL
+    null_rates = {column: (values[i] or 0) / n_rows if n_rows else 0.0 for i, column in enumerate(columns)}
+    duplicates = n_rows - values[len(columns)] if rules.get("unique") else None
+    return dict(rows=n_rows, null_rates=null_rates, duplicates=duplicates)
+
+
+def check_profile(table_name, profile, rules=None, loaded_rows=None):
+    """
+    Returns descriptions of any rules a table profile breaks
+
+    Args:
+        table_name (str): Name of the table
+        profile (dict): Profile from profile_table
+        rules (dict): Rules for the table (see sql_queries.validation_rules)
+        loaded_rows (int): (optional) Number of rows reported by the load (eg: COPY) into the table.  If provided, the
+                           table must have exactly this many rows
+
+    Returns:
+        (list): List of str descriptions.  Empty if every check passed
+    """
+    rules = rules or {}
+    failures = []
+    if profile["rows"] == 0:
+        failures.append(f"{table_name} has no rows")
+    if loaded_rows is not None and loaded_rows != profile["rows"]:
+        failures.append(f"{table_name} was loaded with {loaded_rows} rows but has {profile['rows']}")
+    if profile["duplicates"]:
+        failures.append(f"{table_name} has {profile['duplicates']} rows with a duplicate "
+                        f"({', '.join(rules['unique'])})")
+    for column, max_null_rate in rules.get("max_null_rate", {}).items():
+        null_rate = profile["null_rates"][column]
+        if max_null_rate is not None and null_rate > max_null_rate:
+            failures.append(f"{table_name}.{column} is {null_rate:.2%} null (maximum {max_null_rate:.2%})")
+    return failures
+
+
+def reconcile_table(table_name, staged_rows, inserted_rows, rules=None):
+    """
+    Reconciles the rows staged for a table against the rows inserted into it
+
+    Args:
+        table_name (str): Name of the production table
+        staged_rows (int): Rows loaded into the staging table it is inserted from
+        inserted_rows (int): Rows inserted (or merged) into the table
+        rules (dict): Rules for the table (see sql_queries.validation_rules)
+
+    Returns:
+        (tuple): (result dict of staged, inserted, dropped and dropped_fraction, list of str failure descriptions)
+    """
+    rules = rules or {}
+    dropped = staged_rows - inserted_rows
+    dropped_fraction = dropped / staged_rows if staged_rows else 0.0
+    result = dict(staged=staged_rows, inserted=inserted_rows, dropped=dropped, dropped_fraction=dropped_fraction)
+
+    failures = []
+    if inserted_rows > staged_rows:
+        failures.append(f"{table_name} had {inserted_rows} rows inserted but only {staged_rows} were staged")
+    max_dropped_fraction = rules.get("max_dropped_fraction")
+    if max_dropped_fraction is not None and dropped_fraction > max_dropped_fraction:
+        failures.append(f"{table_name} dropped {dropped} of {staged_rows} staged rows ({dropped_fraction:.2%}, "
+                        f"maximum {max_dropped_fraction:.2%})")
+    return result, failures
+
+
+class DataValidator:
+    def __init__(self, engine, rules=None):
+        """
+        Runs data quality checks and row count reconciliation, collecting the results into a single summary.
+
+        Each table is checked by a single aggregate scan (see profile_table) rather than separate queries per check.
+        Row counts reported by loads (COPY, imports and inserts) are compared to the tables rather than counting rows
+        again after every load.
+
+        Args:
+            engine: psycopg2 engine connected to postgres database
+            rules (dict): Map of {table_name: rules}.  Default is sql_queries.validation_rules
+        """
+        self.engine = engine
+        self.rules = validation_rules if rules is None else rules
+        self.summary = dict(tables={}, reconciliation={}, failures=[])
+
+    def _fail(self, failures):
+        for failure in failures:
+            logger.error(f"\tvalidation failed: {failure}")
+        self.summary["failures"].extend(failures)
+
+    def profile(self, table_names, loaded_rows=None, date_ranges=None):
+        """
+        Profiles and checks tables, adding the results to the summary
+
+        Args:
+            table_names (iterable): Names of the tables to check
+            loaded_rows (dict): (optional) Map of {table_name: rows reported by the load into it}.  Tables listed must
+                                have exactly this many rows
+            date_ranges (dict): (optional) Map of {table_name: (first date, last date)}.  Only the rows of tables
+                                listed within their range are checked, eg: the dates touched by an incremental load
+        """
+        loaded_rows = loaded_rows or {}
+        date_ranges = date_ranges or {}
+        for table_name in table_names:
+            rules = self.rules.get(table_name, {})
+            date_range = date_ranges.get(table_name)
+            with Timer(exit_message=f"\t--> profiled {table_name}", print_function=logger.info, name="profile",
+                       attributes=dict(table=table_name)) as span:
+                profile = profile_table(self.engine, table_name, rules, date_range)
+                span.set_attributes(rows=profile["rows"])
+            profile["loaded_rows"] = loaded_rows.get(table_name)
+            profile["date_range"] = None if date_range is None else [str(d) for d in date_range]
+            failures = check_profile(table_name, profile, rules, loaded_rows=loaded_rows.get(table_name))
+            profile["failures"] = failures
+            self.summary["tables"][table_name] = profile
+            self._fail(failures)
+
+    def reconcile(self, staged_rows, inserted_rows, sources=None):
+        """
+        Reconciles rows staged against rows inserted for every production table with both counts, adding the results
+        to the summary
+
+        Args:
+            staged_rows (dict): Map of {staging table name: rows loaded}
+            inserted_rows (dict): Map of {production table name: rows inserted or merged}
+            sources (dict): Map of {production table name: staging table name}.  Default is
+                            sql_queries.production_table_sources
+        """
+        sources = sources or production_table_sources
+        for table_name, source in sources.items():
+            if table_name not in inserted_rows or source not in staged_rows:
+                continue
+            result, failures = reconcile_table(table_name, staged_rows[source], inserted_rows[table_name],
+                                               self.rules.get(table_name))
+            result.update(source=source, failures=failures)
+            self.summary["reconciliation"][table_name] = result
+            self._fail(failures)
+
+    @property
+    def passed(self):
+        return len(self.summary["failures"]) == 0
+
+    def log_summary(self):
+        """
+        Logs one line per table checked and per table reconciled
+        """
+        for table_name, profile in self.summary["tables"].items():
+            null_rates = ", ".join(f"{c}={r:.2%}" for c, r in profile["null_rates"].items())
+            logger.info(f"\t{table_name}: rows={profile['rows']}, duplicates={profile['duplicates']}"
+                        f"{', null rates: ' + null_rates if null_rates else ''}")
+        for table_name, result in self.summary["reconciliation"].items():
+            logger.info(f"\t{table_name}: staged={result['staged']} ({result['source']}), "
+                        f"inserted={result['inserted']}, dropped={result['dropped']} "
+                        f"({result['dropped_fraction']:.2%})")
+        logger.info(f"\tValidation {'passed' if self.passed else 'failed'} with "
+                    f"{len(self.summary['failures'])} failures")
+
+    def write_summary(self, output):
+        """
+        Writes the summary to a json file
+        """
+        with open(output, "w") as stream:
+            json.dump(dict(passed=self.passed, **self.summary), stream, indent=2)
+        logger.info(f"Wrote validation summary to {output}")
+
+    def raise_for_failures(self):
+        """
+        Raises a ValueError listing every failed check, if any failed
+        """
+        if not self.passed:
+            raise ValueError(f"{len(self.summary['failures'])} validation checks failed: {self.summary['failures']}")
+
+
+def parse_null_rate_overrides(override_args, rules=None):
+    """
+    Returns a copy of rules with maximum null rates overridden by strings of "table.column=rate"
+
+    Args:
+        override_args (list): List of "table.column=rate" strings, or None.  A rate of "none" only reports the rate
+        rules (dict): Map of {table_name: rules}.  Default is sql_queries.validation_rules
+
+    Returns:
+        (dict): Map of {table_name: rules}
+    """
+    rules = copy.deepcopy(validation_rules if rules is None else rules)
+    for override_arg in override_args or []:
+        column, rate = override_arg.rsplit("=", 1)
+        table_name, column = column.split(".", 1)
+        rate = None if rate.lower() == "none" else float(rate)
+        rules.setdefault(table_name, {}).setdefault("max_null_rate", {})[column] = rate
+    return rules
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Checks row counts, duplicate keys and null rates of production and "
+                                                 "OLAP tables, using one aggregate scan per table")
+    parser.add_argument(
+        '--db',
+        action="store",
+        default="postgres",
+        help="Name of db credentials in secrets.yaml.  Use this to point at different dbs (postgres, redshift, ...)"
+    )
+    parser.add_argument(
+        '--table',
+        action="append",
+        default=None,
+        help="Table to check.  Can be given multiple times.  Default is all production and OLAP tables"
+    )
+    parser.add_argument(
+        '--max_null_rate',
+        action="append",
+        default=None,
+        help="Overrides the maximum null rate of a column, as 'table.column=rate' (eg: 'stores.zipcode=0.05'), or "
+             "'table.column=none' to only report it.  Can be given multiple times"
+    )
+    parser.add_argument(
+        '--output',
+        action="store",
+        default=None,
+        help="If set, writes the validation summary to this json file"
+    )
+    parser.add_argument(*logging_argparse_args, **logging_argparse_kwargs)
+    add_tracing_arguments(parser)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    """
+    Validate the tables of a database
+    """
+    args = parse_arguments()
+
+    if args.set_logging_level:
+        logger.setLevel(str(args.set_logging_level).upper())
+
+    start_tracing(Timer(name="validation", exit_message="--> validation complete", print_function=logger.info),
+                  trace_output=args.trace_output, metrics_output=args.metrics_output, trace_memory=args.trace_memory)
+
+    secrets, _ = load_settings()
+
+    engine = psycopg2.connect(**get_connection_kwargs(secrets, args.db))
+
+    validator = DataValidator(engine, rules=parse_null_rate_overrides(args.max_null_rate))
+    with Timer(enter_message="Validating tables", exit_message="--> validation complete", print_function=logger.info):
+        validator.profile(args.table or list(create_table_queries) + list(create_olap_table_queries))
+    validator.log_summary()
+    if args.output:
+        validator.write_summary(args.output)
+    validator.raise_for_failures()